@@ -18,6 +18,11 @@ angular.module('XBeeWiFiApp')
             $log.debug("Got new data: ", event);
             new_data_handler(event);
         });
+        // Server batches bursts of device data into one message
+        socket.addListener('device_data_batch', function (events) {
+            $log.debug("Got new data batch: ", events);
+            _.each(events, new_data_handler);
+        });
 
         var disconnected = false;
         var disconnectedToast;
@@ -82,6 +87,11 @@ angular.module('XBeeWiFiApp')
         // matches (Device ID)/(stream name)
         var streamRegex = /^([0-9a-f]{8}-[0-9a-f]{8}-[0-9a-f]{8}-[0-9a-f]{8})\/(.*)$/i;
 
+        // Newest timestamp seen for each streamId
+        var latest_timestamps = {};
+
+        // Returns the device ID of the data point, or undefined if it was
+        // rejected
         var new_data_handler = function (obj) {
             var point = obj.DataPoint || {};
             if (_.isEmpty(point)) {
@@ -139,6 +149,9 @@ angular.module('XBeeWiFiApp')
                 timestamp: timestamp,
                 value: value
             };
+            if (!(latest_timestamps[streamId] >= timestamp)) {
+                latest_timestamps[streamId] = timestamp;
+            }
             tree.trigger(device, stream, new_data);
         };
 
@@ -152,7 +165,12 @@ angular.module('XBeeWiFiApp')
             initial_data_map[device].then(function(data){
                 var streamId = device + "/" + stream;
                 var datastream = _.find(data, {'streamId': streamId});
-                if(datastream){
+                if(datastream && latest_timestamps[streamId] >=
+                        _.parseInt(datastream.currentValue.timestamp)){
+                    // The socket has already sent this value or a newer one
+                    $log.debug("Skipping older initial data for " + streamId);
+                }
+                else if(datastream){
                     $log.debug("Loading initial data for " + streamId , datastream);
                     //Data returned from /datastream is formatted a bit differently than monitor events
                     new_data_handler({
@@ -63,6 +63,7 @@ describe("Service: dataStreams", function() {
 
     it("should call socket.addListener and socket.on appropriately, right away", function () {
         expect(socket.addListener).toHaveBeenCalledWith('device_data', jasmine.any(Function));
+        expect(socket.addListener).toHaveBeenCalledWith('device_data_batch', jasmine.any(Function));
         expect(socket.on).toHaveBeenCalledWith('connect', jasmine.any(Function));
         expect(socket.on).toHaveBeenCalledWith('disconnect', jasmine.any(Function));
         expect(socket.on).toHaveBeenCalledWith('started_monitoring', jasmine.any(Function));
@@ -113,6 +114,41 @@ describe("Service: dataStreams", function() {
         expect(api.device_data).toHaveBeenCalledWith("my device");
     });
 
+    it("should query initial data for streams the socket hasn't sent", function () {
+        spyOn(tree, 'trigger');
+        // e.g. a single live push for one of the device's streams
+        socket_listeners.device_data_batch([
+            {DataPoint: {streamId: deviceId + "/DIO/0", data: 1, timestamp: 10}}
+        ]);
+        streams.get_initial_data(deviceId, "DIO/1");
+        expect(api.device_data).toHaveBeenCalledWith(deviceId);
+
+        device_data_deferreds[deviceId].resolve([
+            {streamId: deviceId + "/DIO/1", currentValue: {data: 0, timestamp: 5}}
+        ]);
+        rootScope.$digest();
+        expect(tree.trigger).toHaveBeenCalledWith(deviceId, "DIO/1", {timestamp: 5, value: 0});
+    });
+
+    it("should not overwrite newer socket data with initial data", function () {
+        spyOn(tree, 'trigger');
+        streams.get_initial_data(deviceId, "DIO/0");
+        streams.get_initial_data(deviceId, "DIO/1");
+        // The replay arrives before the query's answer
+        socket_listeners.device_data({
+            DataPoint: {streamId: deviceId + "/DIO/0", data: 1, timestamp: 10}
+        });
+        tree.trigger.reset();
+
+        device_data_deferreds[deviceId].resolve([
+            {streamId: deviceId + "/DIO/0", currentValue: {data: 0, timestamp: 5}},
+            {streamId: deviceId + "/DIO/1", currentValue: {data: 0, timestamp: 5}}
+        ]);
+        rootScope.$digest();
+        expect(tree.trigger).not.toHaveBeenCalledWith(deviceId, "DIO/0", jasmine.any(Object));
+        expect(tree.trigger).toHaveBeenCalledWith(deviceId, "DIO/1", {timestamp: 5, value: 0});
+    });
+
     describe("should bring up a notification when an error is received", function () {
         beforeEach(function () {
             // No notifications initially.
@@ -177,6 +213,7 @@ describe("Service: dataStreams", function() {
     it("(CODE COVERAGE CASE)", function () {
         socket_listeners.started_monitoring();
         socket_listeners.device_data({});
+        socket_listeners.device_data_batch([{}, {}]);
 
         streams.get_initial_data("device", "a");
         // covers 'else' branch of get_initial_data if statement
@@ -0,0 +1,207 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Adaptive batching for Device Cloud DataPoint monitors
+
+Each monitor's message rate and delivery latency are measured from the pushes
+it sends. Periodically, its monBatchDuration and monBatchSize are adjusted:
+quiet monitors (e.g. a kit someone is pressing buttons on) get the shortest
+duration, so events show up quickly, while busy monitors get longer
+durations and bigger batches, so they send fewer pushes. Durations never
+exceed the configured bounds, and are cut back when observed latency goes
+over MAX_LATENCY.
+
+Pushes are counted by every worker the monitor bus reaches, whichever worker
+accepted them, but a monitor is only tuned by the worker which last set it
+up.
+'''
+import logging
+import math
+import os
+import gevent
+from django.conf import settings
+from requests.exceptions import HTTPError, ConnectionError
+from monitors import monitor_states
+from xbeewifiapp.libs.digi.connections import connector_registry
+
+logger = logging.getLogger(__name__)
+
+
+class MonitorBatchTuner(object):
+    """
+    Recommends and applies batch settings for the monitors in a
+    MonitorStateCache
+    """
+
+    def __init__(self, states, connectors, interval=60, min_duration=1,
+                 max_duration=5, max_latency=5, busy_rate=50, min_size=10,
+                 max_size=1000):
+        """
+        Args:
+            states (MonitorStateCache): Monitors to tune
+            connectors (ConnectorRegistry): Where to find the connector for
+                            a monitor's account when it is changed
+        Kwargs:
+            interval (int): Seconds between tuning passes, which is also the
+                            measurement window
+            min_duration (int): Shortest monBatchDuration, in seconds
+            max_duration (int): Longest monBatchDuration, in seconds. No
+                            more than max_latency, which a batch would
+                            otherwise exceed on its own.
+            max_latency (float): Observed delivery latency, in seconds, above
+                            which durations are shortened
+            busy_rate (float): Messages per second at which a monitor is
+                            given max_duration
+            min_size (int): Smallest monBatchSize
+            max_size (int): Largest monBatchSize
+        """
+        if max_duration > max_latency:
+            raise ValueError('Monitor batch duration %s is over the latency '
+                             'budget of %s' % (max_duration, max_latency))
+        self.states = states
+        self.connectors = connectors
+        self.interval = interval
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.max_latency = max_latency
+        self.busy_rate = busy_rate
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pid = None
+        self._worker = None
+        # monitor key -> measurements and chosen settings from the last pass
+        self.last_results = {}
+
+    def recommend(self, message_rate, latency, current_duration):
+        """
+        Return (batch_size, batch_duration) for a monitor
+
+        Args:
+            message_rate (float): Messages per second pushed by the monitor
+            latency (float): Worst observed delivery latency in seconds, or
+                             None if unknown
+            current_duration (int): Monitor's current batch duration, or None
+        """
+        # Scale duration with how busy the monitor is
+        busy = min(1.0, message_rate / float(self.busy_rate))
+        duration = self.min_duration + \
+            (self.max_duration - self.min_duration) * busy
+
+        # Latency includes the batching delay; if it is over budget, take
+        # the excess off the current duration
+        if latency is not None and latency > self.max_latency and \
+                current_duration is not None:
+            duration = min(duration,
+                           current_duration - (latency - self.max_latency))
+
+        duration = int(max(self.min_duration,
+                           min(self.max_duration, self.max_latency,
+                               round(duration))))
+
+        # Room for twice the expected batch, so batches are closed by
+        # duration rather than size
+        size = int(math.ceil(message_rate * duration * 2))
+        size = max(self.min_size, min(self.max_size, size))
+        return size, duration
+
+    def tune(self):
+        """
+        Run one tuning pass over every known monitor
+        """
+        results = {}
+        for key, stats in self.states.take_stats():
+            size, duration = self.recommend(
+                stats['message_rate'], stats['latency_max'],
+                stats['batch_duration'])
+            stats.update(recommended_size=size, recommended_duration=duration)
+            results[key] = stats
+
+            if not stats['owned']:
+                # Another worker set it up since, and tunes it
+                continue
+            if stats['monitor_id'] is None or stats['batch_duration'] is None:
+                # Can't update this monitor, or its settings are unknown
+                continue
+            if stats['message_rate'] == 0:
+                # Nothing measured to go on
+                continue
+            if (size, duration) == (stats['batch_size'],
+                                    stats['batch_duration']):
+                continue
+            # Looked up now, so the account's current credentials are used
+            connector = self.connectors.find(key[0], key[1])
+            if connector is None:
+                # Nobody from the account has been around for a while
+                continue
+
+            logger.info('Changing batching of monitor %s from %s/%ss to '
+                        '%s/%ss (%.2f msgs/s, max latency %s)'
+                        % (stats['monitor_id'], stats['batch_size'],
+                           stats['batch_duration'], size, duration,
+                           stats['message_rate'], stats['latency_max']))
+            try:
+                connector.set_monitor_batching(
+                    stats['monitor_id'], size, duration)
+            except (HTTPError, ConnectionError), e:
+                logger.warning('Could not update batching of monitor %s: %s'
+                               % (stats['monitor_id'], e))
+                continue
+            self.states.set_batching(key, size, duration)
+        self.last_results = results
+
+    def start(self):
+        """
+        Start tuning in the background. Safe to call repeatedly; resets
+        itself in forked children.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._worker = None
+        if self._worker is None or self._worker.dead:
+            self._worker = gevent.spawn(self._run)
+
+    def stats(self):
+        """
+        Return the measurements and settings from the last tuning pass
+        """
+        return [{
+            'topic': key[2],
+            'monitor_id': result['monitor_id'],
+            'owned': result['owned'],
+            'message_rate': result['message_rate'],
+            'push_rate': result['push_rate'],
+            'latency_mean': result['latency_mean'],
+            'latency_max': result['latency_max'],
+            'batch_size': result['batch_size'],
+            'batch_duration': result['batch_duration'],
+            'recommended_size': result['recommended_size'],
+            'recommended_duration': result['recommended_duration'],
+        } for key, result in self.last_results.items()]
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.tune()
+            except Exception:
+                logger.exception('Error tuning monitor batching')
+
+
+_tuning_settings = settings.MONITOR_BATCH_TUNING
+
+monitor_tuner = MonitorBatchTuner(
+    monitor_states,
+    connector_registry,
+    interval=_tuning_settings.get('INTERVAL', 60),
+    min_duration=_tuning_settings.get('MIN_DURATION', 1),
+    max_duration=_tuning_settings.get('MAX_DURATION', 5),
+    max_latency=_tuning_settings.get('MAX_LATENCY', 5),
+    busy_rate=_tuning_settings.get('BUSY_RATE', 50),
+    min_size=_tuning_settings.get('MIN_SIZE', 10),
+    max_size=_tuning_settings.get('MAX_SIZE', 1000))
@@ -0,0 +1,221 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Bounded queue decoupling receipt of Device Cloud monitor pushes from fan-out
+
+The monitor receiver only parses and validates a push, queues its events and
+acknowledges it. Worker greenlets drain the queue and publish each event to
+the monitor bus, so a slow socket no longer holds Device Cloud's request open.
+'''
+import logging
+import os
+import time
+import gevent
+from gevent.event import Event
+from gevent.queue import JoinableQueue, Empty
+from django.conf import settings
+from pubsub import monitor_bus, publish_datapoints_missed
+
+logger = logging.getLogger(__name__)
+
+# What to do with a push when the queue can't hold all of its events
+DROP_OLDEST = 'drop-oldest'
+BLOCK = 'block'
+REJECT = 'reject'
+OVERFLOW_POLICIES = (DROP_OLDEST, BLOCK, REJECT)
+
+
+class DispatchQueue(object):
+    """
+    Queue of (topic, device_id, data) monitor events, published by a pool of
+    worker greenlets
+    """
+
+    def __init__(self, publish, max_size=10000, workers=1,
+                 overflow=DROP_OLDEST, block_timeout=5, missed=None):
+        """
+        Args:
+            publish (callable): Called with (topic, device_id, data) for
+                                each queued event
+        Kwargs:
+            max_size (int): Maximum number of queued events
+            workers (int): Number of worker greenlets. More than one may
+                           reorder events for the same device.
+            overflow (str): One of OVERFLOW_POLICIES.
+                            drop-oldest - discard the oldest queued events
+                            block - wait up to block_timeout seconds for room
+                                    for the whole push, else refuse it
+                            reject - refuse the whole push
+            block_timeout (float): Seconds to wait for room with 'block'
+            missed (callable): Called with the ids of the devices whose
+                           DataPoint events were dropped
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %s' % overflow)
+        self.publish = publish
+        self.max_size = max_size
+        self.num_workers = workers
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.missed = missed
+        self._pid = None
+        self._queue = None
+        self._room = None
+        self._workers = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.enqueued = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self):
+        """
+        Return a dict of queue metrics for this worker process
+        """
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'capacity': self.max_size,
+            'overflow': self.overflow,
+            'enqueued': self.enqueued,
+            'dispatched': self.dispatched,
+            'dropped': self.dropped,
+            'rejected': self.rejected,
+            'errors': self.errors,
+        }
+
+    def start(self):
+        """
+        Start the worker greenlets. Safe to call repeatedly; resets itself in
+        forked children.
+        """
+        if self._pid != os.getpid():
+            # Queue and greenlets inherited from a parent belong to its hub
+            self._pid = os.getpid()
+            self._queue = JoinableQueue(self.max_size)
+            # Set whenever a worker takes an event off the queue
+            self._room = Event()
+            self._workers = []
+        self._workers = [w for w in self._workers if not w.dead]
+        while len(self._workers) < self.num_workers:
+            self._workers.append(gevent.spawn(self._work))
+
+    @property
+    def streams(self):
+        """
+        Whether a push may be queued in parts as it is read. Refusing a push
+        makes Device Cloud send all of it again, so otherwise a push is
+        queued whole or not at all.
+        """
+        return self.overflow == DROP_OLDEST
+
+    def has_room(self, count):
+        """
+        Return False if a push of count events would certainly be refused
+        """
+        if self.overflow == REJECT:
+            return self.depth + count <= self.max_size
+        return self.overflow == DROP_OLDEST or count <= self.max_size
+
+    def enqueue(self, events):
+        """
+        Queue a push's events for publishing. With the block and reject
+        policies, either all of them are queued or none.
+
+        Returns False if the push was refused because the queue is full,
+        True otherwise.
+        """
+        self.start()
+        queue = self._queue
+
+        if self.overflow == BLOCK:
+            deadline = time.time() + self.block_timeout
+            while queue.qsize() + len(events) > self.max_size:
+                remaining = deadline - time.time()
+                if len(events) > self.max_size or remaining <= 0:
+                    break
+                self._room.clear()
+                self._room.wait(remaining)
+
+        if self.overflow != DROP_OLDEST and \
+                queue.qsize() + len(events) > self.max_size:
+            self.rejected += len(events)
+            logger.warning('Monitor dispatch queue full (%d queued), '
+                           'rejecting push of %d events'
+                           % (queue.qsize(), len(events)))
+            return False
+
+        dropped = 0
+        dropped_devices = set()
+        for event in events:
+            if self.overflow == DROP_OLDEST:
+                while queue.full():
+                    try:
+                        topic, device_id, data = queue.get_nowait()
+                    except Empty:
+                        break
+                    queue.task_done()
+                    dropped += 1
+                    if topic == 'DataPoint':
+                        dropped_devices.add(device_id)
+            queue.put_nowait(event)
+
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, queue.qsize())
+
+        if dropped:
+            self.dropped += dropped
+            logger.warning('Monitor dispatch queue full, dropped the %d '
+                           'oldest events' % dropped)
+        if dropped_devices and self.missed is not None:
+            self.missed(dropped_devices)
+        return True
+
+    def join(self, timeout=None):
+        """
+        Wait until every queued event has been published. Returns False if
+        the timeout expired first.
+        """
+        if self._queue is None:
+            return True
+        return self._queue.join(timeout)
+
+    def _work(self):
+        queue = self._queue
+        while True:
+            topic, device_id, data = queue.get()
+            self._room.set()
+            try:
+                self.publish(topic, device_id, data)
+                self.dispatched += 1
+            except Exception:
+                self.errors += 1
+                logger.exception('Error dispatching monitor event for %s'
+                                 % device_id)
+            finally:
+                queue.task_done()
+
+
+_dispatch_settings = settings.MONITOR_DISPATCH
+
+monitor_dispatcher = DispatchQueue(
+    monitor_bus.publish,
+    max_size=_dispatch_settings.get('QUEUE_SIZE', 10000),
+    workers=_dispatch_settings.get('WORKERS', 1),
+    overflow=_dispatch_settings.get('OVERFLOW', DROP_OLDEST),
+    block_timeout=_dispatch_settings.get('BLOCK_TIMEOUT', 5),
+    missed=publish_datapoints_missed)
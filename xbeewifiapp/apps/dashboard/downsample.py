@@ -0,0 +1,251 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Reduction of DataPoint histories to a chart's worth of points
+
+Used when Device Cloud can't roll a stream up itself: for windows shorter
+than its finest rollup interval, for non-rollup methods like LTTB, or when
+rollups are refused; and to reduce rollups which still have too many points.
+Points come in oldest first, as Device Cloud returns them, and are reduced
+as they arrive, either into fixed time buckets (min, max, average, sum,
+count), or with Largest-Triangle-Three-Buckets, which keeps the original
+points that best preserve the shape of the line. Streams of strings can
+only be sampled, keeping the first point in each time bucket.
+'''
+import itertools
+from xbeewifiapp.libs.digi.datapoint import DataPoint
+
+AGGREGATE_METHODS = ('average', 'min', 'max', 'sum', 'count')
+METHODS = AGGREGATE_METHODS + ('lttb',)
+
+# Method to reduce already rolled up points with, where it isn't the one
+# they were rolled up with
+ROLLUP_REDUCTIONS = {'count': 'sum'}
+
+
+def numeric_points(items):
+    """
+    Return a list of (timestamp millis, value, item) for DataPoints, or None
+    if any point's data isn't a number
+    """
+    points = []
+    append = points.append
+    for item in items:
+        try:
+            append((int(item.timestamp), float(item.data), item))
+        except (TypeError, ValueError):
+            return None
+    return points
+
+
+def aggregate(points, start, end, buckets, method):
+    """
+    Reduce points to one per time bucket
+
+    Args:
+        points (list): (timestamp millis, value, item) tuples, oldest first
+        start (int): Start of the window, millis
+        end (int): End of the window, millis
+        buckets (int): Number of equal width buckets to split the window into
+        method (str): One of AGGREGATE_METHODS
+
+    Returns:
+        list of DataPoints, with the bucket's start as timestamp, for buckets
+        holding any points. Points outside the window go in the
+        first or last bucket.
+    """
+    width = max(1, -(-(end - start) // buckets))
+    reduce_values = {
+        'average': lambda values: sum(values) / len(values),
+        'min': min,
+        'max': max,
+        'sum': sum,
+        'count': len,
+    }[method]
+
+    last = buckets - 1
+    results = []
+    bucket = None
+    values = []
+    for timestamp, value, item in points:
+        index = min(max((timestamp - start) // width, 0), last)
+        if index != bucket:
+            if values:
+                results.append(_bucket_point(start + bucket * width,
+                                             reduce_values(values)))
+            bucket = index
+            values = []
+        values.append(value)
+    if values:
+        results.append(_bucket_point(start + bucket * width,
+                                     reduce_values(values)))
+    return results
+
+
+def sample(items, start, end, buckets):
+    """
+    Keep the first DataPoint in each time bucket, for streams whose values
+    can't be combined
+
+    Args:
+        items (iterable): DataPoint objects, oldest first
+        start (int): Start of the window, millis
+        end (int): End of the window, millis
+        buckets (int): Number of equal width buckets to split the window into
+
+    Returns:
+        list of at most buckets of the DataPoints, unchanged
+    """
+    width = max(1, -(-(end - start) // buckets))
+    last = buckets - 1
+    kept = []
+    bucket = None
+    for item in items:
+        timestamp = item.millis
+        if timestamp is None:
+            continue
+        index = min(max((timestamp - start) // width, 0), last)
+        if bucket is None or index > bucket:
+            kept.append(item)
+            bucket = index
+    return kept
+
+
+def _bucket_point(timestamp, value):
+    # Match Device Cloud's representation, everything a string
+    return DataPoint(timestamp=str(timestamp), data=repr(value))
+
+
+def lttb_by_time(points, start, end, threshold):
+    """
+    Largest-Triangle-Three-Buckets over equal time buckets rather than equal
+    counts of points, so points can be reduced as they arrive: only the
+    bucket being chosen from and the one after it are held.
+
+    Args:
+        points (iterable): (timestamp millis, value, item) tuples, oldest
+                           first
+        start (int): Start of the window, millis
+        end (int): End of the window, millis
+        threshold (int): Most points to keep, at least 3
+
+    Returns:
+        list of the items of the points kept, including the first and last
+    """
+    points = iter(points)
+    first = next(points, None)
+    if first is None:
+        return []
+    kept = [first[2]]
+    # Buckets between the fixed first and last points
+    buckets = threshold - 2
+    width = max(1, -(-(end - start) // buckets))
+    last_bucket = buckets - 1
+    previous = first
+    current = []
+    following = []
+    following_index = None
+    for point in points:
+        index = min(max((point[0] - start) // width, 0), last_bucket)
+        if index != following_index:
+            if current:
+                previous = _largest_triangle(previous, current, following)
+                kept.append(previous[2])
+            current = following
+            following = []
+            following_index = index
+        following.append(point)
+
+    if not following:
+        return kept
+    # The newest point is kept as it is, closing the last bucket
+    last = following.pop()
+    if current:
+        previous = _largest_triangle(previous, current, following or [last])
+        kept.append(previous[2])
+    if following:
+        kept.append(_largest_triangle(previous, following, [last])[2])
+    kept.append(last[2])
+    return kept
+
+
+def _largest_triangle(a, bucket, following):
+    # The point of bucket making the largest triangle with the point kept
+    # before it, a, and the average of the next bucket
+    avg_x = float(sum(point[0] for point in following)) / len(following)
+    avg_y = sum(point[1] for point in following) / len(following)
+    ax, ay = a[0], a[1]
+    return max(bucket, key=lambda point: abs(
+        (ax - avg_x) * (point[1] - ay) - (ax - point[0]) * (avg_y - ay)))
+
+
+def weighted_average(points, counts, start, end, buckets):
+    """
+    Reduce rolled up averages to one per time bucket, weighting each by the
+    number of points it averaged
+
+    Args:
+        points (list): (timestamp millis, value, item) tuples of the
+                       averages, oldest first
+        counts (list): (timestamp millis, value, item) tuples of the counts
+                       rolled up over the same intervals
+        start (int): Start of the window, millis
+        end (int): End of the window, millis
+        buckets (int): Number of equal width buckets to split the window into
+    """
+    counts = dict((timestamp, value) for timestamp, value, item in counts)
+    totals = []
+    weights = []
+    for timestamp, value, item in points:
+        count = counts.get(timestamp)
+        if count:
+            totals.append((timestamp, value * count, item))
+            weights.append((timestamp, count, item))
+    return [_bucket_point(int(total.timestamp),
+                          float(total.data) / float(weight.data))
+            for total, weight in zip(
+                aggregate(totals, start, end, buckets, 'sum'),
+                aggregate(weights, start, end, buckets, 'sum'))]
+
+
+def _iter_numeric(items):
+    for item in items:
+        try:
+            yield int(item.timestamp), float(item.data), item
+        except (TypeError, ValueError):
+            # Can't be placed on the chart
+            continue
+
+
+def downsample(items, start, end, target, method):
+    """
+    Reduce DataPoints to at most target points, in one pass over them
+
+    Args:
+        items (iterable): DataPoint objects, oldest first
+        start (int): Start of the window, millis
+        end (int): End of the window, millis
+        target (int): Most points to return
+        method (str): One of METHODS
+
+    Returns:
+        list of DataPoints. Non-numeric streams are sampled, as there is
+        nothing to average. Only the first target + 1 points are checked,
+        and non-numeric points after them are left out.
+    """
+    items = iter(items)
+    head = list(itertools.islice(items, target + 1))
+    if len(head) <= target:
+        return head
+    if numeric_points(head) is None:
+        return sample(itertools.chain(head, items), start, end, target)
+    points = _iter_numeric(itertools.chain(head, items))
+    if method == 'lttb':
+        return lttb_by_time(points, start, end, target)
+    return aggregate(points, start, end, target, method)
@@ -0,0 +1,84 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Latest DataPoint push seen for each device stream
+
+Lets a socket that starts monitoring a device be sent current values right
+away, instead of waiting for the device's next push. Pushes are kept as
+compact DataPoints and turned back into messages when sent.
+'''
+import logging
+from collections import OrderedDict
+from django.conf import settings
+from xbeewifiapp.libs.digi.datapoint import DataPoint
+
+logger = logging.getLogger(__name__)
+
+
+class LatestValueCache(object):
+    """
+    Most recent DataPoint push message for each stream, grouped by device.
+    The least recently updated devices are forgotten once max_devices is
+    reached.
+    """
+
+    def __init__(self, max_devices=1000):
+        self.max_devices = max_devices
+        # device_id -> {streamId: DataPoint}
+        self._devices = OrderedDict()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def update(self, device_id, msg):
+        """
+        Remember a DataPoint push message, unless a newer value for the same
+        stream has already been seen
+        """
+        try:
+            point = DataPoint.from_message(msg)
+        except (KeyError, TypeError, AttributeError):
+            return
+        stream_id = point.stream_id
+        if stream_id is None:
+            return
+
+        streams = self._devices.pop(device_id, None)
+        if streams is None:
+            streams = {}
+            if len(self._devices) >= self.max_devices:
+                self._devices.popitem(last=False)
+        # Re-inserting keeps the dict ordered from least to most recent
+        self._devices[device_id] = streams
+
+        previous = streams.get(stream_id)
+        if previous is not None and \
+                (previous.timestamp or 0) > (point.timestamp or 0):
+            # Pushes can arrive out of order
+            return
+        streams[stream_id] = point
+
+    def snapshot(self, device_id):
+        """
+        Return the latest push message for each of a device's streams
+        """
+        streams = self._devices.get(device_id)
+        if not streams:
+            return []
+        return [streams[stream_id].to_message()
+                for stream_id in sorted(streams)]
+
+    def discard(self, device_id):
+        self._devices.pop(device_id, None)
+
+    def clear(self):
+        self._devices.clear()
+
+
+latest_values = LatestValueCache(settings.LATEST_VALUE_CACHE_SIZE)
@@ -0,0 +1,167 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Measure push-to-emit latency of the monitor pub/sub backends
+
+Forks the requested number of subscriber worker processes, publishes DataPoint
+events from this process as if it had received Device Cloud pushes, and
+reports how long each event took to reach the subscribers.
+
+Example:
+    python manage.py benchmark_monitor_pubsub --backend=unix --workers=1,4,16
+'''
+import json
+import os
+import shutil
+import tempfile
+import time
+from optparse import make_option
+
+import gevent
+from gevent.event import Event
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from xbeewifiapp.apps.dashboard.pubsub import create_backend
+
+DEVICE_ID = '00000000-00000000-00000000-00000001'
+
+
+def _run_subscriber(config, expected, ready_fd, result_path, timeout):
+    """
+    Body of a forked subscriber: record latency of every event received
+    """
+    latencies = []
+    done = Event()
+
+    def deliver(topic, device_id, data):
+        latencies.append(time.time() - data['sent'])
+        if len(latencies) >= expected:
+            done.set()
+        return True
+
+    backend = create_backend(config, deliver)
+    backend.start()
+    os.write(ready_fd, 'r')
+    done.wait(timeout)
+
+    with open(result_path, 'w') as f:
+        json.dump(latencies, f)
+
+
+def _percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark push-to-emit latency of the monitor pub/sub backends'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--backend', default='unix',
+                    help='Backend to test: local, unix or postgres'),
+        make_option('--workers', default='1,4,16',
+                    help='Comma separated subscriber worker counts'),
+        make_option('--messages', type='int', default=1000,
+                    help='Events to publish per run'),
+        make_option('--interval', type='float', default=0.001,
+                    help='Seconds between published events'),
+        make_option('--timeout', type='float', default=30,
+                    help='Seconds to wait for subscribers'),
+    )
+
+    def handle(self, *args, **options):
+        backend = options['backend']
+        try:
+            worker_counts = [int(n) for n in options['workers'].split(',')]
+        except ValueError:
+            raise CommandError('--workers must be a list of integers')
+        if backend == 'local':
+            # Everything happens in this process
+            worker_counts = [1]
+
+        self.stdout.write('%-9s %7s %8s %9s %9s %9s %9s' % (
+            'backend', 'workers', 'received', 'mean ms', 'p50 ms',
+            'p99 ms', 'max ms'))
+
+        for workers in worker_counts:
+            if backend == 'local':
+                latencies = self.run_local(options)
+            else:
+                latencies = self.run_remote(backend, workers, options)
+            ms = [l * 1000 for l in latencies]
+            mean = sum(ms) / len(ms) if ms else float('nan')
+            self.stdout.write('%-9s %7d %8d %9.3f %9.3f %9.3f %9.3f' % (
+                backend, workers, len(ms), mean,
+                _percentile(ms, 50), _percentile(ms, 99),
+                max(ms) if ms else float('nan')))
+
+    def publish_all(self, bus, options):
+        for i in xrange(options['messages']):
+            bus.publish('DataPoint', DEVICE_ID, {'sent': time.time()})
+            gevent.sleep(options['interval'])
+
+    def run_local(self, options):
+        latencies = []
+
+        def deliver(topic, device_id, data):
+            latencies.append(time.time() - data['sent'])
+            return True
+
+        bus = create_backend({'BACKEND': 'local'}, deliver)
+        self.publish_all(bus, options)
+        return latencies
+
+    def run_remote(self, backend, workers, options):
+        config = dict(settings.MONITOR_PUBSUB, BACKEND=backend)
+        work_dir = tempfile.mkdtemp()
+        if backend == 'unix':
+            # Keep the benchmark away from any running application workers
+            config['SOCKET_DIR'] = os.path.join(work_dir, 'sockets')
+
+        ready_r, ready_w = os.pipe()
+        children = []
+        for n in range(workers):
+            result_path = os.path.join(work_dir, '%d.json' % n)
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    gevent.reinit()
+                    _run_subscriber(config, options['messages'], ready_w,
+                                    result_path, options['timeout'])
+                finally:
+                    os._exit(0)
+            children.append((pid, result_path))
+
+        # Wait for every subscriber to be listening
+        for n in range(workers):
+            os.read(ready_r, 1)
+
+        def ignore(topic, device_id, data):
+            return False
+        bus = create_backend(config, ignore)
+        bus.start()
+        self.publish_all(bus, options)
+
+        latencies = []
+        for pid, result_path in children:
+            os.waitpid(pid, 0)
+            try:
+                with open(result_path) as f:
+                    latencies.extend(json.load(f))
+            except (IOError, ValueError):
+                self.stderr.write('No results from worker %d' % pid)
+
+        os.close(ready_r)
+        os.close(ready_w)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return latencies
@@ -0,0 +1,111 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Measure monitor push body parsing
+
+Parses a push of recorded DataPoint messages with DRF's JSONParser (what
+monitor_receiver used before) and with the streaming MonitorPushParser, and
+reports for each the time until the first message is available, the time to
+handle every message, and the growth in peak memory. Each run happens in a
+forked child so peak memory (max RSS) of one doesn't hide the other's.
+
+Example:
+    python manage.py benchmark_push_parser --messages=1000 --runs=20
+'''
+import json
+import os
+import resource
+import time
+from optparse import make_option
+from StringIO import StringIO
+
+from django.core.management.base import BaseCommand
+from rest_framework.parsers import JSONParser
+
+from xbeewifiapp.apps.dashboard.parsers import MonitorPushParser
+from xbeewifiapp.apps.dashboard.management.commands.benchmark_topic_router \
+    import make_messages
+
+
+def parse_full(body):
+    data = JSONParser().parse(StringIO(body))
+    messages = data['Document']['Msg']
+    if type(messages) is not list:
+        messages = [messages]
+    return iter(messages)
+
+
+def parse_streaming(body):
+    return MonitorPushParser().parse(StringIO(body))
+
+
+def measure(parse, body, runs):
+    """
+    Return (seconds to first message, seconds to last message) averaged
+    over runs, and the peak memory growth in KB
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        first = total = 0
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for n in range(runs):
+            start = time.time()
+            messages = parse(body)
+            next(messages)
+            first += time.time() - start
+            for msg in messages:
+                pass
+            total += time.time() - start
+            del messages, msg
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+        os.write(write_fd, json.dumps([first / runs, total / runs, peak]))
+        os._exit(0)
+
+    os.close(write_fd)
+    result = ''
+    while True:
+        data = os.read(read_fd, 4096)
+        if not data:
+            break
+        result += data
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return json.loads(result)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark monitor push body parsing'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--messages', type='int', default=1000,
+                    help='Messages per push'),
+        make_option('--devices', type='int', default=50,
+                    help='Number of devices the messages are spread over'),
+        make_option('--runs', type='int', default=20,
+                    help='Pushes to parse per method'),
+    )
+
+    def handle(self, *args, **options):
+        messages = make_messages(options['devices'], options['messages'])
+        body = json.dumps({'Document': {'Msg': messages}})
+
+        # Both must agree before timing means anything
+        assert list(parse_full(body)) == list(parse_streaming(body))
+
+        self.stdout.write('%d messages, %d byte body' % (
+            len(messages), len(body)))
+        self.stdout.write('%-10s %12s %12s %12s' % (
+            'method', 'first (ms)', 'total (ms)', 'peak (KB)'))
+        for name, parse in (('full', parse_full),
+                            ('streaming', parse_streaming)):
+            first, total, peak = measure(parse, body, options['runs'])
+            self.stdout.write('%-10s %12.2f %12.2f %12d' % (
+                name, first * 1000, total * 1000, peak))
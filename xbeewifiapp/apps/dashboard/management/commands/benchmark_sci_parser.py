@@ -0,0 +1,112 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Measure SCI response parsing
+
+Parses an XBee Wi-Fi style query_setting reply, repeated for a number of
+devices as in a batched request, the way _parse_response used to (decode
+to unicode, then xmltodict), with the bytes-based xmlparse module, and with
+xmlparse keeping only the settings groups the Kit configuration uses.
+
+Example:
+    python manage.py benchmark_sci_parser --devices=1 --runs=500
+'''
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+import xmltodict
+
+from xbeewifiapp.libs.digi import xmlparse
+from xbeewifiapp.apps.dashboard.xbee import XBEE_KIT_CONFIG
+
+# query_setting reply shaped like an XBee Wi-Fi module's, covering the
+# settings groups it reports
+QUERY_SETTING_REPLY = '''<rci_reply version="1.1">
+<query_setting>
+<Network><IP>1</IP><MA>0</MA><TM>0x3E8</TM><TS>0x12C</TS><DO>0x15</DO>
+<DE>0x2616</DE><C0>0x2616</C0><DL>192.168.1.100</DL><MY>192.168.1.42</MY>
+<MK>255.255.255.0</MK><GW>192.168.1.1</GW><NS>8.8.8.8</NS><NI>Kit</NI>
+<EQ>my.devicecloud.com</EQ></Network>
+<WiFi><ID>network</ID><EE>2</EE><IP>1</IP><BR>0</BR><PL>4</PL><PK></PK>
+<CH>11</CH><LD>0</LD><AH>2</AH><SS>0</SS></WiFi>
+<Serial><BD>3</BD><NB>0</NB><SB>0</SB><RO>3</RO><FT>0x7BE</FT><AP>0</AP>
+<AO>0</AO></Serial>
+<InputOutput><D0>Input</D0><D1>ADC</D1><D2>ADC</D2><D3>ADC</D3>
+<D4>Input</D4><D5>Associated</D5><D6>high</D6><D7>high</D7><D8>Input</D8>
+<D9>low</D9><P0>PWM0</P0><P1>PWM1</P1><P2>Disabled</P2><P3>DOUT</P3>
+<P4>DIN</P4><PD>0x7FFF</PD><PR>0x7FFF</PR><M0>0x0</M0><M1>0x0</M1>
+<LT>0</LT><RP>0x28</RP><IR>5000</IR><IC>0x3D0</IC><IF>0x1</IF><T0>0</T0>
+<T1>0</T1><T2>0</T2><T3>0</T3><T4>0</T4><T5>0</T5><T6>200</T6><T7>200</T7>
+<T8>0</T8><T9>0</T9><Q0>0</Q0><Q1>0</Q1><Q2>0</Q2><Q3>0</Q3><Q4>0</Q4>
+<Q5>0</Q5><Q6>0</Q6><Q7>0</Q7><Q8>0</Q8><Q9>0</Q9></InputOutput>
+<Sleep><SM>0</SM><SO>0x40</SO><SP>0xC8</SP><ST>0x1388</ST><WH>0</WH>
+</Sleep>
+<Command><CC>0x2B</CC><CT>0x64</CT><GT>0x3E8</GT></Command>
+<Diagnostics><AI>0x0</AI><VR>0x202D</VR><HV>0x1F42</HV><HS>0x0</HS>
+<CK>0x0</CK><AS>0</AS><TP>0x1C</TP><PM>0</PM></Diagnostics>
+</query_setting>
+</rci_reply>'''
+
+
+def make_reply(devices):
+    return ('<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+            '<sci_reply version="1.0"><send_message>' +
+            ''.join('<device id="00000000-00000000-00000000-%08X">%s</device>'
+                    % (n + 1, QUERY_SETTING_REPLY) for n in range(devices)) +
+            '</send_message></sci_reply>')
+
+
+def parse_xmltodict(content):
+    # requests' Response.text, then xmltodict
+    return xmltodict.parse(content.decode('ISO-8859-1'))
+
+
+def parse_fast(content):
+    return xmlparse.parse(content)
+
+
+KEEP = {'query_setting': set(XBEE_KIT_CONFIG)}
+
+
+def parse_selective(content):
+    return xmlparse.parse(content, KEEP)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark SCI XML response parsing'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--devices', type='int', default=1,
+                    help='Devices replying in the SCI response'),
+        make_option('--runs', type='int', default=500,
+                    help='Responses to parse per method'),
+    )
+
+    def handle(self, *args, **options):
+        content = make_reply(options['devices'])
+
+        # Must agree before timing means anything
+        assert parse_fast(content) == parse_xmltodict(content)
+
+        self.stdout.write('%d devices, %d byte response, %s' % (
+            options['devices'], len(content), xmlparse.etree.__name__))
+        self.stdout.write('%-10s %12s %12s' % ('method', 'ms/response',
+                                               'speedup'))
+        baseline = None
+        for name, parse in (('xmltodict', parse_xmltodict),
+                            ('fast', parse_fast),
+                            ('selective', parse_selective)):
+            start = time.time()
+            for n in xrange(options['runs']):
+                parse(content)
+            elapsed = (time.time() - start) / options['runs']
+            baseline = baseline or elapsed
+            self.stdout.write('%-10s %12.3f %11.1fx' % (
+                name, elapsed * 1000, baseline / elapsed))
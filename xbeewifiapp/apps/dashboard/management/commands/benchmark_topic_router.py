@@ -0,0 +1,138 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Measure monitor push routing throughput
+
+Routes recorded DataPoint and DeviceCore push messages, spread over a number
+of devices and streams, through the topic router and through the original
+per-message parsing it replaced, and reports messages per second for each.
+
+Example:
+    python manage.py benchmark_topic_router --devices=50 --messages=100000
+'''
+import copy
+import json
+import re
+import time
+from optparse import make_option
+from urllib import unquote
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from xbeewifiapp.apps.dashboard.routing import TopicRouter, \
+    datapoint_device_id, devicecore_device_id
+
+# Recorded Device Cloud pushes, device id and stream filled in per message
+DATAPOINT_PUSH = json.loads('''{
+    "group": "*",
+    "topic": "1/DataPoint/dia/channel/00000000-00000000-00000000-00000001/DIO/0",
+    "timestamp": "2013-08-27T16:17:07.360Z",
+    "operation": "INSERTION",
+    "DataPoint": {
+        "data": 0,
+        "timestamp": 1377620227161,
+        "description": "",
+        "serverTimestamp": 1377620227253,
+        "quality": 0,
+        "id": "1",
+        "cstId": 1,
+        "streamId": "dia/channel/00000000-00000000-00000000-00000001/DIO/0"
+    }
+}''')
+
+DEVICECORE_PUSH = json.loads('''{
+    "group": "*",
+    "topic": "1/DeviceCore/1234/0",
+    "timestamp": "2013-08-27T16:17:07.360Z",
+    "operation": "UPDATE",
+    "DeviceCore": {
+        "id": {"devId": 1234, "devVersion": 0},
+        "devConnectwareId": "00000000-00000000-00000000-00000001",
+        "dpConnectionStatus": 1
+    }
+}''')
+
+STREAMS = ['DIO/0', 'DIO/1', 'DIO/2', 'DIO/3', 'AD/0', 'AD/1', 'serial/0']
+
+
+def _legacy_route(msg):
+    """
+    Per-message parsing used by monitor_receiver before the topic router
+    """
+    topic_full = msg['topic']
+    (topic, subtopic) = topic_full.split('/', 2)[1:]
+    subtopic = unquote(subtopic)
+    device_id = None
+    if topic == 'DataPoint':
+        reg_pattern = "\S*(?P<dev_id>((-?([0-9A-F]{8})){4}))"
+        match = re.match(reg_pattern, subtopic)
+        if match:
+            device_id = match.groupdict()['dev_id']
+    elif topic == 'DeviceCore':
+        try:
+            device_id = msg['DeviceCore']['devConnectwareId']
+        except KeyError:
+            pass
+    return topic, device_id
+
+
+def make_messages(devices, count):
+    """
+    Build count push messages, cycling over devices and their streams
+    """
+    templates = []
+    for n in range(devices):
+        device_id = '00000000-00000000-00000000-%08X' % (n + 1)
+        for stream in STREAMS:
+            msg = copy.deepcopy(DATAPOINT_PUSH)
+            stream_id = 'dia/channel/%s/%s' % (device_id, stream)
+            msg['topic'] = '1/DataPoint/' + stream_id
+            msg['DataPoint']['streamId'] = stream_id
+            templates.append(msg)
+        msg = copy.deepcopy(DEVICECORE_PUSH)
+        msg['topic'] = '1/DeviceCore/%d/0' % (n + 1)
+        msg['DeviceCore']['devConnectwareId'] = device_id
+        templates.append(msg)
+    return [templates[i % len(templates)] for i in xrange(count)]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark monitor push topic routing'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--devices', type='int', default=50,
+                    help='Number of devices the pushes are spread over'),
+        make_option('--messages', type='int', default=100000,
+                    help='Messages to route per run'),
+        make_option('--cache-size', type='int',
+                    default=settings.MONITOR_TOPIC_CACHE_SIZE,
+                    help='Topic router cache size'),
+    )
+
+    def handle(self, *args, **options):
+        messages = make_messages(options['devices'], options['messages'])
+
+        router = TopicRouter(cache_size=options['cache_size'])
+        router.register_subtopic('DataPoint', datapoint_device_id)
+        router.register_message('DeviceCore', devicecore_device_id)
+
+        # Both must agree before timing means anything
+        for msg in messages[:len(STREAMS) * options['devices'] * 2]:
+            assert router.route(msg) == _legacy_route(msg)
+
+        self.stdout.write('%-8s %10s %12s' % ('method', 'seconds', 'msgs/sec'))
+        for name, route in (('legacy', _legacy_route),
+                            ('router', router.route)):
+            start = time.time()
+            for msg in messages:
+                route(msg)
+            elapsed = time.time() - start
+            self.stdout.write('%-8s %10.3f %12.0f' % (
+                name, elapsed, len(messages) / elapsed))
@@ -0,0 +1,38 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Remove DataPoints older than the retention period from the local store
+
+Meant to be run periodically, e.g. daily from cron or the Heroku scheduler.
+
+Example:
+    python manage.py prune_datapoint_store --days=7
+'''
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from xbeewifiapp.apps.dashboard.store import datapoint_store
+
+
+class Command(BaseCommand):
+    help = 'Remove old DataPoints from the local DataPoint store'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int',
+                    default=settings.DATAPOINT_STORE.get('RETENTION_DAYS', 7),
+                    help='Days of DataPoints to keep'),
+    )
+
+    def handle(self, *args, **options):
+        before = int((time.time() - options['days'] * 86400) * 1000)
+        count = datapoint_store.prune(before)
+        self.stdout.write('Removed %d chunks' % count)
@@ -19,3 +19,31 @@ class Dashboard(models.Model):
     """
     owner = models.ForeignKey(get_user_model(), related_name='dashboards')
     widgets = JSONField(blank=True)
+
+
+class DataPointChunk(models.Model):
+    """
+    DataPoints of one stream received in one monitor push, stored a column
+    per field. Chunks are only ever added, or pruned once old.
+    """
+    stream_id = models.CharField(max_length=255)
+    device_id = models.CharField(max_length=64, db_index=True)
+    # Oldest and newest DataPoint timestamps in the chunk, millis
+    first = models.BigIntegerField()
+    last = models.BigIntegerField()
+    count = models.IntegerField()
+    # Field name ('id', 'timestamp', ...) to the list of its values
+    columns = JSONField()
+
+    class Meta:
+        index_together = [['stream_id', 'last']]
+
+
+class StreamCoverage(models.Model):
+    """
+    Marks a stream's DataPoints from since (millis) onwards as all stored,
+    as pushes for it have been received without a gap
+    """
+    stream_id = models.CharField(max_length=255, unique=True)
+    device_id = models.CharField(max_length=64, db_index=True)
+    since = models.BigIntegerField()
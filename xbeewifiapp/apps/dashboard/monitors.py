@@ -0,0 +1,326 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Cache of Device Cloud monitor state
+
+Setting up a monitor costs a Monitor query plus a create or kick request.
+Once a monitor has been set up (or pushes from it are arriving), further
+setups within a short interval can reuse the result instead.
+'''
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _key_topic(key):
+    # Monitor topics are e.g. 'DataPoint' or 'DataPoint/<device id>'
+    return key[2].split('/', 1)[0]
+
+
+def summarize_push(messages):
+    """
+    Reduce the messages of a push to per device counts, small enough to
+    share with the other workers over the monitor bus
+
+    Args:
+        messages (list): (topic, device_id, latency) for each message in
+                         the push. latency is the seconds since Device Cloud
+                         received the data, or None if unknown.
+    Returns:
+        list of [topic, device_id, messages, latency total, latency count,
+        latency max]
+    """
+    summary = {}
+    for topic, device_id, latency in messages:
+        counts = summary.get((topic, device_id))
+        if counts is None:
+            counts = summary[(topic, device_id)] = [topic, device_id, 0, 0.0,
+                                                    0, 0.0]
+        counts[2] += 1
+        if latency is not None:
+            counts[3] += latency
+            counts[4] += 1
+            counts[5] = max(counts[5], latency)
+    return summary.values()
+
+
+class MonitorStateCache(object):
+    """
+    Bounded cache of monitor setup results keyed by (username, cloud_fqdn,
+    topic, endpoint url). The least recently set up monitors are forgotten
+    first.
+    """
+
+    def __init__(self, min_kick_interval=60, push_timeout=300, max_size=1000):
+        """
+        Kwargs:
+            min_kick_interval (int): Seconds after a setup during which the
+                            monitor is assumed to still be active
+            push_timeout (int): Seconds a monitor whose pushes are arriving
+                            is assumed to stay active without a kick
+            max_size (int): Maximum number of monitors to remember
+        """
+        self.min_kick_interval = min_kick_interval
+        self.push_timeout = push_timeout
+        self.max_size = max_size
+        # key -> state dict
+        self._states = OrderedDict()
+        # device id -> set of keys of monitors covering that device
+        self._devices = {}
+        # (username, cloud_fqdn) -> set of the account's device ids, least
+        # recently added to first
+        self._accounts = OrderedDict()
+        # device id -> (username, cloud_fqdn)
+        self._device_accounts = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, key):
+        """
+        Return the cached state for a monitor if it doesn't need setting up
+        again, otherwise None
+        """
+        now = time.time()
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                fresh = now - state['last_kick'] < self.min_kick_interval
+                pushing = (state['last_push'] is not None and
+                           now - state['last_push'] < self.push_timeout)
+                if fresh or pushing:
+                    self.hits += 1
+                    return state
+            self.misses += 1
+            return None
+
+    def record(self, key, info, monitor_id=None, device_ids=(),
+               batch_size=None, batch_duration=None):
+        """
+        Remember a monitor which was just created or kicked. This worker
+        owns its batching until another worker sets it up.
+
+        Args:
+            key (tuple): (username, cloud_fqdn, topic, endpoint url)
+            info (dict): Monitor information to return to callers
+        Kwargs:
+            monitor_id (str): Device Cloud monId, if known
+            device_ids (list): Devices whose pushes come from this monitor
+            batch_size (int): Monitor's current monBatchSize
+            batch_duration (int): Monitor's current monBatchDuration
+        """
+        now = time.time()
+        with self._lock:
+            self._remove(key)
+            self._states[key] = {
+                'monitor_id': monitor_id,
+                'info': info,
+                'device_ids': set(device_ids),
+                'owned': True,
+                'batch_size': batch_size,
+                'batch_duration': batch_duration,
+                'last_kick': now,
+                'last_push': None,
+                # Push statistics since the last call to take_stats
+                'window_start': now,
+                'pushes': 0,
+                'messages': 0,
+                'latency_total': 0.0,
+                'latency_count': 0,
+                'latency_max': 0.0,
+            }
+            for device_id in device_ids:
+                self._devices.setdefault(device_id, set()).add(key)
+            self._add_account_devices(key[:2], device_ids)
+
+            while len(self._states) > self.max_size:
+                self._remove(next(iter(self._states)))
+
+    def add_device(self, key, device_id):
+        """
+        Note that pushes for another device come from a cached monitor
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None and device_id not in state['device_ids']:
+                state['device_ids'].add(device_id)
+                self._devices.setdefault(device_id, set()).add(key)
+            self._add_account_devices(key[:2], [device_id])
+
+    def add_account_devices(self, account, device_ids):
+        """
+        Note which account devices belong to, as learned by this or any
+        other worker
+
+        Args:
+            account (tuple): (username, cloud_fqdn)
+            device_ids (list): The account's devices
+        """
+        with self._lock:
+            self._add_account_devices(tuple(account), device_ids)
+
+    def account_devices(self, device_ids):
+        """
+        Return every device known to be in the same account as any of the
+        given devices, or None if none of their accounts are known
+        """
+        with self._lock:
+            accounts = set(self._device_accounts.get(device_id)
+                           for device_id in device_ids)
+            accounts.discard(None)
+            if not accounts:
+                return None
+            devices = set(device_ids)
+            for account in accounts:
+                devices.update(self._accounts[account])
+            return devices
+
+    def note_push(self, summary):
+        """
+        Record the arrival of a push with subscribers, accepted by this or
+        any other worker
+
+        Args:
+            summary (list): The push's counts, from summarize_push
+        """
+        now = time.time()
+        with self._lock:
+            pushed = set()
+            for (topic, device_id, messages, latency_total, latency_count,
+                    latency_max) in summary:
+                for key in self._devices.get(device_id, ()):
+                    # Only the device's monitor for this topic is shown to
+                    # be alive, e.g. not its DataPoint monitor by DeviceCore
+                    if _key_topic(key) != topic:
+                        continue
+                    state = self._states[key]
+                    state['last_push'] = now
+                    state['messages'] += messages
+                    pushed.add(key)
+                    if latency_count:
+                        state['latency_total'] += latency_total
+                        state['latency_count'] += latency_count
+                        state['latency_max'] = max(state['latency_max'],
+                                                   latency_max)
+            for key in pushed:
+                self._states[key]['pushes'] += 1
+
+    def take_stats(self):
+        """
+        Return push statistics for each monitor since the last call, and
+        start a new measurement window
+        """
+        now = time.time()
+        results = []
+        with self._lock:
+            for key, state in self._states.items():
+                elapsed = max(float(now - state['window_start']), 1e-6)
+                results.append((key, {
+                    'monitor_id': state['monitor_id'],
+                    'owned': state['owned'],
+                    'batch_size': state['batch_size'],
+                    'batch_duration': state['batch_duration'],
+                    'elapsed': elapsed,
+                    'push_rate': state['pushes'] / elapsed,
+                    'message_rate': state['messages'] / elapsed,
+                    'latency_mean': (
+                        state['latency_total'] / state['latency_count']
+                        if state['latency_count'] else None),
+                    'latency_max': (
+                        state['latency_max']
+                        if state['latency_count'] else None),
+                }))
+                state.update(window_start=now, pushes=0, messages=0,
+                             latency_total=0.0, latency_count=0,
+                             latency_max=0.0)
+        return results
+
+    def set_batching(self, key, batch_size, batch_duration):
+        """
+        Note a change to a monitor's monBatchSize and monBatchDuration
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                state['batch_size'] = batch_size
+                state['batch_duration'] = batch_duration
+
+    def disown(self, key):
+        """
+        Note that another worker has set up a monitor, and now owns its
+        batching
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                state['owned'] = False
+
+    def invalidate_device(self, device_id):
+        """
+        Forget monitors covering a device, e.g. because we refused a push and
+        Device Cloud will back off or deactivate them
+        """
+        with self._lock:
+            for key in list(self._devices.get(device_id, ())):
+                logger.debug('Invalidating cached monitor %s' % (key,))
+                self._remove(key)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self._devices.clear()
+            self._accounts.clear()
+            self._device_accounts.clear()
+
+    def _add_account_devices(self, account, device_ids):
+        devices = self._accounts.pop(account, None)
+        if devices is None:
+            devices = set()
+        self._accounts[account] = devices
+        for device_id in device_ids:
+            previous = self._device_accounts.get(device_id)
+            if previous is not None and previous != account:
+                # Moved to another account
+                self._accounts[previous].discard(device_id)
+            devices.add(device_id)
+            self._device_accounts[device_id] = account
+        while len(self._accounts) > self.max_size:
+            _, forgotten = self._accounts.popitem(last=False)
+            for device_id in forgotten:
+                del self._device_accounts[device_id]
+
+    def _remove(self, key):
+        state = self._states.pop(key, None)
+        if state is None:
+            return
+        for device_id in state['device_ids']:
+            keys = self._devices.get(device_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._devices[device_id]
+
+
+_monitor_settings = settings.MONITOR_STATE_CACHE
+
+monitor_states = MonitorStateCache(
+    min_kick_interval=_monitor_settings.get('MIN_KICK_INTERVAL', 60),
+    push_timeout=_monitor_settings.get('PUSH_TIMEOUT', 300),
+    max_size=_monitor_settings.get('SIZE', 1000))
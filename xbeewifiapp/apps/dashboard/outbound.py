@@ -0,0 +1,139 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Outbound buffering for socket.io connections
+
+Devices sampling quickly, or reporting changes on several pins, produce a
+burst of small monitor events. Rather than emitting a frame for each, events
+are collected for a short window and emitted together as a single list.
+'''
+import logging
+import time
+from collections import OrderedDict
+import gevent
+
+logger = logging.getLogger(__name__)
+
+# What to do with buffered events when a client falls behind
+MERGE = 'merge'
+DROP = 'drop'
+
+
+def datapoint_stream_id(data):
+    """
+    Key DataPoint push messages by stream, so only the latest value of each
+    stream is kept when merging
+    """
+    try:
+        return data['DataPoint']['streamId']
+    except (KeyError, TypeError):
+        return None
+
+
+class CoalescingEmitter(object):
+    """
+    Collects events and emits them as one batch, at most once per window and
+    no more than max_rate batches per second
+    """
+
+    def __init__(self, emit, event, window=0.05, max_rate=20,
+                 max_pending=1000, overflow=MERGE, key=datapoint_stream_id,
+                 backlog=None):
+        """
+        Args:
+            emit (callable): Called with (event, list of data) to send a batch
+            event (str): Name of the batch event
+        Kwargs:
+            window (float): Seconds to collect events before emitting
+            max_rate (float): Maximum batches emitted per second
+            max_pending (int): Events held before the overflow policy applies
+            overflow (str): merge - keep only the latest event for each key,
+                            then drop the oldest if still over max_pending
+                            drop - drop the oldest events
+            key (callable): Returns the merge key of an event's data. Events
+                            with no key are never merged.
+            backlog (callable): Returns the number of frames not yet sent to
+                            the client. Batches are held back while the
+                            client is behind.
+        """
+        self.emit = emit
+        self.event = event
+        self.window = window
+        self.min_interval = 1.0 / max_rate if max_rate else 0
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.key = key
+        self.backlog = backlog
+        self._pending = []
+        self._last_flush = 0
+        self._flusher = None
+        self.emitted = 0
+        self.dropped = 0
+        self.merged = 0
+
+    def add(self, data):
+        """
+        Buffer an event, scheduling the next batch if needed
+        """
+        self._pending.append(data)
+        if len(self._pending) > self.max_pending:
+            self._overflow()
+
+        if self._flusher is None:
+            delay = max(self.window,
+                        self._last_flush + self.min_interval - time.time())
+            self._flusher = gevent.spawn_later(delay, self.flush)
+
+    def flush(self):
+        """
+        Emit everything buffered now, unless the client is still busy with
+        earlier frames
+        """
+        self._flusher = None
+        if not self._pending:
+            return
+        if self.backlog is not None and self.backlog() > 0:
+            # Keep collecting (and merging) until the client catches up
+            self._flusher = gevent.spawn_later(
+                max(self.window, self.min_interval), self.flush)
+            return
+        batch, self._pending = self._pending, []
+        self._last_flush = time.time()
+        self.emitted += len(batch)
+        self.emit(self.event, batch)
+
+    def close(self):
+        """
+        Cancel any scheduled batch and discard buffered events
+        """
+        if self._flusher is not None:
+            self._flusher.kill(block=False)
+            self._flusher = None
+        self._pending = []
+
+    def _overflow(self):
+        pending = self._pending
+        if self.overflow == MERGE:
+            # Keep the latest event for each key, in order of arrival
+            latest = OrderedDict()
+            for n, data in enumerate(pending):
+                key = self.key(data)
+                if key is None:
+                    key = ('unkeyed', n)
+                latest.pop(key, None)
+                latest[key] = data
+            self.merged += len(pending) - len(latest)
+            pending = latest.values()
+
+        excess = len(pending) - self.max_pending
+        if excess > 0:
+            logger.debug('Socket falling behind, dropped %d events' % excess)
+            self.dropped += excess
+            pending = pending[excess:]
+        self._pending = pending
@@ -0,0 +1,167 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Incremental parsing of Device Cloud monitor push bodies
+
+A push can batch up to 1000 messages as {"Document": {"Msg": [...]}}.
+Rather than loading the whole body and building every message before any
+can be handled, the body is read in chunks and each message is decoded and
+handed out as soon as it is complete. Only the message being decoded and
+the unread part of the current chunk are held in memory.
+'''
+import json
+from django.conf import settings
+from rest_framework.parsers import BaseParser
+from rest_framework.exceptions import ParseError
+
+WHITESPACE = ' \t\n\r'
+
+
+class PushMessageStream(object):
+    """
+    Iterator over the messages in a monitor push body. A Msg holding a single
+    object rather than a list yields that one message.
+
+    Raises ParseError while iterating if the body is malformed or has no
+    Document.Msg.
+    """
+
+    def __init__(self, stream, chunk_size=8192, encoding='utf-8'):
+        """
+        Args:
+            stream (file): Body to read from
+        Kwargs:
+            chunk_size (int): Bytes to read at a time
+            encoding (str): Character encoding of the body
+        """
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self._decoder = json.JSONDecoder(encoding=encoding)
+        self._buffer = ''
+        self._pos = 0
+        self._eof = stream is None
+        self._messages = self._parse()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._messages)
+
+    def _parse(self):
+        self._expect('{')
+        if not self._find_key('Document'):
+            raise ParseError('No Document in monitor push')
+        self._expect('{')
+        if not self._find_key('Msg'):
+            raise ParseError('No Msg in monitor push')
+
+        if self._peek() != '[':
+            yield self._value()
+            return
+
+        self._pos += 1
+        if self._peek() == ']':
+            return
+        while True:
+            yield self._value()
+            c = self._peek()
+            self._pos += 1
+            if c == ']':
+                return
+            if c != ',':
+                raise ParseError('Expected , or ] in monitor push Msg list')
+
+    def _find_key(self, name):
+        """
+        Skip the members of the current object up to key name, and return
+        True with the value up next. Returns False at the end of the object.
+        """
+        if self._peek() == '}':
+            return False
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == name:
+                return True
+            self._value()
+            c = self._peek()
+            self._pos += 1
+            if c == '}':
+                return False
+            if c != ',':
+                raise ParseError('Expected , or } in monitor push')
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ParseError('Expected %s in monitor push' % char)
+        self._pos += 1
+
+    def _peek(self):
+        """
+        Return the next non-whitespace character, without consuming it
+        """
+        while True:
+            buf = self._buffer
+            pos = self._pos
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if self._eof:
+                raise ParseError('Monitor push ended unexpectedly')
+            self._fill()
+
+    def _value(self):
+        """
+        Decode the next JSON value, reading more of the body until it is
+        complete
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError, e:
+                if self._eof:
+                    raise ParseError('JSON parse error - %s' % e)
+                self._fill()
+                continue
+            if end == len(self._buffer) and not self._eof:
+                # A number may continue in the next chunk
+                self._fill()
+                continue
+            self._pos = end
+            return value
+
+    def _fill(self):
+        # Drop what has been consumed; read at least as much again as is
+        # held, so a value spanning many chunks isn't rescanned too often
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        chunk = self.stream.read(max(self.chunk_size, len(self._buffer)))
+        if chunk:
+            self._buffer += chunk
+        else:
+            self._eof = True
+
+
+class MonitorPushParser(BaseParser):
+    """
+    Parses a JSON monitor push into a PushMessageStream
+    """
+
+    media_type = 'application/json'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        return PushMessageStream(
+            stream, encoding=encoding,
+            chunk_size=settings.MONITOR_PUSH_STREAMING.get('CHUNK_SIZE', 8192))
@@ -0,0 +1,573 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Pub/sub backbone for Device Cloud monitor events
+
+A push from Device Cloud lands on whichever worker process accepted the
+request, but the sockets interested in it may be held by any worker. Events
+are published to the monitor bus, which delivers them to this process's
+signal receivers and, depending on the configured backend, forwards them to
+the other workers:
+
+    local - this process only
+    unix - every worker on this host, via datagram sockets in a shared
+           directory
+    postgres - every worker sharing the default database, via LISTEN/NOTIFY
+'''
+import abc
+import errno
+import json
+import logging
+import os
+import time
+import uuid
+import gevent
+from gevent import socket
+from django.conf import settings
+from xbeewifiapp.libs.digi.connections import response_cache
+from signals import MONITOR_TOPIC_SIGNAL_MAP
+from latest import latest_values
+from recent import recent_datapoints
+from monitors import monitor_states
+
+logger = logging.getLogger(__name__)
+
+# Published when a device's DataPoint pushes were refused, so every worker
+# knows its recent DataPoints have a gap
+DATAPOINTS_MISSED = 'DataPointsMissed'
+# Published with the counts of each accepted push, so every worker measures
+# the monitors' full message rates
+MONITOR_PUSHED = 'MonitorPushed'
+# Published with the cache key of a monitor a worker has just set up, which
+# takes over tuning its batching
+MONITOR_SET_UP = 'MonitorSetUp'
+# Published when a DeviceCore push shows a device changed, so every worker
+# stops serving cached listings of it
+DEVICE_CHANGED = 'DeviceChanged'
+# Published with [username, cloud_fqdn, device ids] as a worker learns which
+# account devices are in, so any worker can tell whether an account-wide push
+# has subscribers
+ACCOUNT_DEVICES = 'AccountDevices'
+# Most device ids published in one ACCOUNT_DEVICES event
+ACCOUNT_DEVICES_BATCH = 100
+
+
+def keeps_recent_datapoints():
+    """
+    Return True if this worker's recent DataPoints can be trusted to hold
+    every point pushed: only when the bus brings it the pushes accepted by
+    every other worker too
+    """
+    return recent_datapoints.enabled and monitor_bus.cluster_wide
+
+
+def publish_datapoints_missed(device_ids):
+    """
+    Tell every worker that DataPoints pushed for these devices were lost, so
+    their recent DataPoints have a gap
+    """
+    if keeps_recent_datapoints():
+        for device_id in device_ids:
+            monitor_bus.publish(DATAPOINTS_MISSED, device_id, None)
+
+
+def publish_account_devices(username, cloud_fqdn, device_ids):
+    """
+    Tell every worker which account devices are in
+    """
+    for n in xrange(0, len(device_ids), ACCOUNT_DEVICES_BATCH):
+        monitor_bus.publish(ACCOUNT_DEVICES, None, [
+            username, cloud_fqdn, device_ids[n:n + ACCOUNT_DEVICES_BATCH]])
+
+
+class EventLost(Exception):
+    """
+    Raised by a backend's _forward when an event didn't reach every other
+    worker
+    """
+
+    def __init__(self, message, forwarded=False):
+        """
+        Kwargs:
+            forwarded (bool): Whether any other worker got the event
+        """
+        super(EventLost, self).__init__(message)
+        self.forwarded = forwarded
+
+
+def deliver_locally(topic, device_id, data):
+    """
+    Send a monitor event to the signal receivers in this process
+
+    Returns True if there were any receivers for the event
+    """
+    if topic == DATAPOINTS_MISSED:
+        recent_datapoints.discard(device_id)
+        return False
+    if topic == MONITOR_PUSHED:
+        monitor_states.note_push(data)
+        return False
+    if topic == MONITOR_SET_UP:
+        monitor_states.disown(tuple(data))
+        return False
+    if topic == DEVICE_CHANGED:
+        response_cache.invalidate_device(device_id)
+        return False
+    if topic == ACCOUNT_DEVICES:
+        username, cloud_fqdn, device_ids = data
+        monitor_states.add_account_devices((username, cloud_fqdn), device_ids)
+        return False
+    if topic == 'DataPoint':
+        latest_values.update(device_id, data)
+        if keeps_recent_datapoints():
+            recent_datapoints.update(device_id, data)
+
+    try:
+        signal_map = MONITOR_TOPIC_SIGNAL_MAP[topic]
+    except KeyError:
+        logger.warning('No signal map exists for monitor topic %s!' % topic)
+        return False
+
+    signal = signal_map.get(device_id)
+    if signal is None:
+        return False
+
+    logger.debug("%d registered receivers found for this push, sending signal"
+                 % len(signal.receivers))
+    signal.send_robust(sender=None, device_id=device_id, data=data)
+    return True
+
+
+def has_local_receivers(topic, device_id):
+    """
+    Return True if this process has signal receivers for a monitor event, or
+    for any device if device_id is None
+    """
+    try:
+        signal_map = MONITOR_TOPIC_SIGNAL_MAP[topic]
+    except KeyError:
+        return False
+    if device_id is None:
+        return len(signal_map) > 0
+    return device_id in signal_map
+
+
+def local_receivers():
+    """
+    Return the (topic, device_id) pairs this process has signal receivers
+    for
+    """
+    return [(topic, device_id)
+            for topic, signal_map in MONITOR_TOPIC_SIGNAL_MAP.items()
+            for device_id in signal_map.keys()]
+
+
+class LocalBackend(object):
+    """
+    Deliver monitor events to receivers in this process only
+    """
+    # Whether events reach every worker
+    cluster_wide = False
+
+    def __init__(self, deliver=deliver_locally, has_receivers=None):
+        self.deliver = deliver
+        # Without a way to check for receivers, assume there are some
+        if has_receivers is None:
+            if deliver is deliver_locally:
+                has_receivers = has_local_receivers
+            else:
+                has_receivers = lambda topic, device_id: True
+        self.has_receivers = has_receivers
+
+    def start(self):
+        pass
+
+    def has_subscribers(self, topic, device_id):
+        """
+        Return True if a monitor event published now may reach any receivers.
+        A device_id of None asks about receivers for any device.
+        """
+        return self.has_receivers(topic, device_id)
+
+    def publish(self, topic, device_id, data):
+        """
+        Publish a monitor event. Returns True if the event may have reached
+        any receivers.
+        """
+        return self.deliver(topic, device_id, data)
+
+    def advertise(self, receivers=None):
+        """
+        Tell other workers about receivers in this process, when there are
+        any others
+        """
+        pass
+
+
+class RemoteBackend(LocalBackend):
+    """
+    Base class for backends which also forward events to other workers.
+
+    Subclasses implement _setup (open connections), _listen (loop receiving
+    payloads, run in a greenlet) and _forward (send a payload to the other
+    workers, returning True if there were any, or raising EventLost if some
+    didn't get it).
+
+    When a DataPoint event can't be forwarded, the other workers are told
+    its DataPoints were missed.
+
+    Each worker advertises the devices it has receivers for every
+    advertise_interval seconds, and as soon as a socket starts monitoring
+    one, so the others can tell whether a push has subscribers anywhere.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    cluster_wide = True
+    # Most (topic, device_id) pairs sent in one advertisement
+    ADVERTISE_BATCH = 100
+
+    def __init__(self, deliver=deliver_locally, has_receivers=None,
+                 list_receivers=None, advertise_interval=5):
+        """
+        Kwargs:
+            list_receivers (callable): Returns the (topic, device_id) pairs
+                            this process has receivers for
+            advertise_interval (float): Seconds between advertisements of
+                            this worker's receivers
+        """
+        super(RemoteBackend, self).__init__(deliver, has_receivers)
+        if list_receivers is None:
+            if deliver is deliver_locally:
+                list_receivers = local_receivers
+            else:
+                list_receivers = lambda: []
+        self.list_receivers = list_receivers
+        self.advertise_interval = advertise_interval
+        # Receivers are forgotten once a few advertisements have been missed
+        self.advertise_ttl = advertise_interval * 3
+        self.origin = None
+        self._pid = None
+        self._started = None
+        self._listener = None
+        self._advertiser = None
+        # (topic, device_id) -> when the last peer advertising it expires
+        self._peer_receivers = {}
+
+    def start(self):
+        """
+        Start listening for events from other workers. Safe to call
+        repeatedly; resets itself in forked children.
+        """
+        if self._pid != os.getpid():
+            # Anything inherited from a parent process belongs to the parent
+            self._stop()
+            self._peer_receivers = {}
+            self._pid = os.getpid()
+        if self._listener is None or self._listener.dead:
+            self.origin = '%d-%s' % (self._pid, uuid.uuid4().hex)
+            self._setup()
+            self._started = time.time()
+            self._listener = gevent.spawn(self._listen)
+        if self._advertiser is None or self._advertiser.dead:
+            self._advertiser = gevent.spawn(self._advertise_periodically)
+
+    def publish(self, topic, device_id, data):
+        self.start()
+        delivered = self.deliver(topic, device_id, data)
+
+        payload = json.dumps({
+            'origin': self.origin,
+            'topic': topic,
+            'device_id': device_id,
+            'data': data,
+        })
+        try:
+            forwarded = self._forward(payload)
+        except EventLost, e:
+            logger.warning('Monitor event for %s not forwarded to every '
+                           'worker: %s' % (device_id, e))
+            forwarded = e.forwarded
+            self._forward_missed(topic, device_id)
+        except Exception:
+            logger.exception('Error forwarding monitor event to other workers')
+            forwarded = False
+            self._forward_missed(topic, device_id)
+
+        return delivered or forwarded
+
+    def _forward_missed(self, topic, device_id):
+        # The other workers' recent DataPoints now have a gap
+        if topic != 'DataPoint':
+            return
+        payload = json.dumps({
+            'origin': self.origin,
+            'topic': DATAPOINTS_MISSED,
+            'device_id': device_id,
+            'data': None,
+        })
+        try:
+            self._forward(payload)
+        except Exception:
+            logger.exception('Error telling other workers DataPoints for %s '
+                             'were missed' % device_id)
+
+    def has_subscribers(self, topic, device_id):
+        if self.has_receivers(topic, device_id):
+            return True
+        self.start()
+        now = time.time()
+        if now - self._started < self.advertise_ttl:
+            # Other workers may not have advertised their receivers yet
+            return True
+        if device_id is not None:
+            return self._peer_receivers.get((topic, device_id), 0) > now
+        return any(expires > now for (peer_topic, peer_device), expires
+                   in self._peer_receivers.iteritems() if peer_topic == topic)
+
+    def advertise(self, receivers=None):
+        """
+        Tell the other workers which devices this one has receivers for
+
+        Kwargs:
+            receivers (list): (topic, device_id) pairs, all of them if None
+        """
+        self.start()
+        if receivers is None:
+            receivers = self.list_receivers()
+        receivers = [list(receiver) for receiver in receivers]
+        for n in xrange(0, len(receivers), self.ADVERTISE_BATCH):
+            payload = json.dumps({
+                'origin': self.origin,
+                'receivers': receivers[n:n + self.ADVERTISE_BATCH],
+            })
+            try:
+                self._forward(payload)
+            except Exception:
+                logger.exception('Error advertising monitor receivers')
+                return
+
+    def _advertise_periodically(self):
+        while True:
+            self.advertise()
+            now = time.time()
+            for receiver, expires in self._peer_receivers.items():
+                if expires <= now:
+                    del self._peer_receivers[receiver]
+            gevent.sleep(self.advertise_interval)
+
+    def _stop(self):
+        for greenlet in (self._listener, self._advertiser):
+            if greenlet is not None:
+                greenlet.kill(block=False)
+        self._listener = None
+        self._advertiser = None
+
+    def _receive(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.warning('Received a malformed monitor event payload')
+            return
+        # Events we published were already delivered locally
+        if event.get('origin') == self.origin:
+            return
+        if 'receivers' in event:
+            expires = time.time() + self.advertise_ttl
+            for topic, device_id in event['receivers']:
+                self._peer_receivers[(topic, device_id)] = expires
+            return
+        self.deliver(event['topic'], event['device_id'], event['data'])
+
+    @abc.abstractmethod
+    def _setup(self):
+        pass
+
+    @abc.abstractmethod
+    def _listen(self):
+        pass
+
+    @abc.abstractmethod
+    def _forward(self, payload):
+        pass
+
+
+class UnixSocketBackend(RemoteBackend):
+    """
+    Forward events to every worker on this host. Each worker binds a datagram
+    socket in socket_dir, and events are sent to every socket found there.
+    """
+    # Largest event we expect to receive
+    MAX_DATAGRAM = 65536
+    # How often (seconds) to rescan socket_dir for other workers
+    PEER_REFRESH = 1.0
+
+    def __init__(self, socket_dir, deliver=deliver_locally,
+                 has_receivers=None, list_receivers=None,
+                 advertise_interval=5):
+        super(UnixSocketBackend, self).__init__(
+            deliver, has_receivers, list_receivers, advertise_interval)
+        self.socket_dir = socket_dir
+        self.path = None
+        self._sock = None
+        self._owner_pid = None
+        self._peers = []
+        self._peers_checked = 0
+
+    def _setup(self):
+        try:
+            os.makedirs(self.socket_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        if self._sock is not None:
+            self.close()
+
+        self._owner_pid = os.getpid()
+        self.path = os.path.join(self.socket_dir, self.origin + '.sock')
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._peers_checked = 0
+
+    def close(self):
+        self._stop()
+        self._sock.close()
+        self._sock = None
+        # Leave a socket inherited across a fork for its owner to clean up
+        if self._owner_pid == os.getpid():
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _listen(self):
+        while True:
+            self._receive(self._sock.recv(self.MAX_DATAGRAM))
+
+    def peers(self):
+        """
+        Return the socket paths of the other workers
+        """
+        now = time.time()
+        if now - self._peers_checked > self.PEER_REFRESH:
+            self._peers = [
+                os.path.join(self.socket_dir, name)
+                for name in os.listdir(self.socket_dir)
+                if name.endswith('.sock')
+                and os.path.join(self.socket_dir, name) != self.path]
+            self._peers_checked = now
+        return self._peers
+
+    def _forward(self, payload):
+        forwarded = False
+        failed = 0
+        for path in self.peers():
+            try:
+                self._sock.sendto(payload, path)
+                forwarded = True
+            except socket.error, e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # Worker went away without cleaning up
+                    logger.info('Removing stale monitor socket %s' % path)
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                    self._peers_checked = 0
+                else:
+                    logger.warning('Error sending monitor event to %s: %s'
+                                   % (path, e))
+                    failed += 1
+        if failed:
+            raise EventLost('%d workers unreachable' % failed, forwarded)
+        return forwarded
+
+
+class PostgresBackend(RemoteBackend):
+    """
+    Forward events to every worker using the same database, via PostgreSQL
+    LISTEN/NOTIFY.
+
+    Since there is no way to know whether other workers are listening, any
+    successfully sent event is reported as delivered. Whether a push has
+    subscribers is still known from the workers' advertisements.
+    """
+    # NOTIFY payloads must be shorter than 8000 bytes
+    MAX_PAYLOAD = 7999
+
+    def __init__(self, channel, database, deliver=deliver_locally,
+                 has_receivers=None, list_receivers=None,
+                 advertise_interval=5):
+        """
+        Args:
+            channel (str) - Notification channel name
+            database (dict) - Django style database settings
+        """
+        super(PostgresBackend, self).__init__(
+            deliver, has_receivers, list_receivers, advertise_interval)
+        self.channel = channel
+        self.database = database
+
+    def _connect(self):
+        # psycopg2 is only needed when this backend is in use
+        import psycopg2
+        from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+        params = {
+            'database': self.database['NAME'],
+            'user': self.database.get('USER'),
+            'password': self.database.get('PASSWORD'),
+            'host': self.database.get('HOST'),
+            'port': self.database.get('PORT'),
+        }
+        conn = psycopg2.connect(
+            **dict((k, v) for k, v in params.items() if v))
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def _setup(self):
+        self._listen_conn = self._connect()
+        self._listen_conn.cursor().execute('LISTEN "%s";' % self.channel)
+        self._notify_conn = self._connect()
+
+    def _listen(self):
+        conn = self._listen_conn
+        while True:
+            socket.wait_read(conn.fileno())
+            conn.poll()
+            while conn.notifies:
+                self._receive(conn.notifies.pop(0).payload)
+
+    def _forward(self, payload):
+        if len(payload) > self.MAX_PAYLOAD:
+            raise EventLost('too large to forward (%d bytes)' % len(payload))
+        self._notify_conn.cursor().execute(
+            'SELECT pg_notify(%s, %s);', (self.channel, payload))
+        return True
+
+
+def create_backend(config, deliver=deliver_locally):
+    """
+    Create the monitor bus backend described by a MONITOR_PUBSUB style dict
+    """
+    backend = config.get('BACKEND', 'local')
+    interval = config.get('ADVERTISE_INTERVAL', 5)
+    if backend == 'unix':
+        return UnixSocketBackend(config['SOCKET_DIR'], deliver,
+                                 advertise_interval=interval)
+    elif backend == 'postgres':
+        return PostgresBackend(config['CHANNEL'],
+                               settings.DATABASES['default'], deliver,
+                               advertise_interval=interval)
+    elif backend != 'local':
+        logger.error('Unknown monitor pub/sub backend %s, using local'
+                     % backend)
+    return LocalBackend(deliver)
+
+
+monitor_bus = create_backend(settings.MONITOR_PUBSUB)
@@ -0,0 +1,190 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Recent DataPoints of each device stream, kept in memory
+
+Line graphs ask for the last few minutes of a stream when they are opened.
+While a device is being watched, and the monitor bus brings its DataPoints
+to every worker, a worker can answer from the points it has seen rather
+than asking Device Cloud again. Each stream's points are kept in a fixed size ring of
+typed arrays, a few KB per stream, and streams nobody pushes to for a while
+are forgotten.
+'''
+import logging
+import time
+from array import array
+from collections import OrderedDict
+from django.conf import settings
+from xbeewifiapp.libs.digi.datapoint import DataPoint
+
+logger = logging.getLogger(__name__)
+
+
+class StreamRing(object):
+    """
+    The last capacity (timestamp millis, value) points of a numeric stream.
+    Holds every point pushed since `since`.
+    """
+
+    __slots__ = ('timestamps', 'values', 'start', 'size', 'since', 'touched')
+
+    def __init__(self, capacity, since):
+        self.timestamps = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        self.start = 0
+        self.size = 0
+        self.since = since
+        self.touched = time.time()
+
+    def append(self, timestamp, value):
+        capacity = len(self.timestamps)
+        if self.size < capacity:
+            index = (self.start + self.size) % capacity
+            self.size += 1
+        else:
+            # Full, so the oldest point makes way and is no longer covered
+            index = self.start
+            self.since = max(self.since, self.timestamps[index] + 1)
+            self.start = (self.start + 1) % capacity
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+        self.touched = time.time()
+
+    def window(self, start, end):
+        """
+        Return the (timestamp, value) points between start and end, oldest
+        first
+        """
+        capacity = len(self.timestamps)
+        points = []
+        for n in xrange(self.size):
+            index = (self.start + n) % capacity
+            timestamp = self.timestamps[index]
+            if start <= timestamp <= end:
+                points.append((timestamp, self.values[index]))
+        # Pushes can arrive out of order
+        points.sort()
+        return points
+
+
+def _format(value):
+    # Device Cloud returns data as strings
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _text(data):
+    # How Device Cloud would return pushed data
+    if isinstance(data, basestring):
+        return data
+    if isinstance(data, float):
+        return repr(data)
+    return str(data)
+
+
+class RecentDataPoints(object):
+    """
+    A StreamRing per (device_id, streamId) of numeric DataPoint pushes. The
+    least recently pushed streams are forgotten once max_streams is reached,
+    and any not pushed to for idle_timeout seconds.
+    """
+
+    def __init__(self, capacity=300, max_streams=2000, idle_timeout=600):
+        self.capacity = capacity
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        # (device_id, streamId) -> StreamRing, least recently pushed first
+        self._streams = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._streams)
+
+    @property
+    def enabled(self):
+        return settings.RECENT_DATAPOINTS.get('ENABLED', True)
+
+    def update(self, device_id, msg):
+        """
+        Add the DataPoint of a push message to its stream's ring
+        """
+        try:
+            point = msg['DataPoint']
+            key = (device_id, point['streamId'])
+            timestamp = float(point['timestamp'])
+            value = float(point['data'])
+            # Only values that read back exactly as they were pushed, e.g.
+            # not "1.50"
+            if _format(value) != _text(point['data']):
+                raise ValueError(point['data'])
+        except (KeyError, TypeError, ValueError):
+            # Text streams can't be kept in a typed array
+            try:
+                self._streams.pop((device_id, msg['DataPoint']['streamId']),
+                                  None)
+            except (KeyError, TypeError):
+                pass
+            return
+
+        ring = self._streams.pop(key, None)
+        if ring is None:
+            ring = StreamRing(self.capacity, timestamp)
+        # Re-inserting keeps the dict ordered from least to most recent
+        self._streams[key] = ring
+        ring.append(timestamp, value)
+        self._evict()
+
+    def query(self, device_id, stream_id, start, end):
+        """
+        Return a stream's DataPoints between start and end (millis), oldest
+        first, or None if they haven't all been seen
+        """
+        ring = self._streams.get((device_id, stream_id))
+        if ring is not None and time.time() - ring.touched > self.idle_timeout:
+            # Pushes may have stopped, so later points could be missing
+            del self._streams[(device_id, stream_id)]
+            ring = None
+        if ring is None or start < ring.since:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [DataPoint(stream_id=stream_id, timestamp=str(int(timestamp)),
+                          data=_format(value))
+                for timestamp, value in ring.window(start, end)]
+
+    def discard(self, device_id):
+        """
+        Forget a device's streams, when pushes for it may have been missed
+        """
+        for key in [key for key in self._streams if key[0] == device_id]:
+            del self._streams[key]
+
+    def clear(self):
+        self._streams.clear()
+
+    def _evict(self):
+        streams = self._streams
+        while len(streams) > self.max_streams:
+            streams.popitem(last=False)
+        now = time.time()
+        while streams:
+            key, ring = next(streams.iteritems())
+            if now - ring.touched <= self.idle_timeout:
+                break
+            del streams[key]
+
+
+_recent_settings = settings.RECENT_DATAPOINTS
+
+recent_datapoints = RecentDataPoints(
+    capacity=_recent_settings.get('CAPACITY', 300),
+    max_streams=_recent_settings.get('MAX_STREAMS', 2000),
+    idle_timeout=_recent_settings.get('IDLE_TIMEOUT', 600))
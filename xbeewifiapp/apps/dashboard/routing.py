@@ -0,0 +1,128 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Routing of Device Cloud monitor push messages to a (topic, device_id) pair
+
+Reported topics come in a /##/Topic/Sub/topic/... form. Each topic has a
+handler which finds the device id, either from the subtopic (results are
+cached by topic string, as the same topics repeat constantly) or from the
+message body.
+'''
+import logging
+import re
+from collections import OrderedDict
+from urllib import unquote
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEVICE_ID_PATTERN = re.compile(r'\S*(?P<dev_id>((-?([0-9A-F]{8})){4}))')
+
+
+def datapoint_device_id(subtopic):
+    """
+    Extract a device id from a DataPoint subtopic (the stream id)
+    """
+    match = DEVICE_ID_PATTERN.match(subtopic)
+    if match:
+        return match.group('dev_id')
+    logger.warning('Error - No deviceId found in DataPoint subtopic!')
+    return None
+
+
+def devicecore_device_id(msg):
+    """
+    Device id isn't in DeviceCore topics, parse it out of the message body
+    """
+    try:
+        return msg['DeviceCore']['devConnectwareId']
+    except (KeyError, TypeError):
+        logger.warning('No DeviceId found in DeviceCore event')
+        return None
+
+
+class TopicRouter(object):
+    """
+    Maps monitor push messages to (topic, device_id) using a table of
+    per-topic handlers
+    """
+
+    def __init__(self, cache_size=1024):
+        """
+        Kwargs:
+            cache_size (int): Number of topic strings to remember the routing
+                              of
+        """
+        self.cache_size = cache_size
+        self._subtopic_handlers = {}
+        self._message_handlers = {}
+        # topic string -> (topic, device_id or None, needs message handler)
+        self._cache = OrderedDict()
+
+    def register_subtopic(self, topic, handler):
+        """
+        Route a topic using handler(subtopic), which returns a device id or
+        None. Results are cached per topic string.
+        """
+        self._message_handlers.pop(topic, None)
+        self._subtopic_handlers[topic] = handler
+        self._cache.clear()
+
+    def register_message(self, topic, handler):
+        """
+        Route a topic using handler(msg), which returns a device id or None.
+        Called for every message.
+        """
+        self._subtopic_handlers.pop(topic, None)
+        self._message_handlers[topic] = handler
+        self._cache.clear()
+
+    def route(self, msg):
+        """
+        Return (topic, device_id) for a push message. device_id is None if
+        the message could not be routed.
+
+        Raises KeyError if the message has no topic.
+        """
+        topic_full = msg['topic']
+        cache = self._cache
+        try:
+            entry = cache.pop(topic_full)
+        except KeyError:
+            entry = self._resolve(topic_full)
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        # Re-inserting keeps the dict ordered from least to most recent
+        cache[topic_full] = entry
+
+        topic, device_id, by_message = entry
+        if by_message:
+            device_id = self._message_handlers[topic](msg)
+        return topic, device_id
+
+    def _resolve(self, topic_full):
+        parts = topic_full.split('/', 2)
+        if len(parts) < 3:
+            logger.warning('Malformed push topic %s' % topic_full)
+            return (None, None, False)
+        topic = parts[1]
+
+        if topic in self._message_handlers:
+            return (topic, None, True)
+        try:
+            handler = self._subtopic_handlers[topic]
+        except KeyError:
+            logger.warning('No handler for push topic type %s!' % topic)
+            return (topic, None, False)
+        return (topic, handler(unquote(parts[2])), False)
+
+
+topic_router = TopicRouter(settings.MONITOR_TOPIC_CACHE_SIZE)
+topic_router.register_subtopic('DataPoint', datapoint_device_id)
+topic_router.register_message('DeviceCore', devicecore_device_id)
@@ -13,6 +13,7 @@ Created on Aug 6, 2013
 '''
 import logging
 import random
+import weakref
 from django.dispatch import Signal, receiver
 from django.contrib.auth.signals import user_logged_in
 from django.core.exceptions import ImproperlyConfigured
@@ -22,28 +23,131 @@ from django.conf import settings
 logger = logging.getLogger(__name__)
 
 
-class SignalDict(dict):
+def _make_id(target):
+    # Same identity Signal uses for receivers
+    if hasattr(target, '__func__'):
+        return (id(target.__self__), id(target.__func__))
+    return id(target)
 
-    def __init__(self, arglist):
-        self.arglist = arglist[:]
-        self.constructor = lambda: Signal(providing_args=self.arglist)
 
-    def __getitem__(self, item):
-        try:
-            return dict.__getitem__(self, item)
-        except KeyError:
-            # Add a signal for this name
-            newsignal = self.constructor()
-            self[item] = newsignal
-            return newsignal
+def _watch(target, callback, key):
+    """
+    Weakly reference target (the instance, for a bound method), calling
+    callback(key) when it is garbage collected
+    """
+    # Django's saferef can't be used here, asking it for a second reference
+    # to a bound method replaces the signal's own delete callback
+    if getattr(target, '__self__', None) is not None:
+        target = target.__self__
+    return weakref.ref(target, lambda ref: callback(key))
 
 
-# Mapping of monitor topics to SignalDict's for that topic
-# Note that each topic's dict might be constructed differently -
+class SignalRegistry(object):
+    """
+    Signals keyed by name (e.g. device id), created when the first receiver
+    connects and removed when the last one disconnects or is garbage
+    collected. Its size is bounded by the number of live subscriptions, not
+    by the number of names ever asked about.
+    """
+
+    def __init__(self, providing_args):
+        self.providing_args = providing_args[:]
+        self._signals = {}
+        # Weak references to each signal's receivers, so we hear when they
+        # are garbage collected
+        self._refs = {}
+        # Names whose receivers may have been garbage collected
+        self._dirty = set()
+        self.created = 0
+        self.removed = 0
+
+    def __len__(self):
+        return len(self._signals)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def keys(self):
+        """
+        Return the names of the signals with receivers
+        """
+        if self._dirty:
+            self.prune()
+        return self._signals.keys()
+
+    def get(self, key):
+        """
+        Return the signal for key if it has any receivers, otherwise None
+        """
+        if self._dirty:
+            self.prune()
+        return self._signals.get(key)
+
+    def connect(self, key, receiver, **kwargs):
+        """
+        Connect receiver to the signal for key, creating it if needed. Takes
+        the same keyword arguments as Signal.connect.
+        """
+        signal = self._signals.get(key)
+        if signal is None:
+            signal = self._signals[key] = Signal(
+                providing_args=self.providing_args)
+            self.created += 1
+        signal.connect(receiver, **kwargs)
+        if kwargs.get('weak', True):
+            # Only note the name here. The signal's own cleanup hasn't run
+            # yet, and may not be interrupted by work on the signal.
+            self._refs.setdefault(key, []).append(
+                (_make_id(receiver), _watch(receiver, self._dirty.add, key)))
+
+    def disconnect(self, key, receiver, **kwargs):
+        """
+        Disconnect receiver from the signal for key, removing the signal if
+        it has no receivers left
+        """
+        signal = self._signals.get(key)
+        if signal is not None:
+            signal.disconnect(receiver, **kwargs)
+            if key in self._refs:
+                receiver_id = _make_id(receiver)
+                self._refs[key] = [(r_id, ref) for r_id, ref in self._refs[key]
+                                   if r_id != receiver_id]
+            self._discard_if_empty(key)
+
+    def prune(self):
+        """
+        Remove signals left without receivers by garbage collection
+        """
+        dirty, self._dirty = self._dirty, set()
+        for key in dirty:
+            if key in self._refs:
+                self._refs[key] = [(r_id, ref) for r_id, ref in self._refs[key]
+                                   if ref() is not None]
+            self._discard_if_empty(key)
+
+    def stats(self):
+        return {
+            'channels': len(self._signals),
+            'receivers': sum(len(signal.receivers)
+                             for signal in self._signals.values()),
+            'created': self.created,
+            'removed': self.removed,
+        }
+
+    def _discard_if_empty(self, key):
+        signal = self._signals.get(key)
+        if signal is not None and not signal.receivers:
+            del self._signals[key]
+            self._refs.pop(key, None)
+            self.removed += 1
+
+
+# Mapping of monitor topics to SignalRegistry's for that topic
+# Note that each topic's registry might be constructed differently -
 # ex. DataPoint uses device_id and data args
 MONITOR_TOPIC_SIGNAL_MAP = {
-    'DataPoint': SignalDict(['device_id', 'data']),
-    'DeviceCore': SignalDict(['device_id', 'data'])
+    'DataPoint': SignalRegistry(['device_id', 'data']),
+    'DeviceCore': SignalRegistry(['device_id', 'data'])
 }
 
 
@@ -8,7 +8,11 @@
 
 import logging
 
+from django.conf import settings
 from signals import MONITOR_TOPIC_SIGNAL_MAP
+from pubsub import monitor_bus
+from outbound import CoalescingEmitter
+from latest import latest_values
 from socketio.namespace import BaseNamespace
 from socketio.sdjango import namespace
 from views import DevicesList, monitor_setup, monitor_devicecore_setup
@@ -30,6 +34,18 @@ class DeviceDataNamespace(BaseNamespace):
         """
         # Create a new set to track monitored devices
         self.monitored_devices = set()
+        # Device data is sent in batches, unless batching is turned off
+        outbound = settings.SOCKET_OUTBOUND
+        if outbound.get('WINDOW', 0) > 0:
+            self.data_buffer = CoalescingEmitter(
+                self.emit, 'device_data_batch',
+                window=outbound['WINDOW'],
+                max_rate=outbound.get('MAX_RATE'),
+                max_pending=outbound.get('MAX_PENDING', 1000),
+                overflow=outbound.get('OVERFLOW', 'merge'),
+                backlog=self.socket.client_queue.qsize)
+        else:
+            self.data_buffer = None
         if not self.request.user.is_authenticated():
             logger.error(
                 "Attempted to initialize unauthenticated socket connection")
@@ -41,6 +57,8 @@ class DeviceDataNamespace(BaseNamespace):
         else:
             # Lift access control restrictions
             self.lift_acl_restrictions()
+            # Make sure this worker hears pushes received by other workers
+            monitor_bus.start()
 
     def on_startmonitoringdevice(self, *args):
         for device_id in args:
@@ -69,13 +87,17 @@ class DeviceDataNamespace(BaseNamespace):
                             "Adding socket reciever for data for device %s" %
                             device_id)
                         # Add receiver for DataPoint events
-                        MONITOR_TOPIC_SIGNAL_MAP['DataPoint'][device_id]\
-                            .connect(self.device_data_receiver)
+                        MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].connect(
+                            device_id, self.device_data_receiver)
                         # Add receiver for DeviceCore events
-                        MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'][device_id]\
-                            .connect(self.device_status_receiver)
+                        MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'].connect(
+                            device_id, self.device_status_receiver)
+                        # Other workers can now accept pushes for it
+                        monitor_bus.advertise([('DataPoint', device_id),
+                                               ('DeviceCore', device_id)])
                         self.monitored_devices.add(device_id)
                         self.emit('started_monitoring', device_id)
+                        self.send_latest_values(device_id)
                 else:
                     logger.error(
                         "User %s attempted to start monitoring device %s," +
@@ -92,10 +114,10 @@ class DeviceDataNamespace(BaseNamespace):
             if device_id in self.monitored_devices:
                 logger.debug("Removing socket reciever for data for device %s"
                              % device_id)
-                MONITOR_TOPIC_SIGNAL_MAP['DataPoint'][device_id]\
-                    .disconnect(self.device_data_receiver)
-                MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'][device_id]\
-                    .disconnect(self.device_status_receiver)
+                MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].disconnect(
+                    device_id, self.device_data_receiver)
+                MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'].disconnect(
+                    device_id, self.device_status_receiver)
                 self.monitored_devices.remove(device_id)
                 self.emit('stopped_monitoring', device_id)
         return True
@@ -117,18 +139,37 @@ class DeviceDataNamespace(BaseNamespace):
     def disconnect(self, **kwargs):
         logger.debug("disconnecting socket & signal recievers")
         for device_id in self.monitored_devices:
-            MONITOR_TOPIC_SIGNAL_MAP['DataPoint'][device_id]\
-                .disconnect(self.device_data_receiver)
-            MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'][device_id]\
-                .disconnect(self.device_status_receiver)
+            MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].disconnect(
+                device_id, self.device_data_receiver)
+            MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'].disconnect(
+                device_id, self.device_status_receiver)
         self.monitored_devices.clear()
+        if self.data_buffer is not None:
+            self.data_buffer.close()
         super(DeviceDataNamespace, self).disconnect(**kwargs)
 
+    def send_latest_values(self, device_id):
+        """
+        Send the last value seen for each of a device's streams, so the
+        client doesn't have to wait for the next push
+        """
+        snapshot = latest_values.snapshot(device_id)
+        if not snapshot:
+            return
+        if self.data_buffer is not None:
+            self.emit('device_data_batch', snapshot)
+        else:
+            for data in snapshot:
+                self.emit('device_data', data)
+
     def device_data_receiver(self, **kwargs):
         # Validate that we're only sending data this socket is supposed to
         # monitor
         if kwargs['device_id'] in self.monitored_devices:
-            self.emit('device_data', kwargs['data'])
+            if self.data_buffer is not None:
+                self.data_buffer.add(kwargs['data'])
+            else:
+                self.emit('device_data', kwargs['data'])
         return True
 
     def device_status_receiver(self, **kwargs):
@@ -0,0 +1,271 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Local store of DataPoints received in monitor pushes
+
+Each push's DataPoints are written in one batch, as a chunk per stream with
+a column per field. Once a stream's points have been stored, its history
+from then on can be answered from the database rather than Device Cloud.
+That only holds while pushes keep arriving: when a push is refused, the
+monitor backs off and points are missed, so the streams of its devices stop
+being covered until pushes are stored again.
+
+Pushes are written by a background greenlet, so a slow database doesn't
+hold up acknowledging them to Device Cloud.
+'''
+import heapq
+import json
+import logging
+import os
+import gevent
+from gevent.queue import JoinableQueue
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import Q
+from models import DataPointChunk, StreamCoverage
+from xbeewifiapp.libs.digi.datapoint import DataPoint
+
+logger = logging.getLogger(__name__)
+
+# DataPoint fields kept, as Device Cloud's DataPoint resource returns them
+COLUMNS = ('id', 'timestamp', 'serverTimestamp', 'data', 'quality')
+# The DataPoint attribute of each column
+_ATTRIBUTES = ('id', 'timestamp', 'server_timestamp', 'data', 'quality')
+# Columns in the order points are sorted by while a history is read
+_HEAP_ORDER = ('timestamp', 'id', 'serverTimestamp', 'data', 'quality')
+# Chunks read from the database at a time
+CHUNK_BATCH = 100
+
+
+def _text(value):
+    # Pushes carry numbers where queries return strings
+    if value is None or isinstance(value, basestring):
+        return value
+    return str(value)
+
+
+class DataPointStore(object):
+    """
+    Writes pushed DataPoints to DataPointChunks, and reads histories back
+    for covered streams
+    """
+
+    def __init__(self, max_pending=10000):
+        """
+        Kwargs:
+            max_pending (int): Most DataPoints waiting to be written. Pushes
+                            arriving while there are more are dropped, and
+                            their devices' streams no longer covered.
+        """
+        self.max_pending = max_pending
+        self.pending = 0
+        self.dropped = 0
+        self._pid = None
+        self._queue = None
+        self._writer = None
+
+    @property
+    def enabled(self):
+        return settings.DATAPOINT_STORE.get('ENABLED', False)
+
+    def record_later(self, points):
+        """
+        Queue the DataPoints of one push to be stored in the background
+
+        Args:
+            points (list): (device_id, DataPoint) pairs
+        """
+        self._start()
+        if self.pending + len(points) > self.max_pending:
+            self.dropped += len(points)
+            logger.warning('DataPoint store falling behind, dropping %d '
+                           'pushed DataPoints' % len(points))
+            self.invalidate_later(set(device_id for device_id, _ in points))
+            return
+        self.pending += len(points)
+        self._queue.put((self.record, points))
+
+    def invalidate_later(self, device_ids):
+        """
+        Queue invalidate, to run after every push queued before it is stored
+        """
+        self._start()
+        self._queue.put((self.invalidate, device_ids))
+
+    def join(self, timeout=None):
+        """
+        Wait until everything queued has been written. Returns False if the
+        timeout expired first.
+        """
+        if self._queue is None:
+            return True
+        return self._queue.join(timeout)
+
+    def _start(self):
+        if self._pid != os.getpid():
+            # A queue inherited from a parent belongs to its hub
+            self._pid = os.getpid()
+            self._queue = JoinableQueue()
+            self._writer = None
+            self.pending = 0
+        if self._writer is None or self._writer.dead:
+            self._writer = gevent.spawn(self._write)
+
+    def _write(self):
+        queue = self._queue
+        while True:
+            method, arg = queue.get()
+            try:
+                method(arg)
+            except Exception:
+                logger.exception('Error writing to the DataPoint store')
+                if method == self.record:
+                    self.invalidate(set(device_id for device_id, _ in arg))
+            finally:
+                if method == self.record:
+                    self.pending -= len(arg)
+                queue.task_done()
+
+    def record(self, points):
+        """
+        Store the DataPoints of one push
+
+        Args:
+            points (list): (device_id, DataPoint) pairs
+        """
+        streams = {}
+        for device_id, point in points:
+            stream_id = point.stream_id
+            timestamp = point.millis
+            if stream_id is None or timestamp is None:
+                continue
+            stream = streams.get(stream_id)
+            if stream is None:
+                stream = streams[stream_id] = (device_id, dict(
+                    (name, []) for name in COLUMNS))
+            columns = stream[1]
+            for name, attribute in zip(COLUMNS, _ATTRIBUTES):
+                columns[name].append(_text(getattr(point, attribute)))
+            columns['timestamp'][-1] = timestamp
+        if not streams:
+            return
+
+        chunks = []
+        for stream_id, (device_id, columns) in streams.iteritems():
+            timestamps = columns['timestamp']
+            chunks.append(DataPointChunk(
+                stream_id=stream_id, device_id=device_id,
+                first=min(timestamps), last=max(timestamps),
+                count=len(timestamps), columns=columns))
+        try:
+            DataPointChunk.objects.bulk_create(chunks)
+        except DatabaseError, e:
+            logger.error('Failed to store pushed DataPoints: %s' % e)
+            self.invalidate(set(chunk.device_id for chunk in chunks))
+            return
+
+        # Streams seen for the first time (or since a gap) are covered from
+        # their oldest point in this push
+        covered = set(StreamCoverage.objects.filter(
+            stream_id__in=streams.keys()).values_list('stream_id', flat=True))
+        for chunk in chunks:
+            if chunk.stream_id not in covered:
+                StreamCoverage.objects.get_or_create(
+                    stream_id=chunk.stream_id,
+                    defaults={'device_id': chunk.device_id,
+                              'since': chunk.first})
+
+    def query(self, stream_id, start, end):
+        """
+        Return an iterator over a stream's DataPoints between start and end
+        (millis), oldest first, or None if the store doesn't hold all of
+        them. Chunks are read CHUNK_BATCH at a time as the iterator is
+        consumed, so a long window is never loaded whole.
+        """
+        try:
+            coverage = StreamCoverage.objects.get(stream_id=stream_id)
+        except StreamCoverage.DoesNotExist:
+            return None
+        except DatabaseError, e:
+            logger.error('Failed to read stored DataPoints: %s' % e)
+            return None
+        if start < coverage.since:
+            return None
+        return self._iter_points(stream_id, start, end)
+
+    def _iter_points(self, stream_id, start, end):
+        chunks = DataPointChunk.objects.filter(
+            stream_id=stream_id, last__gte=start, first__lte=end).order_by(
+            'first', 'pk').values_list('pk', 'first', 'columns')
+        # Pushes can arrive out of order, so chunks overlap. Points wait in a
+        # heap until a chunk starts after them, as no later chunk (ordered by
+        # first) can hold anything older.
+        pending = []
+        previous = None
+        after = None
+        while True:
+            batch = chunks
+            if after is not None:
+                batch = batch.filter(Q(first__gt=after[0]) |
+                                     Q(first=after[0], pk__gt=after[1]))
+            batch = list(batch[:CHUNK_BATCH])
+            for pk, first, columns in batch:
+                while pending and pending[0][0] < first:
+                    point = heapq.heappop(pending)
+                    # A push Device Cloud sent again is stored twice, and
+                    # its copies leave the heap one after the other
+                    if point[:2] != previous:
+                        previous = point[:2]
+                        yield self._point(stream_id, point)
+                if isinstance(columns, basestring):
+                    # values_list() skips the JSONField's decoding
+                    columns = json.loads(columns)
+                for point in zip(*[columns[name] for name in _HEAP_ORDER]):
+                    if start <= point[0] <= end:
+                        heapq.heappush(pending, point)
+            if len(batch) < CHUNK_BATCH:
+                break
+            after = batch[-1][1], batch[-1][0]
+        while pending:
+            point = heapq.heappop(pending)
+            if point[:2] != previous:
+                previous = point[:2]
+                yield self._point(stream_id, point)
+
+    @staticmethod
+    def _point(stream_id, point):
+        timestamp, id, server_timestamp, data, quality = point
+        return DataPoint(id, stream_id, str(timestamp), server_timestamp,
+                         data, quality)
+
+    def invalidate(self, device_ids):
+        """
+        Stop answering for the streams of devices whose pushes may have been
+        missed
+        """
+        if not device_ids:
+            return
+        try:
+            StreamCoverage.objects.filter(device_id__in=device_ids).delete()
+        except DatabaseError, e:
+            logger.error('Failed to drop DataPoint store coverage: %s' % e)
+
+    def prune(self, before):
+        """
+        Delete chunks holding nothing newer than before (millis)
+        """
+        deleted = DataPointChunk.objects.filter(last__lt=before)
+        count = deleted.count()
+        deleted.delete()
+        StreamCoverage.objects.filter(since__lt=before).update(since=before)
+        return count
+
+
+datapoint_store = DataPointStore(
+    max_pending=settings.DATAPOINT_STORE.get('MAX_PENDING', 10000))
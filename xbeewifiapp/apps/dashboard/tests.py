@@ -18,10 +18,12 @@ from django.test.client import RequestFactory
 from mock import patch, MagicMock
 from django.contrib.auth import get_user_model, login
 from views import login_user, logout_user
+import views
+import downsample
 from django.contrib.sessions.middleware import SessionMiddleware
 from models import Dashboard
 from xbeewifiapp.libs.digi.models import DeviceCloudUser
-from xbeewifiapp.libs.digi.tests import TEST_RESPONSES
+from xbeewifiapp.libs.digi.tests import TEST_RESPONSES, DataPointPages
 import json
 from sockets import DeviceDataNamespace
 from socketio.virtsocket import Socket
@@ -29,7 +31,29 @@ import util
 import base64
 from django.conf import settings
 from rest_framework.test import APITestCase
-from signals import MONITOR_TOPIC_SIGNAL_MAP
+from signals import MONITOR_TOPIC_SIGNAL_MAP, SignalRegistry
+from xbeewifiapp.libs.digi.connections import connector_registry
+from xbeewifiapp.libs.digi.devicecloud import DeviceCloudConnector
+import pubsub
+import dispatch
+import routing
+import outbound
+from latest import LatestValueCache, latest_values
+from parsers import PushMessageStream
+from rest_framework.exceptions import ParseError
+from StringIO import StringIO
+from monitors import MonitorStateCache, monitor_states, summarize_push
+from batching import MonitorBatchTuner
+from requests.exceptions import ConnectionError
+from dispatch import monitor_dispatcher
+from store import DataPointStore, datapoint_store
+from recent import RecentDataPoints, recent_datapoints
+from xbeewifiapp.libs.digi.datapoint import DataPoint
+import gevent
+import os
+import shutil
+import tempfile
+import time
 
 User = get_user_model()
 
@@ -62,6 +86,13 @@ class MockedCloudTestCase(APITestCase):
         # By default cloud cred check will return valid, individual test can change this if desired
         self.set_auth_result((True, {}))
 
+        # Don't share pooled connectors or cached monitors between tests
+        self.addCleanup(connector_registry.clear)
+        monitor_states.clear()
+        self.addCleanup(monitor_states.clear)
+        recent_datapoints.clear()
+        self.addCleanup(recent_datapoints.clear)
+
     def do_session_middleware_stuff(self, request):
         """
         If using the RequestFactory, middleware is skipped which breaks auth. Use this to re-add session info to request
@@ -319,6 +350,31 @@ class DevicesViewTest(MockedCloudAuthenticatedTestCase):
         self.assertTrue(self.patched_post.called)
         self.assertIn("<DeviceCore><devMac>123456</devMac></DeviceCore>", self.patched_post.call_args[1]['data'])
 
+    def test_device_list_cached(self):
+        self.client.get(reverse('devices-list'))
+        resp = self.client.get(reverse('devices-list'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.patched_get.call_count, 1)
+        self.assertIn('url', json.loads(resp.content)['items'][0].keys())
+        # Provisioning adds a device to the account
+        self.patched_post.return_value.json.return_value = {}
+        self.client.post(reverse('devices-list'), {'mac': '123456'})
+        self.client.get(reverse('devices-list'))
+        self.assertEqual(self.patched_get.call_count, 2)
+
+    def test_device_list_devicecore_push(self):
+        self.client.get(reverse('devices-list'))
+        push = {"Document": {"Msg": {
+            "topic": "1/DeviceCore/1234/0",
+            "DeviceCore": {"devConnectwareId": "00000000-00000000-00000000-00000001"}}}}
+        with patch.object(pubsub.monitor_bus, 'publish', wraps=pubsub.monitor_bus.publish) as publish:
+            self.client.put(reverse('monitor_receiver'), push,
+                            HTTP_AUTHORIZATION=MonitorReceiverTest.good_auth_header)
+        # Every worker's cached listings are invalidated
+        publish.assert_any_call(pubsub.DEVICE_CHANGED, "00000000-00000000-00000000-00000001", None)
+        self.client.get(reverse('devices-list'))
+        self.assertEqual(self.patched_get.call_count, 2)
+
 
 
 class DeviceDetailViewTest(MockedCloudAuthenticatedTestCase):
@@ -351,6 +407,27 @@ class DeviceDetailViewTest(MockedCloudAuthenticatedTestCase):
         self.assertIn('data-url', json_resp['items'][0].keys())
         self.assertTrue(reverse('device-datastream-list', kwargs={'device_id': '00000000-00000000-00000000-00000001'}) in json_resp['items'][0]['data-url'])
 
+    def test_device_detail_include(self):
+        def get(session, uri, params=None):
+            resource = 'DataStream' if 'DataStream' in uri else 'DeviceCore'
+            response = MagicMock()
+            response.json.return_value = json.loads(TEST_RESPONSES[resource]['GET'])
+            return response
+        self.patched_get.side_effect = get
+        self.patched_post.return_value.json.return_value = json.loads(TEST_RESPONSES['sci']['GET'])
+
+        url = reverse('devices-detail', kwargs={'device_id': "00000000-00000000-00000000-00000001"})
+        resp = self.client.get(url + '?include=data,config')
+        self.assertEqual(resp.status_code, 200)
+        device = json.loads(resp.content)['items'][0]
+        self.assertEqual(device['data']['items'][0]['streamId'], json.loads(TEST_RESPONSES['DataStream']['GET'])['items'][0]['streamId'])
+        self.assertIn('sci_reply', device['config'])
+        self.assertEqual(self.patched_get.call_count, 2)
+        self.assertEqual(self.patched_post.call_count, 1)
+
+        resp = self.client.get(url + '?include=alarms')
+        self.assertEqual(resp.status_code, 400)
+
 
 # ******************************
 #            Device Config
@@ -413,6 +490,34 @@ class DeviceConfigViewTest(MockedCloudAuthenticatedTestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertTrue(self.patched_post.called)
 
+    def test_devices_config_stock_put(self):
+        device_list = TEST_RESPONSES['DeviceCore']['GET']
+        self.patched_get.return_value.json.return_value = json.loads(device_list)
+        resp = self.client.put(reverse('devices-config-stock'))
+        self.assertEqual(resp.status_code, 200)
+        progress = [json.loads(line) for line in
+                    ''.join(resp.streaming_content).splitlines()]
+        self.assertEqual(len(progress), 1)
+        self.assertEqual(progress[0]['device_id'], "00000000-00000000-00000000-00000001")
+        self.assertEqual(progress[0]['status'], 'applied')
+        # One query, then one batched set_setting
+        self.assertEqual(self.patched_post.call_count, 2)
+        self.assertIn("<set_setting>", self.patched_post.call_args[1]['data'])
+
+    def test_devices_config_stock_put_query_error(self):
+        device_list = TEST_RESPONSES['DeviceCore']['GET']
+        self.patched_get.return_value.json.return_value = json.loads(device_list)
+        reply = {'sci_reply': {'send_message': {'device': {'rci_reply': {
+            'query_setting': {'error': {'desc': 'Busy'}}}}}}}
+        with patch.object(DeviceCloudConnector, 'get_device_settings', return_value=reply):
+            resp = self.client.put(reverse('devices-config-stock'))
+            progress = [json.loads(line) for line in
+                        ''.join(resp.streaming_content).splitlines()]
+        self.assertEqual(progress[0]['status'], 'error')
+        self.assertEqual(progress[0]['detail'], reply)
+        # Nothing is set on a device whose settings couldn't be read
+        self.assertFalse(self.patched_post.called)
+
 # ******************************
 #            Device IO
 # ******************************
@@ -442,6 +547,12 @@ class DeviceIOViewTest(MockedCloudAuthenticatedTestCase):
         good_data = {"DIO/2": 1, "D1": "high", "serial/0": "asdf"}
         resp = self.client.put(reverse('device-io', kwargs={'device_id': "00000000-00000000-00000000-00000001"}), good_data)
         self.assertEqual(resp.status_code, 200)
+        # Levels, setting and serial data all go in one SCI request
+        self.assertEqual(self.patched_post.call_count, 1)
+        body = self.patched_post.call_args[1]['data']
+        self.assertIn('<set_state>', body)
+        self.assertIn('<set_setting>', body)
+        self.assertIn('<data_service>', body)
 
 # ******************************
 #            Device Data
@@ -507,6 +618,336 @@ class DeviceDataPointViewTest(MockedCloudAuthenticatedTestCase):
         self.assertEqual(json_resp['items'][0]['data'], "0")
 
 
+class DeviceDataPointHistoryViewTest(MockedCloudAuthenticatedTestCase):
+
+    path = reverse('device-datapoint-list', kwargs={'device_id': "00000000-00000000-00000000-00000001", 'stream_id': "00000000-00000000-00000000-00000001/DIO/0"})
+
+    def setUp(self):
+        super(DeviceDataPointHistoryViewTest, self).setUp()
+        self.pages = DataPointPages([{'id': str(n), 'data': str(n)} for n in range(5)])
+        self.patched_get.side_effect = self.pages
+
+    def test_history_streamed(self):
+        resp = self.client.get(self.path, {'startTime': 0, 'endTime': 60, 'size': 2})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        json_resp = json.loads(''.join(resp.streaming_content))
+        self.assertEqual(json_resp['items'], self.pages.points)
+        self.assertEqual(json_resp['resultSize'], "5")
+        self.assertEqual(self.patched_get.call_count, 3)
+
+    def test_history_single_page(self):
+        resp = self.client.get(self.path, {'size': 10})
+        self.assertFalse(resp.streaming)
+        self.assertEqual(json.loads(resp.content)['items'], self.pages.points)
+
+    def test_history_error(self):
+        self.pages.fail_after = 2
+        resp = self.client.get(self.path, {'size': 2})
+        json_resp = json.loads(''.join(resp.streaming_content))
+        self.assertEqual(json_resp['items'], self.pages.points[:2])
+        self.assertIn('error', json_resp)
+
+    def test_history_bad_size(self):
+        resp = self.client.get(self.path, {'size': 1001})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_history_reduced_locally(self):
+        # A sample every 12s over 10 minutes, too short for a rollup
+        self.pages.points = [{'timestamp': str(n * 12000), 'data': str(n)} for n in range(50)]
+        resp = self.client.get(self.path, {'startTime': 0, 'endTime': 600, 'points': 5})
+        self.assertEqual(resp.status_code, 200)
+        json_resp = json.loads(resp.content)
+        self.assertEqual(json_resp['rollup'], {'source': 'local', 'method': 'average'})
+        self.assertEqual(json_resp['resultSize'], "5")
+        self.assertEqual(json_resp['items'][0], {'timestamp': '0', 'data': '4.5'})
+        self.assertIsNone(self.pages.requests[0]['rollupInterval'])
+
+    def test_history_rolled_up(self):
+        # A day split into 300 points needs Device Cloud's half hour rollups
+        self.pages.points = [{'timestamp': str(n * 1800000), 'data': '1'} for n in range(48)]
+        resp = self.client.get(self.path, {'startTime': 0, 'endTime': 86400, 'points': 300, 'rollupMethod': 'max'})
+        json_resp = json.loads(resp.content)
+        self.assertEqual(json_resp['rollup'], {'source': 'devicecloud', 'interval': 'half', 'method': 'max'})
+        self.assertEqual(json_resp['resultSize'], "48")
+        self.assertEqual(self.pages.requests[0]['rollupInterval'], 'half')
+        self.assertEqual(self.pages.requests[0]['rollupMethod'], 'max')
+
+    def test_history_rolled_up_averages(self):
+        # Half hour averages of very different numbers of points
+        self.pages.points = [{'timestamp': str(n * 1800000), 'data': data}
+                       for n, data in ((0, '10'), (1, '1'), (16, '2'), (17, '2'))]
+        self.pages.counts = [{'timestamp': str(n * 1800000), 'data': count}
+                       for n, count in ((0, '1'), (1, '9'), (16, '1'), (17, '1'))]
+        resp = self.client.get(self.path, {'startTime': 0, 'endTime': 86400, 'points': 3})
+        json_resp = json.loads(resp.content)
+        self.assertEqual([p['data'] for p in json_resp['items']], ['1.9', '2.0'])
+        self.assertEqual([r['rollupMethod'] for r in self.pages.requests], ['average', 'count'])
+
+    def test_history_rollup_refused(self):
+        self.pages.refuse_rollups = True
+        self.pages.points = [{'timestamp': str(n * 1000), 'data': 'text'} for n in range(5)]
+        resp = self.client.get(self.path, {'startTime': 0, 'endTime': 86400, 'points': 300})
+        json_resp = json.loads(resp.content)
+        self.assertEqual(json_resp['rollup']['source'], 'local')
+        # Strings can't be reduced, so come back as they are
+        self.assertEqual(json_resp['items'], self.pages.points)
+
+    def test_history_bad_points(self):
+        resp = self.client.get(self.path, {'points': 2})
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(self.path, {'points': 100, 'rollupMethod': 'median'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_history_from_store(self):
+        stream_id = "00000000-00000000-00000000-00000001/DIO/0"
+        datapoint_store.record([('00000000-00000000-00000000-00000001',
+                                 DataPoint(str(n), stream_id, n * 1000, data=n))
+                                for n in range(10)])
+        session = self.client.session
+        session['user_devices'] = ['00000000-00000000-00000000-00000001']
+        session.save()
+        with self.settings(DATAPOINT_STORE={'ENABLED': True}):
+            resp = self.client.get(self.path, {'startTime': 2, 'endTime': 5})
+            json_resp = json.loads(resp.content)
+            self.assertEqual([p['data'] for p in json_resp['items']], ['2', '3', '4', '5'])
+            self.assertEqual(json_resp['resultSize'], "4")
+            resp = self.client.get(self.path, {'startTime': 0, 'endTime': 10, 'points': 5})
+            self.assertEqual(json.loads(resp.content)['rollup'], {'source': 'store', 'method': 'average'})
+            # Longer than a page, so streamed
+            resp = self.client.get(self.path, {'startTime': 0, 'endTime': 10, 'size': 3})
+            json_resp = json.loads(''.join(resp.streaming_content))
+            self.assertEqual([p['data'] for p in json_resp['items']], [str(n) for n in range(10)])
+            self.assertEqual(json_resp['resultSize'], "10")
+            self.assertFalse(self.patched_get.called)
+            # Before the first stored point, so Device Cloud is asked
+            self.client.get(self.path, {'startTime': -60, 'endTime': 5})
+            self.assertTrue(self.patched_get.called)
+            # Only streams under the device's own id are answered locally
+            self.patched_get.reset_mock()
+            other_id = 'other/' + stream_id
+            datapoint_store.record([('other', DataPoint(str(n), other_id, n * 1000, data=n)) for n in range(10)])
+            path = reverse('device-datapoint-list', kwargs={'device_id': "00000000-00000000-00000000-00000001",
+                                                            'stream_id': other_id})
+            self.client.get(path, {'startTime': 2, 'endTime': 5})
+            self.assertTrue(self.patched_get.called)
+
+    def test_history_from_memory(self):
+        device_id = "00000000-00000000-00000000-00000001"
+        stream_id = "00000000-00000000-00000000-00000001/DIO/0"
+        now = int(time.time() * 1000)
+        # Watched for the last 10 minutes, a point every 30s
+        for n in range(20, 0, -1):
+            recent_datapoints.update(device_id, {'DataPoint': {
+                'streamId': stream_id, 'timestamp': now - n * 30000, 'data': n}})
+        bus = patch.object(pubsub.monitor_bus, 'cluster_wide', True)
+        bus.start()
+        self.addCleanup(bus.stop)
+        resp = self.client.get(self.path)
+        # Only answered for the user's own devices
+        self.assertTrue(self.patched_get.called)
+        self.patched_get.reset_mock()
+        session = self.client.session
+        session['user_devices'] = [device_id]
+        session.save()
+        resp = self.client.get(self.path)
+        json_resp = json.loads(resp.content)
+        # The default window is the last 5 minutes, to the second
+        data = [p['data'] for p in json_resp['items']]
+        self.assertEqual(data[-9:], [str(n) for n in range(9, 0, -1)])
+        self.assertNotIn('11', data)
+        resp = self.client.get(self.path, {'points': 5})
+        self.assertEqual(json.loads(resp.content)['rollup'], {'source': 'recent', 'method': 'average'})
+        self.assertFalse(self.patched_get.called)
+
+
+class DownsampleTest(TestCase):
+
+    def setUp(self):
+        # A flat line with a spike, one point a second
+        self.items = [DataPoint(timestamp=str(n * 1000), data='0') for n in range(100)]
+        self.items[41].data = '10'
+        self.points = downsample.numeric_points(self.items)
+
+    def test_aggregate(self):
+        averages = downsample.aggregate(self.points, 0, 100000, 10, 'average')
+        self.assertEqual(len(averages), 10)
+        self.assertEqual(averages[4].to_dict(), {'timestamp': '40000', 'data': '1.0'})
+        maxima = downsample.aggregate(self.points, 0, 100000, 10, 'max')
+        self.assertEqual([p.data for p in maxima].count('10.0'), 1)
+        counts = downsample.aggregate(self.points, 0, 100000, 10, 'count')
+        self.assertEqual(counts[0].data, '10')
+
+    def test_aggregate_outside_window(self):
+        # Rollups are aligned to their interval, so may start before the window
+        points = downsample.numeric_points([DataPoint(timestamp='-500', data='1'), DataPoint(timestamp='150000', data='1')])
+        self.assertEqual(len(downsample.aggregate(points, 0, 100000, 10, 'sum')), 2)
+
+    def test_lttb(self):
+        kept = downsample.lttb_by_time(self.points, 0, 100000, 10)
+        self.assertEqual(len(kept), 10)
+        self.assertIs(kept[0], self.items[0])
+        self.assertIs(kept[-1], self.items[-1])
+        # The spike is what gives the line its shape
+        self.assertIn(self.items[41], kept)
+
+    def test_downsample(self):
+        self.assertEqual(len(downsample.downsample(self.items, 0, 100000, 20, 'lttb')), 20)
+        self.assertEqual(downsample.downsample(self.items, 0, 100000, 200, 'average'), self.items)
+        text = [DataPoint(timestamp='0', data='a'), DataPoint(timestamp='1', data='b')]
+        self.assertEqual(downsample.downsample(text, 0, 2, 2, 'average'), text)
+        # Too many strings to return are sampled, without holding them all
+        text = (DataPoint(timestamp=str(n), data='on') for n in xrange(100000))
+        sampled = downsample.downsample(text, 0, 100000, 300, 'average')
+        self.assertEqual(len(sampled), 300)
+        self.assertEqual(sampled[1].to_dict(), {'timestamp': '334', 'data': 'on'})
+        # Reduced as the points arrive, without holding them all
+        points = (DataPoint(timestamp=str(n), data='1') for n in xrange(100000))
+        self.assertEqual(len(downsample.downsample(points, 0, 100000, 300, 'lttb')), 300)
+
+    def test_weighted_average(self):
+        averages = downsample.numeric_points([DataPoint(timestamp='0', data='10'), DataPoint(timestamp='1', data='1')])
+        counts = downsample.numeric_points([DataPoint(timestamp='0', data='1'), DataPoint(timestamp='1', data='9')])
+        self.assertEqual(downsample.weighted_average(averages, counts, 0, 2, 1)[0].data, '1.9')
+
+    def test_rollup_interval(self):
+        self.assertEqual(views.rollup_interval(24 * 3600, 300, 0.125), 'half')
+        # Half hours would only give 12 of the 300 points
+        self.assertIsNone(views.rollup_interval(6 * 3600, 300, 0.125))
+        # A month of half hours wouldn't fit in a page
+        self.assertEqual(views.rollup_interval(30 * 24 * 3600, 300, 0.125), 'hour')
+
+
+class RecentDataPointsTest(TestCase):
+
+    def setUp(self):
+        self.recent = RecentDataPoints(capacity=4, max_streams=2, idle_timeout=60)
+
+    def push(self, stream_id, timestamp, data):
+        self.recent.update('dev', {'DataPoint': {'streamId': stream_id, 'timestamp': timestamp, 'data': data}})
+
+    def test_query(self):
+        for n, data in ((1, 1.5), (3, 4.5), (2, 3)):
+            self.push('s', n * 1000, data)
+        self.assertEqual([p.to_dict() for p in self.recent.query('dev', 's', 1000, 2000)],
+                         [{'timestamp': '1000', 'data': '1.5', 'streamId': 's'},
+                          {'timestamp': '2000', 'data': '3', 'streamId': 's'}])
+        # Nothing is known from before the first point
+        self.assertIsNone(self.recent.query('dev', 's', 0, 2000))
+        self.assertIsNone(self.recent.query('dev', 'other', 1000, 2000))
+
+    def test_ring_wraps(self):
+        for n in range(1, 7):
+            self.push('s', n * 1000, n)
+        self.assertIsNone(self.recent.query('dev', 's', 2000, 6000))
+        self.assertEqual([p.data for p in self.recent.query('dev', 's', 2001, 6000)], ['3', '4', '5', '6'])
+
+    def test_eviction(self):
+        self.push('a', 1000, 1)
+        self.push('b', 1000, 1)
+        self.push('a', 2000, 1)
+        self.push('c', 1000, 1)
+        # b was least recently pushed
+        self.assertIsNone(self.recent.query('dev', 'b', 1000, 2000))
+        self.assertEqual(len(self.recent), 2)
+        with patch('xbeewifiapp.apps.dashboard.recent.time.time', return_value=time.time() + 120):
+            self.assertIsNone(self.recent.query('dev', 'a', 1000, 2000))
+
+    def test_text_and_discard(self):
+        self.push('s', 1000, 1)
+        self.push('s', 2000, 'on')
+        self.assertIsNone(self.recent.query('dev', 's', 1000, 2000))
+        # Numbers that wouldn't read back as pushed aren't kept either
+        self.push('s', 3000, '1.50')
+        self.assertIsNone(self.recent.query('dev', 's', 3000, 3000))
+        self.push('s', 3000, '1.5')
+        self.assertEqual(self.recent.query('dev', 's', 3000, 3000)[0].data, '1.5')
+        self.push('s', 3000, 1)
+        self.recent.discard('dev')
+        self.assertEqual(len(self.recent), 0)
+
+
+class DataPointStoreTest(TestCase):
+
+    device_id = '00000000-00000000-00000000-00000001'
+    stream_id = 'dia/channel/00000000-00000000-00000000-00000001/DIO/0'
+
+    def push(self, first, count):
+        datapoint_store.record([(self.device_id, DataPoint.from_dict({
+            'id': str(n), 'streamId': self.stream_id, 'timestamp': n * 1000,
+            'serverTimestamp': n * 1000 + 5, 'data': n, 'quality': 0}))
+            for n in range(first, first + count)])
+
+    def test_record_and_query(self):
+        self.push(10, 5)
+        self.push(15, 5)
+        items = list(datapoint_store.query(self.stream_id, 12000, 16000))
+        self.assertEqual([item.id for item in items], ['12', '13', '14', '15', '16'])
+        self.assertEqual(items[0].to_dict(), {'id': '12', 'streamId': self.stream_id, 'timestamp': '12000',
+                                    'serverTimestamp': '12005', 'data': '12', 'quality': '0'})
+
+    def test_not_covered(self):
+        self.assertIsNone(datapoint_store.query(self.stream_id, 0, 1000))
+        self.push(10, 5)
+        # Points before the first push may be missing
+        self.assertIsNone(datapoint_store.query(self.stream_id, 9000, 12000))
+        self.assertEqual(list(datapoint_store.query(self.stream_id, 20000, 30000)), [])
+
+    def test_duplicate_push(self):
+        self.push(10, 5)
+        self.push(10, 5)
+        self.assertEqual(len(list(datapoint_store.query(self.stream_id, 10000, 14000))), 5)
+
+    def test_read_in_batches(self):
+        # Pushed out of order, and one of them twice
+        self.push(10, 5)
+        self.push(20, 5)
+        self.push(15, 5)
+        self.push(20, 5)
+        with patch('xbeewifiapp.apps.dashboard.store.CHUNK_BATCH', 1):
+            items = datapoint_store.query(self.stream_id, 10000, 30000)
+            self.assertEqual([item.id for item in items], [str(n) for n in range(10, 25)])
+
+    def test_invalidate(self):
+        self.push(10, 5)
+        datapoint_store.invalidate([self.device_id])
+        self.assertIsNone(datapoint_store.query(self.stream_id, 10000, 14000))
+        # Covered again from the next push
+        self.push(20, 5)
+        self.assertIsNone(datapoint_store.query(self.stream_id, 10000, 24000))
+        self.assertEqual(len(list(datapoint_store.query(self.stream_id, 20000, 24000))), 5)
+
+    def test_record_later(self):
+        def points(first, count):
+            return [(self.device_id, DataPoint(str(n), self.stream_id, n * 1000, data=n))
+                    for n in range(first, first + count)]
+        store = DataPointStore(max_pending=6)
+        store.record_later(points(10, 5))
+        self.assertIsNone(store.query(self.stream_id, 10000, 14000))
+        self.assertTrue(store.join(timeout=1))
+        self.assertEqual(len(list(store.query(self.stream_id, 10000, 14000))), 5)
+        # Invalidated in order, after the pushes queued before it
+        store.record_later(points(15, 5))
+        store.invalidate_later([self.device_id])
+        store.record_later(points(20, 1))
+        store.join(timeout=1)
+        self.assertIsNone(store.query(self.stream_id, 10000, 20000))
+        # Too far behind, so the push is dropped and its streams not covered
+        with patch.object(store, 'record', side_effect=lambda points: gevent.sleep(0.01)):
+            store.record_later(points(21, 5))
+            store.record_later(points(26, 5))
+            store.join(timeout=1)
+        self.assertEqual((store.dropped, store.pending), (5, 0))
+        self.assertIsNone(store.query(self.stream_id, 20000, 20000))
+
+    def test_prune(self):
+        self.push(10, 5)
+        self.push(20, 5)
+        self.assertEqual(datapoint_store.prune(15000), 1)
+        self.assertIsNone(datapoint_store.query(self.stream_id, 10000, 24000))
+        self.assertEqual(len(list(datapoint_store.query(self.stream_id, 15000, 24000))), 5)
+
+
 # ******************************
 #            Device Serial
 # ******************************
@@ -587,9 +1028,18 @@ class MonitorReceiverTest(APITestCase):
         self.assertEqual(resp.status_code, 503)
         # We should get a 200 if something is
         receiver_mock = MagicMock()
-        MONITOR_TOPIC_SIGNAL_MAP['DataPoint']['00000000-00000000-00000000-00000001'].connect(receiver_mock)
+        registry = MONITOR_TOPIC_SIGNAL_MAP['DataPoint']
+        registry.connect('00000000-00000000-00000000-00000001', receiver_mock)
+        # Disconnect explicitly; letting the mock be garbage collected while
+        # connected can deadlock the dispatcher in a later connect()
+        self.addCleanup(registry.disconnect, '00000000-00000000-00000000-00000001', receiver_mock)
         resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
         self.assertEqual(resp.status_code, 200)
+        self.addCleanup(latest_values.clear)
+        # Fan out happens in the background
+        self.assertTrue(monitor_dispatcher.join(timeout=1))
+        self.assertEqual(latest_values.snapshot('00000000-00000000-00000000-00000001'),
+                         [self.mon_push_body["Document"]["Msg"]])
         # Check that the signal reciever was called properly
         self.assertTrue(receiver_mock.called)
         self.assertEqual(receiver_mock.call_count, 1)
@@ -597,6 +1047,116 @@ class MonitorReceiverTest(APITestCase):
         self.assertEqual(kwargs['device_id'], '00000000-00000000-00000000-00000001')
         self.assertEqual(kwargs['data'], self.mon_push_body["Document"]["Msg"])
 
+    def test_receiver_many_messages(self):
+        msg = self.mon_push_body["Document"]["Msg"]
+        body = {"Document": {"Msg": [msg] * 250}}
+        receiver_mock = MagicMock()
+        registry = MONITOR_TOPIC_SIGNAL_MAP['DataPoint']
+        registry.connect('00000000-00000000-00000000-00000001', receiver_mock)
+        self.addCleanup(registry.disconnect, '00000000-00000000-00000000-00000001', receiver_mock)
+        self.addCleanup(latest_values.clear)
+        with patch.object(monitor_dispatcher, 'enqueue', wraps=monitor_dispatcher.enqueue) as enqueue:
+            resp = self.client.put(self.path, body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+        self.assertEqual(resp.status_code, 200)
+        # Handed over in batches while parsing
+        self.assertEqual([len(args[0]) for args, kwargs in enqueue.call_args_list], [100, 100, 50])
+        self.assertTrue(monitor_dispatcher.join(timeout=1))
+        self.assertEqual(receiver_mock.call_count, 250)
+
+        # Refusing a push makes Device Cloud send it all again, so with the
+        # reject policy none of it goes out
+        with patch.object(monitor_dispatcher, 'overflow', dispatch.REJECT):
+            with patch.object(monitor_dispatcher, 'max_size', 150):
+                with patch.object(monitor_dispatcher, 'enqueue', wraps=monitor_dispatcher.enqueue) as enqueue:
+                    resp = self.client.put(self.path, body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+        self.assertEqual(resp.status_code, 503)
+        self.assertFalse(enqueue.called)
+        with patch.object(monitor_dispatcher, 'overflow', dispatch.REJECT):
+            with patch.object(monitor_dispatcher, 'enqueue', wraps=monitor_dispatcher.enqueue) as enqueue:
+                resp = self.client.put(self.path, body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([len(args[0]) for args, kwargs in enqueue.call_args_list], [250])
+        self.assertTrue(monitor_dispatcher.join(timeout=1))
+
+    def test_receiver_refused_publishes_gap(self):
+        device_id = '00000000-00000000-00000000-00000001'
+        msg = self.mon_push_body["Document"]["Msg"]
+        self.addCleanup(recent_datapoints.clear)
+        self.addCleanup(latest_values.clear)
+        with patch.object(pubsub.monitor_bus, 'cluster_wide', True):
+            pubsub.deliver_locally('DataPoint', device_id, msg)
+            self.assertEqual(len(recent_datapoints), 1)
+            with patch.object(pubsub.monitor_bus, 'publish', wraps=pubsub.monitor_bus.publish) as publish:
+                resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+            self.assertEqual(resp.status_code, 503)
+            # Sent to every worker, this one included
+            publish.assert_called_once_with(pubsub.DATAPOINTS_MISSED, device_id, None)
+            self.assertEqual(len(recent_datapoints), 0)
+        # Without a bus reaching every worker, nothing is kept
+        pubsub.deliver_locally('DataPoint', device_id, msg)
+        self.assertEqual(len(recent_datapoints), 0)
+
+    def test_receiver_stores_datapoints(self):
+        receiver_mock = MagicMock()
+        registry = MONITOR_TOPIC_SIGNAL_MAP['DataPoint']
+        registry.connect('00000000-00000000-00000000-00000001', receiver_mock)
+        self.addCleanup(registry.disconnect, '00000000-00000000-00000000-00000001', receiver_mock)
+        self.addCleanup(latest_values.clear)
+        stream_id = 'dia/channel/00000000-00000000-00000000-00000001/DIO/0'
+        with self.settings(DATAPOINT_STORE={'ENABLED': True}):
+            resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+            self.assertEqual(resp.status_code, 200)
+            monitor_dispatcher.join(timeout=1)
+            # Written after the push was acknowledged
+            self.assertTrue(datapoint_store.join(timeout=1))
+            items = list(datapoint_store.query(stream_id, 1377620227161, 1377620227161))
+            self.assertEqual([item.id for item in items], ['1'])
+            # Nobody listening, so the monitor backs off and points are missed
+            registry.disconnect('00000000-00000000-00000000-00000001', receiver_mock)
+            resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+            self.assertEqual(resp.status_code, 503)
+            datapoint_store.join(timeout=1)
+            self.assertIsNone(datapoint_store.query(stream_id, 1377620227161, 1377620227161))
+
+    def test_receiver_malformed_body(self):
+        resp = self.client.put(self.path, '{"Document": {"Msg": [{"topic": "x"}',
+                               content_type='application/json',
+                               **{'HTTP_AUTHORIZATION': self.good_auth_header})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_receiver_no_listeners_invalidates_monitor(self):
+        key = ('user', 'fqdn', 'DataPoint/00000000-00000000-00000000-00000001', 'url')
+        monitor_states.record(key, {}, device_ids=['00000000-00000000-00000000-00000001'])
+        self.addCleanup(monitor_states.clear)
+        resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+        self.assertEqual(resp.status_code, 503)
+        self.assertIsNone(monitor_states.get(key))
+
+    def test_receiver_account_wide_unwatched_device(self):
+        # Another device is being watched, in another account
+        receiver_mock = MagicMock()
+        registry = MONITOR_TOPIC_SIGNAL_MAP['DataPoint']
+        registry.connect('00000000-00000000-00000000-00000002', receiver_mock)
+        self.addCleanup(registry.disconnect, '00000000-00000000-00000000-00000002', receiver_mock)
+        self.addCleanup(monitor_states.clear)
+        with self.settings(MONITOR_DATAPOINT={'MODE': 'account'}):
+            # Without knowing the account, any watched device keeps the push
+            resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+            self.assertEqual(resp.status_code, 200)
+            # As told by another worker
+            pubsub.deliver_locally(pubsub.ACCOUNT_DEVICES, None, ['user', 'fqdn', ['00000000-00000000-00000000-00000001']])
+            pubsub.deliver_locally(pubsub.ACCOUNT_DEVICES, None, ['other', 'fqdn', ['00000000-00000000-00000000-00000002']])
+            resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+            self.assertEqual(resp.status_code, 503)
+            # Now one in the same account
+            pubsub.deliver_locally(pubsub.ACCOUNT_DEVICES, None, ['user', 'fqdn', ['00000000-00000000-00000000-00000002']])
+            resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+            self.assertEqual(resp.status_code, 200)
+        resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+        self.assertEqual(resp.status_code, 503)
+        monitor_dispatcher.join(timeout=1)
+        self.assertFalse(receiver_mock.called)
+
     def test_reciever_other_resource(self):
         other_body = """{
                           "Document": {
@@ -607,11 +1167,242 @@ class MonitorReceiverTest(APITestCase):
                       }"""
         # Register for DataPoint, send something else
         receiver_mock = MagicMock()
-        MONITOR_TOPIC_SIGNAL_MAP['DataPoint']['00000000-00000000-00000000-00000001'].connect(receiver_mock)
+        registry = MONITOR_TOPIC_SIGNAL_MAP['DataPoint']
+        registry.connect('00000000-00000000-00000000-00000001', receiver_mock)
+        # Disconnect explicitly; letting the mock be garbage collected while
+        # connected can deadlock the dispatcher in a later connect()
+        self.addCleanup(registry.disconnect, '00000000-00000000-00000000-00000001', receiver_mock)
         resp = self.client.put(self.path, json.loads(other_body), **{'HTTP_AUTHORIZATION': self.good_auth_header})
         self.assertEqual(resp.status_code, 503)
         self.assertFalse(receiver_mock.called)
 
+    def test_monitor_stats(self):
+        resp = self.client.get(reverse('monitor_stats'))
+        self.assertEqual(resp.status_code, 403)
+        resp = self.client.get(reverse('monitor_stats'), **{'HTTP_AUTHORIZATION': self.good_auth_header})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['capacity'], monitor_dispatcher.max_size)
+        self.assertIn('depth', resp.data)
+        self.assertIn('monitor_batching', resp.data)
+
+
+class SignalRegistryTest(TestCase):
+
+    def setUp(self):
+        self.registry = SignalRegistry(['device_id', 'data'])
+
+    def test_lookup_does_not_create(self):
+        self.assertIsNone(self.registry.get('dev'))
+        self.assertFalse('dev' in self.registry)
+        self.assertEqual(len(self.registry), 0)
+
+    def test_connect_disconnect(self):
+        receiver = MagicMock()
+        self.registry.connect('dev', receiver)
+        self.assertTrue('dev' in self.registry)
+        self.registry.get('dev').send(sender=None, device_id='dev', data=1)
+        receiver.assert_called_once_with(signal=self.registry.get('dev'), sender=None, device_id='dev', data=1)
+
+        self.registry.disconnect('dev', receiver)
+        self.assertEqual(len(self.registry), 0)
+        self.assertEqual(self.registry.stats(),
+                         {'channels': 0, 'receivers': 0, 'created': 1, 'removed': 1})
+
+    def test_garbage_collected_receiver(self):
+        class Receiver(object):
+            def receive(self, **kwargs):
+                pass
+        keep = Receiver()
+        self.registry.connect('kept', keep.receive)
+        self.registry.connect('dropped', Receiver().receive)
+        self.assertIsNone(self.registry.get('dropped'))
+        self.assertEqual(self.registry.stats()['channels'], 1)
+        self.registry.disconnect('kept', keep.receive)
+
+
+class TopicRouterTest(TestCase):
+
+    def setUp(self):
+        self.router = routing.TopicRouter(cache_size=2)
+        self.router.register_subtopic('DataPoint', routing.datapoint_device_id)
+        self.router.register_message('DeviceCore', routing.devicecore_device_id)
+
+    def test_datapoint(self):
+        msg = {'topic': '1/DataPoint/dia/channel/00000000-00000000-00000000-0000000A/DIO/0'}
+        self.assertEqual(self.router.route(msg), ('DataPoint', '00000000-00000000-00000000-0000000A'))
+        # Quoted subtopics are unquoted before matching
+        msg = {'topic': '1/DataPoint/dia%2Fchannel%2F00000000-00000000-00000000-0000000B%2FDIO%2F0'}
+        self.assertEqual(self.router.route(msg), ('DataPoint', '00000000-00000000-00000000-0000000B'))
+        msg = {'topic': '1/DataPoint/dia/channel/nodevice/DIO/0'}
+        self.assertEqual(self.router.route(msg), ('DataPoint', None))
+
+    def test_devicecore_uses_message(self):
+        msg = {'topic': '1/DeviceCore/1234/0', 'DeviceCore': {'devConnectwareId': 'a'}}
+        self.assertEqual(self.router.route(msg), ('DeviceCore', 'a'))
+        # Same topic, different body
+        msg = {'topic': '1/DeviceCore/1234/0', 'DeviceCore': {'devConnectwareId': 'b'}}
+        self.assertEqual(self.router.route(msg), ('DeviceCore', 'b'))
+
+    def test_unknown_and_malformed(self):
+        self.assertEqual(self.router.route({'topic': '1/OtherTopic/'}), ('OtherTopic', None))
+        self.assertEqual(self.router.route({'topic': 'garbage'}), (None, None))
+        self.assertRaises(KeyError, self.router.route, {})
+
+    def test_cache(self):
+        handler = MagicMock(return_value='dev')
+        self.router.register_subtopic('Test', handler)
+        for topic in ['1/Test/a', '1/Test/b', '1/Test/a', '1/Test/c', '1/Test/b']:
+            self.assertEqual(self.router.route({'topic': topic}), ('Test', 'dev'))
+        # a hit, c evicted b, so b was resolved again
+        self.assertEqual([c[0][0] for c in handler.call_args_list], ['a', 'b', 'c', 'b'])
+
+
+class DispatchQueueTest(TestCase):
+
+    def make_queue(self, overflow, **kwargs):
+        self.publish = MagicMock()
+        return dispatch.DispatchQueue(self.publish, max_size=2,
+                                      overflow=overflow, **kwargs)
+
+    def test_dispatch(self):
+        queue = self.make_queue(dispatch.DROP_OLDEST)
+        self.assertTrue(queue.enqueue([('DataPoint', 'dev', {'a': 1})]))
+        self.assertFalse(self.publish.called)
+        self.assertTrue(queue.join(timeout=1))
+        self.publish.assert_called_once_with('DataPoint', 'dev', {'a': 1})
+        self.assertEqual(queue.stats()['dispatched'], 1)
+
+    def test_drop_oldest(self):
+        queue = self.make_queue(dispatch.DROP_OLDEST)
+        events = [('DataPoint', 'dev', {'n': n}) for n in range(3)]
+        self.assertTrue(queue.enqueue(events))
+        queue.join(timeout=1)
+        self.assertEqual([c[0][2]['n'] for c in self.publish.call_args_list], [1, 2])
+        stats = queue.stats()
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['max_depth'], 2)
+
+    def test_drop_reports_missed(self):
+        missed = MagicMock()
+        queue = self.make_queue(dispatch.DROP_OLDEST, missed=missed)
+        queue.enqueue([('DeviceCore', 'other', {}), ('DataPoint', 'dev', {}), ('DataPoint', 'dev2', {})])
+        self.assertFalse(missed.called)
+        queue.enqueue([('DataPoint', 'dev3', {})])
+        missed.assert_called_once_with(set(['dev']))
+        # Devices' recent DataPoints are discarded on every worker
+        with patch.object(pubsub, 'keeps_recent_datapoints', return_value=True):
+            with patch.object(pubsub.monitor_bus, 'publish') as publish:
+                pubsub.publish_datapoints_missed(['dev'])
+        publish.assert_called_once_with(pubsub.DATAPOINTS_MISSED, 'dev', None)
+
+    def test_reject(self):
+        queue = self.make_queue(dispatch.REJECT)
+        events = [('DataPoint', 'dev', {'n': n}) for n in range(3)]
+        self.assertFalse(queue.enqueue(events))
+        self.assertEqual(queue.stats()['rejected'], 3)
+        self.assertTrue(queue.enqueue(events[:2]))
+        queue.join(timeout=1)
+        self.assertEqual(self.publish.call_count, 2)
+
+    def test_block_timeout(self):
+        queue = self.make_queue(dispatch.BLOCK, block_timeout=0.01)
+        # Stall the worker so the queue can't drain
+        self.publish.side_effect = lambda *args: gevent.sleep(1)
+        events = [('DataPoint', 'dev', {'n': n}) for n in range(2)]
+        self.assertTrue(queue.enqueue(events))
+        gevent.sleep(0)
+        # Room for one more, but not the whole push
+        self.assertFalse(queue.enqueue(events))
+        stats = queue.stats()
+        self.assertEqual((stats['enqueued'], stats['rejected']), (2, 2))
+        self.assertFalse(queue.has_room(3))
+
+    def test_block_waits_for_room(self):
+        queue = self.make_queue(dispatch.BLOCK, block_timeout=1)
+        self.publish.side_effect = lambda *args: gevent.sleep(0.01)
+        events = [('DataPoint', 'dev', {'n': n}) for n in range(2)]
+        self.assertTrue(queue.enqueue(events))
+        self.assertTrue(queue.enqueue(events))
+        queue.join(timeout=1)
+        self.assertEqual(self.publish.call_count, 4)
+
+
+class MonitorPubSubTest(TestCase):
+
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.socket_dir, True)
+
+    def test_local_backend(self):
+        deliver = MagicMock(return_value=False)
+        bus = pubsub.LocalBackend(deliver)
+        self.assertFalse(bus.publish('DataPoint', 'dev', {'a': 1}))
+        deliver.assert_called_once_with('DataPoint', 'dev', {'a': 1})
+
+    def test_unix_backend_fan_out(self):
+        deliver_a = MagicMock(return_value=False)
+        deliver_b = MagicMock(return_value=True)
+        bus_a = pubsub.UnixSocketBackend(self.socket_dir, deliver_a)
+        bus_b = pubsub.UnixSocketBackend(self.socket_dir, deliver_b)
+        bus_a.start()
+        bus_b.start()
+        self.addCleanup(bus_a.close)
+        self.addCleanup(bus_b.close)
+
+        # No local listeners, but another worker is present
+        self.assertTrue(bus_a.publish('DataPoint', 'dev', {'a': 1}))
+        gevent.sleep(0.05)
+        deliver_a.assert_called_once_with('DataPoint', 'dev', {'a': 1})
+        deliver_b.assert_called_once_with('DataPoint', 'dev', {'a': 1})
+
+    def test_remote_backend_abstract(self):
+        self.assertRaises(TypeError, pubsub.RemoteBackend)
+
+    def test_unix_backend_advertised_receivers(self):
+        no_receivers = lambda topic, device_id: False
+        bus_a = pubsub.UnixSocketBackend(self.socket_dir, MagicMock(), has_receivers=no_receivers)
+        bus_b = pubsub.UnixSocketBackend(self.socket_dir, MagicMock(), has_receivers=no_receivers,
+                                         list_receivers=lambda: [('DataPoint', 'dev')])
+        bus_a.start()
+        bus_b.start()
+        self.addCleanup(bus_a.close)
+        self.addCleanup(bus_b.close)
+        # Until every worker has had time to advertise, assume they listen
+        self.assertTrue(bus_a.has_subscribers('DataPoint', 'other'))
+        bus_a._started -= bus_a.advertise_ttl
+
+        bus_b.advertise()
+        gevent.sleep(0.05)
+        self.assertTrue(bus_a.has_subscribers('DataPoint', 'dev'))
+        self.assertTrue(bus_a.has_subscribers('DataPoint', None))
+        self.assertFalse(bus_a.has_subscribers('DataPoint', 'other'))
+        self.assertFalse(bus_a.has_subscribers('DeviceCore', None))
+        # Forgotten once the other worker stops advertising them
+        with patch('xbeewifiapp.apps.dashboard.pubsub.time.time', return_value=time.time() + bus_a.advertise_ttl):
+            self.assertFalse(bus_a.has_subscribers('DataPoint', 'dev'))
+
+    def test_postgres_backend_too_large(self):
+        bus = pubsub.PostgresBackend('channel', {}, MagicMock(return_value=False))
+        bus._listen_conn = bus._notify_conn = MagicMock()
+        bus.origin = 'me'
+        with patch.object(bus, 'start'):
+            self.assertFalse(bus.publish('DataPoint', 'dev', {'data': 'x' * 8000}))
+        # Only the other workers being told they missed it got through
+        execute = bus._notify_conn.cursor.return_value.execute
+        self.assertEqual(execute.call_count, 1)
+        payload = json.loads(execute.call_args[0][1][1])
+        self.assertEqual((payload['topic'], payload['device_id']), (pubsub.DATAPOINTS_MISSED, 'dev'))
+
+    def test_unix_backend_stale_socket(self):
+        bus = pubsub.UnixSocketBackend(self.socket_dir, MagicMock(return_value=False))
+        bus.start()
+        self.addCleanup(bus.close)
+        stale_path = os.path.join(self.socket_dir, 'gone.sock')
+        open(stale_path, 'w').close()
+        self.assertFalse(bus.publish('DataPoint', 'dev', {}))
+        self.assertFalse(os.path.exists(stale_path))
+
+
 class MonitorSetupTest(MockedCloudAuthenticatedTestCase):
 
     path = reverse('monitor_setup', kwargs={'device_id': "00000000-00000000-00000000-00000001"})
@@ -667,6 +1458,238 @@ class MonitorSetupTest(MockedCloudAuthenticatedTestCase):
         self.assertTrue(self.patched_put.called)
         self.assertEqual(self.patched_put.call_count, 1)
 
+    def test_setup_reuses_recent_setup(self):
+        resp = self.client.get(self.path)
+        self.assertEqual(resp.status_code, 200)
+        # Another tab opening the same device shortly after
+        resp = self.client.get(self.path)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content)['items'][0]['monId'], "00001")
+        self.assertEqual(self.patched_get.call_count, 1)
+        self.assertEqual(self.patched_put.call_count, 1)
+
+        # Refusing a push means Device Cloud will back off, kick it again
+        monitor_states.invalidate_device('00000000-00000000-00000000-00000001')
+        resp = self.client.get(self.path)
+        self.assertEqual(self.patched_get.call_count, 2)
+        self.assertEqual(self.patched_put.call_count, 2)
+
+
+    def test_setup_account_wide(self):
+        with self.settings(MONITOR_DATAPOINT={'MODE': 'account', 'BATCH_SIZE': 500, 'BATCH_DURATION': 2}):
+            self.patched_get.return_value.json.return_value = {'items': [], 'resultSize': '0'}
+            self.patched_post.return_value.json.return_value = {'post': 'resp'}
+            resp = self.client.get(self.path)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("monTopic='DataPoint' and", self.patched_get.call_args[1]['params']['condition'])
+            self.assertIn('<monTopic>DataPoint</monTopic>', self.patched_post.call_args[1]['data'])
+            self.assertIn('<monBatchSize>500</monBatchSize>', self.patched_post.call_args[1]['data'])
+
+            # Other devices share the same monitor
+            other_path = reverse('monitor_setup', kwargs={'device_id': "00000000-00000000-00000000-00000002"})
+            resp = self.client.get(other_path)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(self.patched_get.call_count, 1)
+            self.assertEqual(self.patched_post.call_count, 1)
+
+
+class MonitorStateCacheTest(TestCase):
+
+    key = ('user', 'fqdn', 'DataPoint/dev', 'url')
+
+    def test_account_devices(self):
+        cache = MonitorStateCache(max_size=2)
+        self.assertIsNone(cache.account_devices(['dev']))
+        cache.record(self.key, {}, device_ids=['dev'])
+        cache.add_account_devices(('user', 'fqdn'), ['dev2'])
+        cache.add_account_devices(('other', 'fqdn'), ['dev3'])
+        self.assertEqual(cache.account_devices(['dev2']), set(['dev', 'dev2']))
+        # A device moved to another account
+        cache.add_account_devices(('other', 'fqdn'), ['dev2'])
+        self.assertEqual(cache.account_devices(['dev']), set(['dev']))
+        self.assertEqual(cache.account_devices(['dev2']), set(['dev2', 'dev3']))
+        # Least recently added to accounts are forgotten
+        cache.add_account_devices(('third', 'fqdn'), ['dev4'])
+        self.assertIsNone(cache.account_devices(['dev']))
+
+    @patch('xbeewifiapp.apps.dashboard.monitors.time.time')
+    def test_kick_interval_and_pushes(self, mock_time):
+        cache = MonitorStateCache(min_kick_interval=60, push_timeout=300)
+        mock_time.return_value = 1000
+        cache.record(self.key, {'info': 1}, monitor_id='1', device_ids=['dev'])
+        mock_time.return_value = 1059
+        self.assertEqual(cache.get(self.key)['info'], {'info': 1})
+        mock_time.return_value = 1060
+        self.assertIsNone(cache.get(self.key))
+
+        # DeviceCore pushes say nothing about the DataPoint monitor
+        cache.note_push(summarize_push([('DeviceCore', 'dev', None)]))
+        self.assertIsNone(cache.get(self.key))
+        # Pushes arriving keep it alive past the kick interval
+        cache.note_push(summarize_push([('DataPoint', 'dev', None)]))
+        mock_time.return_value = 1359
+        self.assertIsNotNone(cache.get(self.key))
+        mock_time.return_value = 1360
+        self.assertIsNone(cache.get(self.key))
+
+    def test_invalidate_and_size(self):
+        cache = MonitorStateCache(max_size=1)
+        cache.record(self.key, {}, device_ids=['dev'])
+        cache.invalidate_device('dev')
+        self.assertIsNone(cache.get(self.key))
+        cache.record(self.key, {}, device_ids=['dev'])
+        cache.record(('user', 'fqdn', 'DeviceCore', 'url'), {})
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.get(self.key))
+
+    @patch('xbeewifiapp.apps.dashboard.monitors.time.time')
+    def test_take_stats(self, mock_time):
+        cache = MonitorStateCache()
+        mock_time.return_value = 1000
+        cache.record(self.key, {}, monitor_id='1', device_ids=['dev'],
+                     batch_size=100, batch_duration=1)
+        cache.note_push(summarize_push([('DataPoint', 'dev', 2.0), ('DataPoint', 'dev', 4.0),
+                                        ('DataPoint', 'other', 9.0)]))
+        cache.note_push(summarize_push([('DataPoint', 'dev', None)]))
+        mock_time.return_value = 1010
+
+        [(key, stats)] = cache.take_stats()
+        self.assertEqual(key, self.key)
+        self.assertEqual(stats['push_rate'], 0.2)
+        self.assertEqual(stats['message_rate'], 0.3)
+        self.assertEqual(stats['latency_mean'], 3.0)
+        self.assertEqual(stats['latency_max'], 4.0)
+        self.assertEqual(stats['batch_size'], 100)
+        self.assertTrue(stats['owned'])
+
+        # Window restarts
+        mock_time.return_value = 1020
+        [(key, stats)] = cache.take_stats()
+        self.assertEqual(stats['message_rate'], 0)
+        self.assertIsNone(stats['latency_max'])
+
+
+class MonitorBatchTunerTest(TestCase):
+
+    key = ('user', 'fqdn', 'DataPoint/dev', 'url')
+
+    def setUp(self):
+        self.states = MonitorStateCache()
+        self.conn = MagicMock()
+        self.connectors = MagicMock()
+        self.connectors.find.return_value = self.conn
+        self.tuner = MonitorBatchTuner(
+            self.states, self.connectors, min_duration=1, max_duration=10,
+            max_latency=10, busy_rate=50, min_size=10, max_size=1000)
+
+    def push(self, topic, count):
+        self.states.note_push(summarize_push([(topic, 'dev', 0.5)] * count))
+
+    def test_recommend(self):
+        # Quiet monitors deliver quickly
+        self.assertEqual(self.tuner.recommend(0.1, 1.0, 10), (10, 1))
+        # Busy monitors batch up to the limits
+        self.assertEqual(self.tuner.recommend(25, 1.0, 1), (300, 6))
+        self.assertEqual(self.tuner.recommend(500, 1.0, 1), (1000, 10))
+        # Latency over budget shortens the current duration
+        self.assertEqual(self.tuner.recommend(500, 13.0, 10), (1000, 7))
+        self.assertEqual(self.tuner.recommend(500, 35.0, 10), (1000, 1))
+
+    def test_duration_within_latency(self):
+        # A batch held longer than the latency budget would always be late
+        self.assertRaises(ValueError, MonitorBatchTuner, self.states, self.connectors,
+                          max_duration=10, max_latency=5)
+
+    @patch('xbeewifiapp.apps.dashboard.monitors.time.time')
+    def test_tune(self, mock_time):
+        conn = self.conn
+        mock_time.return_value = 1000
+        self.states.record(self.key, {}, monitor_id='5', device_ids=['dev'],
+                           batch_size=1000, batch_duration=1)
+        self.push('DataPoint', 600)
+        mock_time.return_value = 1060
+
+        self.tuner.tune()
+        # The account's connector is looked up when the monitor is changed
+        self.connectors.find.assert_called_once_with('user', 'fqdn')
+        conn.set_monitor_batching.assert_called_once_with('5', 60, 3)
+        [result] = self.tuner.stats()
+        self.assertEqual(result['topic'], 'DataPoint/dev')
+        self.assertEqual(result['message_rate'], 10)
+        self.assertEqual(result['recommended_duration'], 3)
+
+        # Unchanged recommendation, or no traffic, doesn't touch the monitor
+        conn.reset_mock()
+        self.push('DataPoint', 600)
+        mock_time.return_value = 1120
+        self.tuner.tune()
+        mock_time.return_value = 1180
+        self.tuner.tune()
+        self.assertFalse(conn.set_monitor_batching.called)
+
+    @patch('xbeewifiapp.apps.dashboard.monitors.time.time')
+    def test_tune_devicecore(self, mock_time):
+        key = ('user', 'fqdn', 'DeviceCore', 'url')
+        mock_time.return_value = 1000
+        self.states.record(key, {}, monitor_id='7', device_ids=['dev'],
+                           batch_size=1000, batch_duration=1)
+        self.push('DeviceCore', 600)
+        mock_time.return_value = 1060
+        self.tuner.tune()
+        self.conn.set_monitor_batching.assert_called_once_with('7', 60, 3)
+
+    @patch('xbeewifiapp.apps.dashboard.monitors.time.time')
+    def test_tune_only_owned(self, mock_time):
+        mock_time.return_value = 1000
+        self.states.record(self.key, {}, monitor_id='5', device_ids=['dev'],
+                           batch_size=1000, batch_duration=1)
+        # Another worker set the monitor up since
+        self.states.disown(self.key)
+        self.push('DataPoint', 600)
+        mock_time.return_value = 1060
+        self.tuner.tune()
+        self.assertFalse(self.conn.set_monitor_batching.called)
+        self.assertEqual(self.tuner.stats()[0]['recommended_duration'], 3)
+
+        # Nor without a connector for the account
+        self.states.record(self.key, {}, monitor_id='5', device_ids=['dev'],
+                           batch_size=1000, batch_duration=1)
+        self.connectors.find.return_value = None
+        self.push('DataPoint', 600)
+        mock_time.return_value = 1120
+        self.tuner.tune()
+        self.assertFalse(self.conn.set_monitor_batching.called)
+
+    def test_shared_over_bus(self):
+        self.addCleanup(monitor_states.clear)
+        monitor_states.record(self.key, {}, monitor_id='5', device_ids=['dev'])
+        # Pushes accepted by other workers are counted too
+        pubsub.deliver_locally(pubsub.MONITOR_PUSHED, None,
+                               summarize_push([('DataPoint', 'dev', 0.5)] * 3))
+        [(key, stats)] = monitor_states.take_stats()
+        self.assertGreater(stats['message_rate'], 0)
+        self.assertTrue(stats['owned'])
+        # As are their monitor setups, which take tuning over
+        pubsub.deliver_locally(pubsub.MONITOR_SET_UP, None, list(self.key))
+        [(key, stats)] = monitor_states.take_stats()
+        self.assertFalse(stats['owned'])
+
+    @patch('xbeewifiapp.apps.dashboard.monitors.time.time')
+    def test_tune_error(self, mock_time):
+        conn = self.conn
+        conn.set_monitor_batching.side_effect = ConnectionError()
+        mock_time.return_value = 1000
+        self.states.record(self.key, {}, monitor_id='5', device_ids=['dev'],
+                           batch_size=1000, batch_duration=1)
+        self.push('DataPoint', 600)
+        mock_time.return_value = 1060
+
+        self.tuner.tune()
+        # Settings unchanged, so the next pass tries again
+        [(key, stats)] = self.states.take_stats()
+        self.assertEqual(stats['batch_duration'], 1)
+
+
 class MonitorDeviceCoreSetupTest(MockedCloudAuthenticatedTestCase):
 
     path = reverse('monitor_setup_devicecore')
@@ -709,10 +1732,20 @@ class MonitorDeviceCoreSetupTest(MockedCloudAuthenticatedTestCase):
 
 
     def test_setup_existing_monitor(self):
+        session = self.client.session
+        session['user_devices'] = ['00000000-00000000-00000000-00000001']
+        session.save()
         resp = self.client.get(self.path)
         self.assertEqual(resp.status_code, 200)
         json_resp = json.loads(resp.content)
         self.assertEqual(json_resp['items'][0]['monTopic'], "DeviceCore")
+        # Remembered with what's needed to tune its batching
+        [(key, stats)] = monitor_states.take_stats()
+        self.assertEqual(key[2], 'DeviceCore')
+        self.assertEqual((stats['monitor_id'], stats['batch_size'], stats['batch_duration']),
+                         (json_resp['items'][0]['monId'], 1, 0))
+        monitor_states.note_push(summarize_push([('DeviceCore', '00000000-00000000-00000000-00000001', None)]))
+        self.assertGreater(monitor_states.take_stats()[0][1]['message_rate'], 0)
 
         self.assertTrue(self.patched_get.called)
         self.assertEqual(self.patched_get.call_count, 1)
@@ -763,6 +1796,145 @@ class DeviceNamespaceTest(TestCase):
         self.ns.process_packet(pkt)
         assert self.environ['socketio'].error.called
 
+    def test_device_data_batched(self):
+        self.ns.emit = MagicMock()
+        self.ns.request = MagicMock()
+        self.ns.initialize()
+        self.ns.monitored_devices.add('dev')
+        self.ns.device_data_receiver(device_id='dev', data={'a': 1})
+        self.ns.device_data_receiver(device_id='dev', data={'a': 2})
+        self.ns.device_data_receiver(device_id='other', data={'a': 3})
+        self.assertFalse(self.ns.emit.called)
+        self.ns.data_buffer.flush()
+        self.ns.emit.assert_called_once_with('device_data_batch', [{'a': 1}, {'a': 2}])
+
+
+    def test_send_latest_values(self):
+        self.ns.emit = MagicMock()
+        self.ns.request = MagicMock()
+        self.ns.initialize()
+        point = {'DataPoint': {'streamId': 'dev/DIO/0', 'data': 1}}
+        latest_values.update('dev', point)
+        self.addCleanup(latest_values.clear)
+        self.ns.send_latest_values('dev')
+        self.ns.emit.assert_called_once_with('device_data_batch', [point])
+        self.ns.emit.reset_mock()
+        self.ns.send_latest_values('other')
+        self.assertFalse(self.ns.emit.called)
+
+
+class LatestValueCacheTest(TestCase):
+
+    def point(self, stream, value, timestamp):
+        return {'DataPoint': {'streamId': stream, 'data': value, 'timestamp': timestamp}}
+
+    def test_latest_per_stream(self):
+        cache = LatestValueCache()
+        cache.update('dev', self.point('dev/DIO/1', 0, 1))
+        cache.update('dev', self.point('dev/DIO/0', 0, 1))
+        cache.update('dev', self.point('dev/DIO/0', 1, 3))
+        # Late arrival of an older value is ignored
+        cache.update('dev', self.point('dev/DIO/0', 2, 2))
+        cache.update('dev', {'bad': 'message'})
+        self.assertEqual(cache.snapshot('dev'),
+                         [self.point('dev/DIO/0', 1, 3), self.point('dev/DIO/1', 0, 1)])
+        self.assertEqual(cache.snapshot('other'), [])
+
+    def test_max_devices(self):
+        cache = LatestValueCache(max_devices=2)
+        cache.update('a', self.point('a/DIO/0', 0, 1))
+        cache.update('b', self.point('b/DIO/0', 0, 1))
+        cache.update('a', self.point('a/DIO/0', 1, 2))
+        cache.update('c', self.point('c/DIO/0', 0, 1))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.snapshot('b'), [])
+        self.assertEqual(cache.snapshot('a'), [self.point('a/DIO/0', 1, 2)])
+
+
+class PushMessageStreamTest(TestCase):
+
+    def parse(self, body, chunk_size=3):
+        return list(PushMessageStream(StringIO(body), chunk_size=chunk_size))
+
+    def test_message_list(self):
+        body = json.dumps({"Other": [1, {"Msg": 2}],
+                           "Document": {"x": "Msg", "Msg": [{"a": 1}, {"b": [12345, u"\u00e9"]}, 67890],
+                                        "after": 1}})
+        for chunk_size in (1, 3, 8192):
+            self.assertEqual(self.parse(body, chunk_size), [{"a": 1}, {"b": [12345, u"\u00e9"]}, 67890])
+
+    def test_single_and_empty(self):
+        self.assertEqual(self.parse(' { "Document" : { "Msg" : { "a" : 1 } } } '), [{"a": 1}])
+        self.assertEqual(self.parse('{"Document": {"Msg": []}}'), [])
+
+    def test_incremental(self):
+        body = StringIO('{"Document": {"Msg": [{"a": 1}, ' + '{"b": 2}, ' * 1000 + '{"c": 3}]}}')
+        messages = PushMessageStream(body, chunk_size=64)
+        self.assertEqual(next(messages), {"a": 1})
+        self.assertLess(body.tell(), 128)
+
+    def test_malformed(self):
+        for body in ('', '[]', '{"Document": {}}', '{"Msg": []}', '{"Document": {"Msg": [{"a": 1}',
+                     '{"Document": {"Msg": [{"a": 1} {"b": 2}]}}', '{"Document": {"Msg": [{"a": }]}}'):
+            self.assertRaises(ParseError, self.parse, body)
+
+
+class CoalescingEmitterTest(TestCase):
+
+    def point(self, stream, value):
+        return {'DataPoint': {'streamId': stream, 'data': value}}
+
+    def test_window(self):
+        emit = MagicMock()
+        emitter = outbound.CoalescingEmitter(emit, 'batch', window=0.01)
+        for n in range(5):
+            emitter.add(self.point('dev/DIO/0', n))
+        self.assertFalse(emit.called)
+        gevent.sleep(0.05)
+        emit.assert_called_once_with('batch', [self.point('dev/DIO/0', n) for n in range(5)])
+
+    def test_max_rate(self):
+        emit = MagicMock()
+        emitter = outbound.CoalescingEmitter(emit, 'batch', window=0.001, max_rate=10)
+        emitter.add(1)
+        gevent.sleep(0.02)
+        emitter.add(2)
+        gevent.sleep(0.02)
+        # Second batch waits out the rest of the 100ms interval
+        self.assertEqual(emit.call_count, 1)
+        gevent.sleep(0.1)
+        self.assertEqual(emit.call_count, 2)
+
+    def test_merge(self):
+        emitter = outbound.CoalescingEmitter(MagicMock(), 'batch', max_pending=3)
+        self.addCleanup(emitter.close)
+        for n in range(3):
+            emitter.add(self.point('dev/DIO/0', n))
+        emitter.add(self.point('dev/DIO/1', 0))
+        self.assertEqual(emitter._pending, [self.point('dev/DIO/0', 2), self.point('dev/DIO/1', 0)])
+        self.assertEqual(emitter.merged, 2)
+
+    def test_drop(self):
+        emitter = outbound.CoalescingEmitter(MagicMock(), 'batch', max_pending=2,
+                                             overflow=outbound.DROP)
+        self.addCleanup(emitter.close)
+        for n in range(3):
+            emitter.add(self.point('dev/DIO/0', n))
+        self.assertEqual(emitter._pending, [self.point('dev/DIO/0', 1), self.point('dev/DIO/0', 2)])
+        self.assertEqual(emitter.dropped, 1)
+
+    def test_backlog(self):
+        emit = MagicMock()
+        backlog = MagicMock(return_value=1)
+        emitter = outbound.CoalescingEmitter(emit, 'batch', window=0.01, backlog=backlog)
+        self.addCleanup(emitter.close)
+        emitter.add(1)
+        gevent.sleep(0.03)
+        self.assertFalse(emit.called)
+        backlog.return_value = 0
+        gevent.sleep(0.1)
+        emit.assert_called_once_with('batch', [1])
+
 # ******************************
 #            API Browser
 # ******************************
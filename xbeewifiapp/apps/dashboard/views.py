@@ -8,11 +8,13 @@
 
 import logging
 from django.shortcuts import render_to_response
+from django.http import StreamingHttpResponse
+from django.db import DatabaseError
 from django.contrib.auth import get_user_model
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
 from django.contrib.auth import login, logout, authenticate
 from rest_framework.decorators import api_view, authentication_classes,\
-    permission_classes
+    permission_classes, parser_classes
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
@@ -23,17 +25,37 @@ from models import Dashboard
 from serializers import DashboardSerializer, UserSerializer
 from permissions import IsOwner
 from authentication import MonitorBasicAuthentication
+from parsers import MonitorPushParser, PushMessageStream
 from django.conf import settings
+from pubsub import monitor_bus, keeps_recent_datapoints, \
+    publish_datapoints_missed, publish_account_devices, MONITOR_PUSHED, \
+    MONITOR_SET_UP, DEVICE_CHANGED
 from signals import MONITOR_TOPIC_SIGNAL_MAP
+from dispatch import monitor_dispatcher
+from routing import topic_router
+from monitors import monitor_states, summarize_push
+from batching import monitor_tuner
+from store import datapoint_store
+from recent import recent_datapoints
 from util import get_credentials, is_key_in_nested_dict
-from xbeewifiapp.libs.digi.devicecloud import DeviceCloudConnector
+from xbeewifiapp.libs.digi.connections import get_connector
+from xbeewifiapp.libs.digi.datapoint import DataPoint
+from xbeewifiapp.libs.digi.devicecloud import DATAPOINT_PAGE_SIZE, \
+    ROLLUP_INTERVALS
+from xbeewifiapp.libs.digi.concurrency import AsyncConnector, \
+    device_commands, wait_all
 from requests.exceptions import HTTPError, ConnectionError
 import re
 from datetime import datetime, timedelta
-from urllib import unquote
 from distutils.util import strtobool
 import base64
-from xbee import compare_config_with_stock
+import json
+import time
+import gevent
+from gevent.pool import Pool
+import calendar
+from xbee import compare_config_with_stock, XBEE_KIT_CONFIG
+import downsample
 
 logger = logging.getLogger(__name__)
 
@@ -56,6 +78,7 @@ def socket_test(request):
 @api_view(['PUT'])
 @authentication_classes((MonitorBasicAuthentication,))
 @permission_classes(())
+@parser_classes((MonitorPushParser,))
 def monitor_receiver(request):
     """
     Push Monitor endpoint - Recieves data from Device Cloud
@@ -65,92 +88,195 @@ def monitor_receiver(request):
     # Further restrict only to the device cloud user specified in settings
     # Note that this User object is a one-off, where we set the credentials
     # directly in special basic auth class and is not persisted to the db
-    secret_user = settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER
-    secret_pass = settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS
-    if (request.user.username != secret_user
-            or request.user.password != secret_pass):
+    if not is_monitor_user(request.user):
         return Response(status=status.HTTP_403_FORBIDDEN)
 
     logger.info('Recieved Device Cloud Push')
 
-    # Iterate through payload, sending messages keyed off topic
-    try:
-        messages = request.DATA['Document']['Msg']
-    except KeyError:
+    # Messages are parsed from the body one at a time, as they are read
+    messages = request.DATA
+    if not isinstance(messages, PushMessageStream):
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
-    # Msg may be a list or object, depending on if multiple events.
-    # Handle single case by making list of len 1
-    if type(messages) is not list:
-        messages = [messages]
-
-    monitor_has_listeners = False
+    batch_size = settings.MONITOR_PUSH_STREAMING.get('DISPATCH_BATCH', 100)
+    store = datapoint_store.enabled
+    events = []
+    pushed = []
+    points = []
+    device_ids = set()
+    changed = set()
+    queued = False
+    datapoint_filtered = False
     for msg in messages:
+        # Each topic may be handled differently. For example, datapoint events
+        # are keyed off device id
         try:
-            topic_full = msg['topic']
+            (topic, device_id) = topic_router.route(msg)
         except KeyError:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        # reported topics come in a /##/Topic/Sub/topic/...,
-        # grab parts we care about
-        (topic, subtopic) = topic_full.split('/', 2)[1:]
-        subtopic = unquote(subtopic)
-
-        try:
-            signal_map = MONITOR_TOPIC_SIGNAL_MAP[topic]
-        except KeyError:
-            logger.warning(
-                'No signal map exists for monitor topic %s!' % topic)
-
-        # Each topic may be handled differently. For example, datapoint signals
-        # are keyed off device id
-        signal = None
-        args = {}
-
-        if topic == 'DataPoint':
-            # Attempt to extract a device_id from the subtopic
-            reg_pattern = "\S*(?P<dev_id>((-?([0-9A-F]{8})){4}))"
-            match = re.match(reg_pattern, subtopic)
-            if match:
-                device_id = match.groupdict()['dev_id']
-                signal = signal_map[device_id]
-                args['device_id'] = device_id
-                args['data'] = msg
-            else:
-                logger.warning(
-                    'Error - No deviceId found in DataPoint subtopic!')
-        elif topic == 'DeviceCore':
-            # Device id not in topic, need to parse out from
-            # message body directly...
-            try:
-                device_id = msg['DeviceCore']['devConnectwareId']
-                signal = signal_map[device_id]
-                args['device_id'] = device_id
-                args['data'] = msg
-            except KeyError:
-                logger.warning('No DeviceId found in DeviceCore event')
-        else:
-            logger.warning('No handler for push topic type %s!' % topic)
-
-        # If we have no receivers, monitor should be marked inactive
-        # As of 2.10, Device Cloud will retry up to 16 min apart over 24 hours,
-        # then flag
-        if signal is not None and len(signal.receivers):
-            monitor_has_listeners = True
-            logger.debug(
-                "%d registered receivers found for this push, sending signal"
-                % len(signal.receivers))
-            signal.send_robust(sender=None, **args)
-
-    if monitor_has_listeners:
-        logger.info('Push event with receivers handled')
+        if device_id is None:
+            continue
+        device_ids.add(device_id)
+        if topic == 'DeviceCore' and device_id not in changed:
+            # Cached listings of the device no longer hold, on any worker
+            changed.add(device_id)
+            monitor_bus.publish(DEVICE_CHANGED, device_id, None)
+        elif topic == 'DataPoint' and store:
+            points.append((device_id, DataPoint.from_dict(msg['DataPoint'])))
+        if monitor_bus.has_subscribers(topic, device_id):
+            events.append((topic, device_id, msg))
+            pushed.append((topic, device_id, push_latency(topic, msg)))
+        elif topic == 'DataPoint':
+            datapoint_filtered = True
+
+        if len(events) >= batch_size and monitor_dispatcher.streams:
+            # Start fanning out the front of a large push while the rest is
+            # read
+            if not monitor_dispatcher.enqueue(events):
+                return dispatch_refused(device_ids, messages)
+            queued = True
+            events = []
+        elif events and len(events) % batch_size == 0 and \
+                not monitor_dispatcher.has_room(len(events)):
+            # Refused before any of it goes out, as Device Cloud retries the
+            # whole push
+            return dispatch_refused(device_ids, messages)
+
+    if not queued and not events and datapoint_filtered and \
+            account_wide_datapoints() and account_watched(device_ids):
+        # An account-wide monitor pushes data for devices nobody is watching.
+        # Refusing it would also hold up data for the account's devices that
+        # are being watched.
+        logger.info('Push event for unmonitored devices discarded')
+        if points:
+            datapoint_store.record_later(points)
         return Response()
-    else:
+
+    # If we have no receivers, monitor should be marked inactive
+    # As of 2.10, Device Cloud will retry up to 16 min apart over 24 hours,
+    # then flag
+    if not queued and not events:
         # TODO what status code to return? DC will use anything > 3xx
         logger.info("Received a push with no receivers, responding with 503 " +
                     "to make monitor inactive")
+        monitor_unavailable(device_ids)
         return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
+    # Fan out in the background, Device Cloud doesn't need to wait on sockets
+    if events and not monitor_dispatcher.enqueue(events):
+        return dispatch_refused(device_ids, messages)
+
+    # Counted by every worker, as any of them may be tuning the monitors
+    monitor_bus.publish(MONITOR_PUSHED, None, summarize_push(pushed))
+    # Only kept once accepted, so a push Device Cloud retries isn't stored
+    # twice
+    if points:
+        datapoint_store.record_later(points)
+
+    logger.info('Push event with receivers queued')
+    return Response()
+
+
+def dispatch_refused(device_ids, messages):
+    """
+    Respond to a push the dispatch queue has no room for. Messages not yet
+    read from the push are routed only to find the devices they cover.
+    """
+    logger.info('Monitor dispatch queue full, responding with 503')
+    for msg in messages:
+        try:
+            (topic, device_id) = topic_router.route(msg)
+        except KeyError:
+            continue
+        if device_id is not None:
+            device_ids.add(device_id)
+    monitor_unavailable(device_ids)
+    return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+def push_latency(topic, msg):
+    """
+    Seconds since Device Cloud received a pushed DataPoint, or None
+    """
+    if topic != 'DataPoint':
+        return None
+    try:
+        return time.time() - int(msg['DataPoint']['serverTimestamp']) / 1000.0
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def account_wide_datapoints():
+    """
+    True if DataPoints are monitored with one monitor per account, rather
+    than one per device
+    """
+    return settings.MONITOR_DATAPOINT.get('MODE') == 'account'
+
+
+def account_watched(device_ids):
+    """
+    True if DataPoints of any device in the account these devices belong to
+    may have subscribers
+    """
+    account_devices = monitor_states.account_devices(device_ids)
+    if account_devices is None:
+        # No worker has told us the account, e.g. since this one started.
+        # Refusing the push could stop data for devices watched elsewhere.
+        return monitor_bus.has_subscribers('DataPoint', None)
+    return any(monitor_bus.has_subscribers('DataPoint', device_id)
+               for device_id in account_devices)
+
+
+def monitor_unavailable(device_ids):
+    """
+    Device Cloud backs off or deactivates monitors whose pushes we refuse, so
+    the next monitor setup for these devices must kick them again
+    """
+    for device_id in device_ids:
+        monitor_states.invalidate_device(device_id)
+    # Every worker's recent DataPoints now have a gap
+    publish_datapoints_missed(device_ids)
+    # Points are missed until pushes are accepted again
+    if datapoint_store.enabled:
+        datapoint_store.invalidate_later(device_ids)
+
+
+@api_view(['GET'])
+@authentication_classes((MonitorBasicAuthentication,))
+@permission_classes(())
+def monitor_stats(request):
+    """
+    Monitor dispatch queue and signal registry metrics for the worker
+    handling this request
+    """
+    if not is_monitor_user(request.user):
+        return Response(status=status.HTTP_403_FORBIDDEN)
+    stats = monitor_dispatcher.stats()
+    stats['signals'] = dict((topic, registry.stats()) for topic, registry
+                            in MONITOR_TOPIC_SIGNAL_MAP.items())
+    stats['monitor_setups'] = {
+        'cached': len(monitor_states),
+        'hits': monitor_states.hits,
+        'misses': monitor_states.misses,
+    }
+    stats['monitor_batching'] = monitor_tuner.stats()
+    stats['recent_datapoints'] = {
+        'streams': len(recent_datapoints),
+        'hits': recent_datapoints.hits,
+        'misses': recent_datapoints.misses,
+    }
+    return Response(stats)
+
+
+def is_monitor_user(user):
+    """
+    Check for the Device Cloud monitor user specified in settings
+    """
+    return (user.username == settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER
+            and user.password == settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS)
+
 
 # *************
 
@@ -170,7 +296,7 @@ def monitor_setup(request, device_id):
     if not username or not password or not cloud_fqdn:
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
-    conn = DeviceCloudConnector(username, password, cloud_fqdn)
+    conn = get_connector(username, password, cloud_fqdn)
 
     endpoint_url = reverse(monitor_receiver, request=request)
     # Device cloud won't allow monitors pointing to localhost, etc,
@@ -179,8 +305,32 @@ def monitor_setup(request, device_id):
         logger.error('Rejecting attempt to create monitor to ' + endpoint_url)
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
+    # One monitor may cover every device in the account
+    if account_wide_datapoints():
+        monitor_device = None
+        topic = 'DataPoint'
+    else:
+        monitor_device = device_id
+        topic = 'DataPoint/' + device_id
+
+    # The account's DeviceCore monitor also pushes for this device
+    monitor_states.add_device(
+        (username, cloud_fqdn, 'DeviceCore', endpoint_url), device_id)
+    publish_account_devices(username, cloud_fqdn, [device_id])
+
+    # Reuse a recent setup of this monitor, e.g. from another browser tab
+    cache_key = (username, cloud_fqdn, topic, endpoint_url)
+    state = monitor_states.get(cache_key)
+    if state is not None:
+        monitor_states.add_device(cache_key, device_id)
+        return Response(data=state['info'])
+
+    monitor_settings = settings.MONITOR_DATAPOINT
+    batch_size = monitor_settings.get('BATCH_SIZE', 1000)
+    batch_duration = monitor_settings.get('BATCH_DURATION', 1)
+    monitor_id = None
     try:
-        monitors = conn.get_datapoint_monitor_for_device(device_id,
+        monitors = conn.get_datapoint_monitor_for_device(monitor_device,
                                                          endpoint_url)
 
         if monitors['resultSize'] == "0":
@@ -189,14 +339,17 @@ def monitor_setup(request, device_id):
             # NOTE: The full url is generated by information passed in the
             # request. If the same backend is being routed to from multiple
             # places (reverse proxies, etc), each will generate a different url
-            logger.info('Creating a new DataPoint monitor for device %s'
-                        % device_id)
+            logger.info('Creating a new %s monitor for device %s'
+                        % (topic, device_id))
             resp = conn.create_datapoint_monitor(
-                device_id,
+                monitor_device,
                 endpoint_url,
                 settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER,
                 settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS,
-                description="XBee Wi-Fi Cloud Kit Monitor")
+                description="XBee Wi-Fi Cloud Kit Monitor",
+                batch_size=batch_size,
+                batch_duration=batch_duration)
+            monitor_id = created_monitor_id(resp)
         else:
             # Should only have one monitor for a given device/topic
             if len(monitors['items']) > 1:
@@ -204,11 +357,13 @@ def monitor_setup(request, device_id):
                                "This should not happen!")
 
             monitor = monitors['items'][0]
+            monitor_id = monitor['monId']
+            batch_size, batch_duration = monitor_batching(monitor)
             logger.info(
-                'Found an existing DataPoint monitor for %s, kicking it'
-                % device_id)
+                'Found an existing %s monitor for %s, kicking it'
+                % (topic, device_id))
             conn.kick_monitor(
-                monitor['monId'],
+                monitor_id,
                 settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER,
                 settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS)
             # Return the original info
@@ -219,9 +374,41 @@ def monitor_setup(request, device_id):
     except ConnectionError, e:
         return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
+    # Other workers leave this monitor's batching to us from now on
+    monitor_bus.publish(MONITOR_SET_UP, None, cache_key)
+    monitor_states.record(cache_key, resp, monitor_id=monitor_id,
+                          device_ids=[device_id], batch_size=batch_size,
+                          batch_duration=batch_duration)
+    if settings.MONITOR_BATCH_TUNING.get('ENABLED'):
+        monitor_tuner.start()
     return Response(data=resp)
 
 
+def created_monitor_id(resp):
+    """
+    Parse the monId out of a monitor creation response (location is of the
+    form Monitor/<monId>)
+    """
+    try:
+        return resp['location'].rsplit('/', 1)[-1] or None
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+def monitor_batching(monitor):
+    """
+    Return (monBatchSize, monBatchDuration) of a monitor from Device Cloud,
+    as ints, or None for values which are missing
+    """
+    values = []
+    for field in ('monBatchSize', 'monBatchDuration'):
+        try:
+            values.append(int(monitor[field]))
+        except (KeyError, TypeError, ValueError):
+            values.append(None)
+    return tuple(values)
+
+
 @api_view(['GET'])
 def monitor_devicecore_setup(request):
     """
@@ -238,7 +425,7 @@ def monitor_devicecore_setup(request):
     if not username or not password or not cloud_fqdn:
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
-    conn = DeviceCloudConnector(username, password, cloud_fqdn)
+    conn = get_connector(username, password, cloud_fqdn)
 
     endpoint_url = reverse(monitor_receiver, request=request)
     # Device cloud won't allow monitors pointing to localhost, etc,
@@ -247,6 +434,14 @@ def monitor_devicecore_setup(request):
         logger.error('Rejecting attempt to create monitor to ' + endpoint_url)
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
+    cache_key = (username, cloud_fqdn, 'DeviceCore', endpoint_url)
+    state = monitor_states.get(cache_key)
+    if state is not None:
+        return Response(data=state['info'])
+
+    batch_size = 1000
+    batch_duration = 1
+    monitor_id = None
     try:
         monitors = conn.get_devicecore_monitor(endpoint_url)
 
@@ -263,7 +458,10 @@ def monitor_devicecore_setup(request):
                 endpoint_url,
                 settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER,
                 settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS,
-                description="XBee Wi-Fi Cloud Kit Monitor")
+                description="XBee Wi-Fi Cloud Kit Monitor",
+                batch_size=batch_size,
+                batch_duration=batch_duration)
+            monitor_id = created_monitor_id(resp)
         else:
             # Should only have one monitor for a given device/topic
             if len(monitors['items']) > 1:
@@ -271,10 +469,12 @@ def monitor_devicecore_setup(request):
                                "This should not happen!" % username)
 
             monitor = monitors['items'][0]
+            monitor_id = monitor['monId']
+            batch_size, batch_duration = monitor_batching(monitor)
             logger.info(
                 'Found an existing DeviceCore monitor for user, kicking it')
             conn.kick_monitor(
-                monitor['monId'],
+                monitor_id,
                 settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER,
                 settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS)
             # Return the original info
@@ -285,6 +485,14 @@ def monitor_devicecore_setup(request):
     except ConnectionError, e:
         return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
+    # Pushes are counted against the account's devices, as far as known
+    monitor_bus.publish(MONITOR_SET_UP, None, cache_key)
+    monitor_states.record(cache_key, resp, monitor_id=monitor_id,
+                          device_ids=request.session.get('user_devices', []),
+                          batch_size=batch_size,
+                          batch_duration=batch_duration)
+    if settings.MONITOR_BATCH_TUNING.get('ENABLED'):
+        monitor_tuner.start()
     return Response(data=resp)
 
 
@@ -472,7 +680,7 @@ class DevicesList(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        conn = get_connector(username, password, cloud_fqdn)
 
         try:
             devices = conn.get_device_list(
@@ -488,6 +696,8 @@ class DevicesList(APIView):
             # check to control access to signals, etc
             request.session['user_devices'] = \
                 [device['devConnectwareId'] for device in devices['items']]
+            publish_account_devices(username, cloud_fqdn,
+                                    request.session['user_devices'])
             # Inject a url to each item pointing to the individual view for
             # that device
             for device in devices['items']:
@@ -507,7 +717,7 @@ class DevicesList(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        conn = get_connector(username, password, cloud_fqdn)
 
         if 'mac' in request.DATA:
             mac = request.DATA['mac']
@@ -537,9 +747,19 @@ class DevicesDetail(APIView):
 
     *GET* - Show DeviceCore data for the the specified device
 
+      - Query params: ?include=data,config - Also return the device's
+        DataStreams and settings, queried alongside the device.
+
      _Authentication Required_
     """
 
+    # ?include= values, and the connector call returning each
+    INCLUDES = {
+        'data': lambda conn, device_id: conn.get_datastream_list(
+            device_id=device_id),
+        'config': lambda conn, device_id: conn.get_device_settings(device_id),
+    }
+
     def get(self, request, device_id=None, format=None):
         """
         Return a single Xbee WiFi devices, and provide links to data and config
@@ -551,10 +771,19 @@ class DevicesDetail(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        includes = [name for name in
+                    request.QUERY_PARAMS.get('include', '').split(',') if name]
+        if set(includes) - set(self.INCLUDES):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        conn = AsyncConnector(get_connector(username, password, cloud_fqdn))
 
         try:
-            device = conn.get_device_list(device_id=device_id)
+            # The device and anything included are independent queries
+            futures = [conn.get_device_list(device_id=device_id)] + \
+                [self.INCLUDES[name](conn, device_id) for name in includes]
+            results = wait_all(futures)
+            device = results[0]
         except HTTPError, e:
             return Response(status=e.response.status_code,
                             data=e.response.text)
@@ -580,6 +809,8 @@ class DevicesDetail(APIView):
                     'device-datastream-list',
                     kwargs={'device_id': str(dev['devConnectwareId'])},
                     request=request)
+                if dev['devConnectwareId'] == device_id:
+                    dev.update(zip(includes, results[1:]))
 
         return Response(data=device)
 
@@ -661,34 +892,32 @@ class DeviceIO(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        connector = get_connector(username, password, cloud_fqdn)
 
-        resp = {}
+        # For IO command, need to generate two bitmasks - enable and level
+        enable_mask = 0
+        output_mask = 0
+        for bit, value in io_command_pairs:
+            enable_mask |= 1 << int(bit)
+            output_mask |= value << int(bit)
 
-        try:
-            # For IO command, need to generate two bitmasks - enable and level
-            if len(io_command_pairs):
-                enable_mask = 0
-                output_mask = 0
-                for bit, value in io_command_pairs:
-                    enable_mask |= 1 << int(bit)
-                    output_mask |= value << int(bit)
-                resp = conn.set_output(device_id,
-                                       hex(enable_mask), hex(output_mask))
-
-            if len(io_set_setting_pairs):
-                # Because these settings belong to a single known group, we can
-                # construct the request for the user
-                new_settings = {'InputOutput': {}}
-                for name, val in io_set_setting_pairs:
-                    new_settings['InputOutput'][name] = val
-                resp = conn.set_device_settings(device_id, new_settings)
-
-            if len(io_serial_data_values):
-                data = "".join(io_serial_data_values)
-                data = base64.b64encode(data)
-                resp = conn.send_serial_data(device_id, data)
+        # Because these settings belong to a single known group, we can
+        # construct the request for the user
+        new_settings = dict(io_set_setting_pairs)
+
+        # Levels, settings and serial data all go out in one SCI request.
+        # Writes made while an earlier one is still in flight (e.g. from
+        # dragging a slider) are merged, latest value winning.
+        if enable_mask or new_settings or io_serial_data_values:
+            future = device_commands.submit(
+                connector, device_id, enable_mask, output_mask, new_settings,
+                "".join(io_serial_data_values))
+        else:
+            future = None
 
+        try:
+            # Respond with the device's reply to each operation
+            resp = future.get() if future is not None else {}
         except HTTPError, e:
             return Response(status=e.response.status_code,
                             data=e.response.text)
@@ -729,7 +958,7 @@ class DeviceConfig(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        conn = get_connector(username, password, cloud_fqdn)
 
         cache = bool(strtobool(request.QUERY_PARAMS.get('cache', 'False')))
 
@@ -790,7 +1019,7 @@ class DeviceConfig(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        conn = get_connector(username, password, cloud_fqdn)
 
         try:
             settings = conn.set_device_settings(device_id,
@@ -839,7 +1068,7 @@ class DeviceConfigGroup(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        conn = get_connector(username, password, cloud_fqdn)
 
         cache = bool(strtobool(request.QUERY_PARAMS.get('cache', 'False')))
 
@@ -875,7 +1104,7 @@ class DeviceConfigGroup(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        conn = get_connector(username, password, cloud_fqdn)
 
         try:
             settings = conn.set_device_settings(device_id, new_settings)
@@ -913,10 +1142,11 @@ class DeviceConfigStock(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        conn = get_connector(username, password, cloud_fqdn)
 
         try:
-            settings = conn.get_device_settings(device_id)
+            settings = conn.get_device_settings(
+                device_id, keep_groups=XBEE_KIT_CONFIG.keys())
         except HTTPError, e:
             return Response(status=e.response.status_code,
                             data=e.response.text)
@@ -959,6 +1189,117 @@ class DeviceConfigStock(APIView):
             return Response(status=status.HTTP_200_OK)
 
 
+class DevicesConfigStock(APIView):
+    """
+    Apply the default Kit configuration to every XBee module in the account
+    ------------------------------------------
+
+    *PUT* - Set device settings to Kit defaults for all devices. No request
+            content required.
+
+    Devices are queried a few at a time, and devices needing the same changes
+    are updated together in a single request. Progress is streamed back as
+    one json object per line, each with a `device_id` and a `status` of
+    `unchanged`, `applied` or `error`.
+
+     _Authentication Required_
+    """
+
+    def put(self, request, format=None):
+        username, password, cloud_fqdn = get_credentials(request)
+
+        if not username or not password or not cloud_fqdn:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        conn = get_connector(username, password, cloud_fqdn)
+
+        try:
+            devices = conn.get_device_list(
+                device_types=settings.SUPPORTED_DEVICE_TYPES)
+        except HTTPError, e:
+            return Response(status=e.response.status_code,
+                            data=e.response.text)
+        except ConnectionError, e:
+            return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        device_ids = [device['devConnectwareId']
+                      for device in devices.get('items', [])]
+
+        response = StreamingHttpResponse(
+            self.apply_stock_config(AsyncConnector(conn), device_ids),
+            content_type='application/x-ndjson')
+        return response
+
+    def apply_stock_config(self, conn, device_ids):
+        """
+        Generator yielding a line of json progress for each device
+        """
+        def progress(device_id, state, **kwargs):
+            kwargs.update({'device_id': device_id, 'status': state})
+            return json.dumps(kwargs) + '\n'
+
+        def query(device_id):
+            try:
+                return device_id, conn.get_device_settings(
+                    device_id, keep_groups=XBEE_KIT_CONFIG.keys()).get(), None
+            except (HTTPError, ConnectionError), e:
+                return device_id, None, e
+
+        # Query devices' current settings, a bounded number at a time, and
+        # group devices by the changes they need as the replies come in
+        pool = Pool(settings.LIB_DIGI_DEVICECLOUD.get(
+            'MAX_IN_FLIGHT_REQUESTS', 20))
+        deltas = {}
+        for device_id, settings_reply, error in pool.imap_unordered(
+                query, device_ids):
+            if error is not None:
+                yield progress(device_id, 'error', detail=str(error))
+                continue
+
+            # Check for any errors in query
+            if is_key_in_nested_dict(settings_reply, 'error'):
+                yield progress(device_id, 'error', detail=settings_reply)
+                continue
+
+            try:
+                device = settings_reply['sci_reply']['send_message']['device']
+                settings_resp = device['rci_reply']['query_setting']
+            except (KeyError, TypeError):
+                yield progress(device_id, 'error', detail=settings_reply)
+                continue
+
+            settings_diff = compare_config_with_stock(settings_resp)
+            if settings_diff:
+                key = json.dumps(settings_diff, sort_keys=True)
+                deltas.setdefault(key, (settings_diff, []))[1].append(
+                    device_id)
+            else:
+                yield progress(device_id, 'unchanged')
+
+        # Push each distinct set of changes to all devices that need it
+        updates = {}
+        for settings_diff, group in deltas.values():
+            future = conn.set_device_settings_batch(group,
+                                                    settings=settings_diff)
+            updates[future] = group
+
+        for future in gevent.iwait(updates.keys()):
+            group = updates[future]
+            try:
+                replies = future.get()
+            except (HTTPError, ConnectionError), e:
+                for device_id in group:
+                    yield progress(device_id, 'error', detail=str(e))
+                continue
+
+            for device_id in group:
+                reply = replies.get(device_id, {})
+                if not reply or is_key_in_nested_dict(reply, 'error'):
+                    yield progress(device_id, 'error', detail=reply)
+                else:
+                    yield progress(device_id, 'applied')
+
+
 class DeviceSerial(APIView):
     """
     Send data out serial port of devices
@@ -1004,7 +1345,7 @@ class DeviceSerial(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        conn = get_connector(username, password, cloud_fqdn)
 
         try:
             response = conn.send_serial_data(device_id, data)
@@ -1044,7 +1385,7 @@ class DevicesDatastreamList(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        conn = get_connector(username, password, cloud_fqdn)
 
         try:
             data_streams = conn.get_datastream_list(device_id=device_id)
@@ -1079,6 +1420,29 @@ class DevicesDatapointList(APIView):
 
     * `startTime` - POSIX timestamp in seconds. Defaults to 5 minutes in the
                     past.
+    * `endTime` - POSIX timestamp in seconds. Defaults to now.
+    * `size` - DataPoints to request from Device Cloud at a time, at most
+               1000.
+    * `points` - Reduce the history to at most this many points (3 to 1000)
+                 for charting.
+    * `rollupMethod` - How points are reduced, one of `average` (default),
+                       `min`, `max`, `sum`, `count` or `lttb`.
+
+    Histories longer than one page are streamed to the client a page at a
+    time, as a json object with the `items` of every page and their total
+    `resultSize`. Should a later page fail, an `error` is added after the
+    items received so far.
+
+    When `points` is given, Device Cloud rolls the stream up using the finest
+    interval that fits in a page, and the result is reduced further here if
+    still too long. Windows too short for its rollup intervals, the `lttb`
+    method, and streams it won't roll up are instead reduced here from the
+    raw points. The response has a `rollup` describing what was done.
+
+    Windows this worker has seen every point of, because the device was
+    being watched and the monitor bus brings every worker every push, are
+    answered from memory instead of Device Cloud. With the
+    local DataPoint store enabled, so are windows it holds every point of.
 
      _Authentication Required_
     """
@@ -1092,26 +1456,224 @@ class DevicesDatapointList(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        conn = get_connector(username, password, cloud_fqdn)
 
         # Only show the data from the last x minutes
-        if 'startTime' in request.GET:
-            try:
-                time = datetime.utcfromtimestamp(
+        try:
+            if 'startTime' in request.GET:
+                start_time = datetime.utcfromtimestamp(
                     float(request.GET['startTime']))
-            except ValueError:
-                return Response(status=status.HTTP_400_BAD_REQUEST)
+            else:
+                start_time = datetime.utcnow() - timedelta(minutes=5)
+            end_time = None
+            if 'endTime' in request.GET:
+                end_time = datetime.utcfromtimestamp(
+                    float(request.GET['endTime']))
+            size = int(request.GET.get('size', DATAPOINT_PAGE_SIZE))
+        except ValueError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if not 0 < size <= DATAPOINT_PAGE_SIZE:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        # Answer from pushes kept in memory or stored locally if they cover
+        # the window, and the device is known to be the user's
+        stored = None
+        source = None
+        if stream_id.startswith(device_id + '/') and \
+                device_id in request.session.get('user_devices', []):
+            start_ms = epoch_millis(start_time)
+            end_ms = epoch_millis(end_time or datetime.utcnow())
+            if keeps_recent_datapoints():
+                stored = recent_datapoints.query(device_id, stream_id,
+                                                 start_ms, end_ms)
+                source = 'recent'
+            if stored is None and datapoint_store.enabled:
+                stored = datapoint_store.query(stream_id, start_ms, end_ms)
+                source = 'store'
+
+        if 'points' in request.GET:
+            return self.get_reduced(request, conn, stream_id, start_time,
+                                    end_time or datetime.utcnow(), stored,
+                                    source)
+        if stored is not None:
+            # Paged like Device Cloud's answer, so a long stored window is
+            # streamed rather than held whole
+            pages = ({'items': [point.to_dict() for point in page],
+                      'resultSize': str(len(page))}
+                     for page in paged(stored, size))
         else:
-            time = datetime.utcnow() - timedelta(minutes=5)
-        time_no_micro = time.replace(microsecond=0)
-        iso_time = time_no_micro.isoformat()+'z'
+            pages = conn.iter_datapoint_pages(
+                stream_id, iso_timestamp(start_time),
+                iso_timestamp(end_time) if end_time else None, size)
+        try:
+            first_page = next(pages)
+        except HTTPError, e:
+            return Response(status=e.response.status_code,
+                            data=e.response.text)
+        except (ConnectionError, DatabaseError), e:
+            return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        if len(first_page.get('items') or []) < size:
+            # Everything fit in one page
+            return Response(data=first_page)
+
+        return StreamingHttpResponse(
+            self.stream_datapoints(first_page, pages),
+            content_type='application/json')
+
+    def get_reduced(self, request, conn, stream_id, start_time, end_time,
+                    stored=None, source='store'):
+        """
+        Respond with the history reduced to a number of points, rolled up by
+        Device Cloud where possible. stored is the history held locally, if
+        any, and source where it was held.
+        """
+        method = request.GET.get('rollupMethod', 'average')
+        try:
+            points = int(request.GET['points'])
+        except ValueError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if method not in downsample.METHODS or \
+                not 3 <= points <= DATAPOINT_PAGE_SIZE:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
 
+        start_ms = epoch_millis(start_time)
+        end_ms = epoch_millis(end_time)
+        if stored is not None:
+            try:
+                items = downsample.downsample(stored, start_ms, end_ms,
+                                              points, method)
+            except DatabaseError, e:
+                return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            return Response(data={
+                'items': [point.to_dict() for point in items],
+                'resultSize': str(len(items)),
+                'rollup': {'source': source, 'method': method}})
+
+        window = (end_time - start_time).total_seconds()
+        rollups = settings.DATAPOINT_ROLLUPS
+        interval = None
+        if method != 'lttb' and rollups.get('DEVICE_CLOUD', True):
+            interval = rollup_interval(window, points,
+                                       rollups.get('MIN_FRACTION', 0.125))
+
+        start = iso_timestamp(start_time)
+        end = iso_timestamp(end_time)
         try:
-            data_points = conn.get_datapoints(stream_id, iso_time)
+            if interval is not None:
+                try:
+                    items = map(DataPoint.from_dict, conn.iter_datapoints(
+                        stream_id, start, end, rollup_interval=interval,
+                        rollup_method=method))
+                    rollup = {'source': 'devicecloud', 'interval': interval,
+                              'method': method}
+                except HTTPError, e:
+                    # e.g. rollups of a stream of strings
+                    if e.response.status_code != status.HTTP_400_BAD_REQUEST:
+                        raise
+                    logger.info('Rollup of %s refused, reducing locally'
+                                % stream_id)
+                    interval = None
+                else:
+                    # The interval may leave more points than asked for
+                    if method == 'average' and len(items) > points:
+                        # Buckets average different numbers of points, so
+                        # their averages are weighted by those counts
+                        counts = map(DataPoint.from_dict, conn.iter_datapoints(
+                            stream_id, start, end, rollup_interval=interval,
+                            rollup_method='count'))
+                        items = downsample.weighted_average(
+                            downsample.numeric_points(items),
+                            downsample.numeric_points(counts),
+                            start_ms, end_ms, points)
+                    else:
+                        items = downsample.downsample(
+                            items, start_ms, end_ms, points,
+                            downsample.ROLLUP_REDUCTIONS.get(method, method))
+            if interval is None:
+                # Converted as the pages arrive, so a long window's raw
+                # points aren't all held as dicts
+                items = downsample.downsample(
+                    (DataPoint.from_dict(item) for item in
+                     conn.iter_datapoints(stream_id, start, end)),
+                    start_ms, end_ms, points, method)
+                rollup = {'source': 'local', 'method': method}
         except HTTPError, e:
             return Response(status=e.response.status_code,
                             data=e.response.text)
         except ConnectionError, e:
             return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        return Response(data=data_points)
+        return Response(data={'items': [point.to_dict() for point in items],
+                              'resultSize': str(len(items)),
+                              'rollup': rollup})
+
+    def stream_datapoints(self, first_page, pages):
+        """
+        Generator yielding the json response a page of DataPoints at a time
+        """
+        yield '{"items": ['
+        count = 0
+        error = None
+        page = first_page
+        while page is not None:
+            items = page.get('items') or []
+            if items:
+                chunk = ', '.join(json.dumps(item) for item in items)
+                yield chunk if not count else ', ' + chunk
+                count += len(items)
+            try:
+                page = next(pages, None)
+            except (HTTPError, ConnectionError, DatabaseError), e:
+                logger.warning('DataPoint history ended early: %s' % e)
+                error = str(e)
+                page = None
+
+        end = {'resultSize': str(count)}
+        if error is not None:
+            end['error'] = error
+        yield '], ' + json.dumps(end)[1:]
+
+
+def paged(items, size):
+    """
+    Generator yielding lists of up to size items, and at least one list
+    """
+    page = []
+    for item in items:
+        page.append(item)
+        if len(page) == size:
+            yield page
+            page = []
+    yield page
+
+
+def rollup_interval(window, points, min_fraction=0):
+    """
+    The finest Device Cloud rollup interval splitting a window of seconds
+    into a single page of buckets, which can then be reduced further to the
+    number of points wanted. None if the window is too short for it to give
+    at least min_fraction of the points, as reducing the raw points gives a
+    better chart.
+    """
+    for name, seconds in ROLLUP_INTERVALS.items():
+        buckets = window / seconds
+        if buckets <= DATAPOINT_PAGE_SIZE:
+            if buckets < max(points * min_fraction, 2):
+                return None
+            return name
+    return None
+
+
+def epoch_millis(when):
+    """
+    Milliseconds since the epoch of a naive UTC datetime
+    """
+    return int(calendar.timegm(when.utctimetuple()) * 1000)
+
+
+def iso_timestamp(when):
+    """
+    ISO 8601 UTC timestamp for Device Cloud queries, to the second
+    """
+    return when.replace(microsecond=0).isoformat() + 'z'
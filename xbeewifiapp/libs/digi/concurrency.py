@@ -0,0 +1,256 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Concurrent Device Cloud requests using gevent greenlets
+
+Wrapping a DeviceCloudConnector in an AsyncConnector makes each API method
+return a future (a gevent Greenlet) instead of blocking, so several
+independent calls can be in flight at once. The number of concurrent requests
+to each Device Cloud server is capped per worker.
+
+Output, InputOutput setting and serial writes to a device go through a
+DeviceCommandQueue, which merges writes arriving while an earlier one is in
+flight so a device never works through a backlog of stale states. Writes
+to a device go out in the order they were made.
+
+"""
+import base64
+import logging
+import weakref
+from collections import OrderedDict, deque
+from functools import partial
+import gevent
+from gevent.event import AsyncResult
+from gevent.lock import BoundedSemaphore
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class InFlightLimiter(object):
+    """
+    Hands out a bounded semaphore per cloud fqdn, limiting how many requests
+    may be outstanding to that server at once
+    """
+
+    def __init__(self, max_in_flight=20):
+        self.max_in_flight = max_in_flight
+        # gevent primitives can't be shared across OS threads, so keep a
+        # separate set of semaphores per hub (one hub per thread)
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def semaphore(self, cloud_fqdn):
+        per_hub = self._semaphores.setdefault(gevent.get_hub(), {})
+        try:
+            return per_hub[cloud_fqdn]
+        except KeyError:
+            sem = per_hub[cloud_fqdn] = BoundedSemaphore(self.max_in_flight)
+            return sem
+
+
+def _run_limited(semaphore, func, args, kwargs):
+    with semaphore:
+        return func(*args, **kwargs)
+
+
+class AsyncConnector(object):
+    """
+    Proxy for a DeviceCloudConnector where every public method returns a
+    future. Call .get() on the future to wait for and return the result, or
+    re-raise any exception from the call.
+    """
+
+    def __init__(self, connector, limiter=None):
+        self.connector = connector
+        self.limiter = limiter or default_limiter
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Start running connector.method(*args, **kwargs) in a new greenlet
+        """
+        func = getattr(self.connector, method)
+        semaphore = self.limiter.semaphore(self.connector.cloud_fqdn)
+        return gevent.spawn(_run_limited, semaphore, func, args, kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self.connector, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        return partial(self.submit, name)
+
+
+def wait_all(futures, timeout=None):
+    """
+    Wait for all futures to finish, returning their results in order. If any
+    call raised, the first such exception is re-raised here.
+    """
+    gevent.joinall(futures, timeout=timeout)
+    return [future.get(block=False) for future in futures]
+
+
+class _PendingWrite(object):
+    """
+    Writes to a device merged into one batch, the connector sending it, and
+    the future its waiters share
+    """
+
+    def __init__(self, connector):
+        self.connector = connector
+        self.enable_mask = 0
+        self.output_mask = 0
+        self.settings = OrderedDict()
+        self.serial_data = ''
+        self.writes = 0
+        self.result = AsyncResult()
+
+    def _ranks(self, enable_mask, settings, serial_data):
+        # Position in the composite request: levels, then settings, then
+        # serial data
+        return [rank for rank, part in enumerate(
+            (enable_mask, settings, serial_data)) if part]
+
+    def accepts(self, connector, enable_mask, settings, serial_data):
+        """
+        Whether a write can join the batch. It must be for the same account,
+        and none of it may end up ahead of a part of the batch written
+        before it, e.g. a level change after serial data.
+        """
+        if connector.r.auth[0] != self.connector.r.auth[0]:
+            return False
+        held = self._ranks(self.enable_mask, self.settings, self.serial_data)
+        new = self._ranks(enable_mask, settings, serial_data)
+        return not held or not new or min(new) >= max(held)
+
+    def merge(self, enable_mask, output_mask, settings, serial_data):
+        # Latest level wins for each pin, every enabled pin stays enabled
+        self.output_mask = (self.output_mask & ~enable_mask) | \
+            (output_mask & enable_mask)
+        self.enable_mask |= enable_mask
+        # Latest value wins for each setting
+        for name, value in settings.items():
+            self.settings.pop(name, None)
+            self.settings[name] = value
+        # Serial data is a stream, so nothing is dropped
+        self.serial_data += serial_data
+        self.writes += 1
+
+
+class DeviceCommandQueue(object):
+    """
+    Last-write-wins pipeline of output level, InputOutput setting and serial
+    writes, one per device. At most one request is in flight to a device;
+    writes submitted meanwhile are merged into pending batches, each sent as
+    one composite SCI request once the one before it completes. Everyone
+    whose write went into a batch gets that batch's result.
+
+    A composite request sets levels, then settings, then serial data, so a
+    write only joins the last pending batch if that keeps it after the
+    writes made before it; otherwise it starts a new batch. Writes are only
+    merged within an account, so each batch goes out with the credentials
+    of the account whose writes it holds.
+    """
+
+    def __init__(self, limiter=None):
+        self.limiter = limiter or default_limiter
+        # (cloud_fqdn, device_id) ->
+        #     {'pending': deque of _PendingWrite, 'worker': ...}
+        self._devices = {}
+        self.submitted = 0
+        self.sent = 0
+
+    def submit(self, connector, device_id, enable_mask=0, output_mask=0,
+               settings=None, serial_data=''):
+        """
+        Queue a write, returning a future for the result of the batch it ends
+        up in
+
+        Args:
+            connector (DeviceCloudConnector): Connector to send with. A batch
+                            is sent with the connector of its first write.
+            device_id (str): The device to write to
+        Kwargs:
+            enable_mask (int): Bit map of the pins whose level to set
+            output_mask (int): Bit map of pin levels
+            settings (dict): InputOutput settings to set, name to value
+            serial_data (str): Bytes to send out the serial port, after any
+                            already pending
+        """
+        settings = settings or {}
+        key = (connector.cloud_fqdn, device_id)
+        state = self._devices.get(key)
+        if state is None:
+            state = self._devices[key] = {'pending': deque(), 'worker': None}
+        pending = state['pending']
+        if not pending or not pending[-1].accepts(connector, enable_mask,
+                                                  settings, serial_data):
+            pending.append(_PendingWrite(connector))
+        batch = pending[-1]
+        batch.merge(enable_mask, output_mask, settings, serial_data)
+        self.submitted += 1
+
+        if state['worker'] is None:
+            state['worker'] = gevent.spawn(self._drain, key, state)
+        return batch.result
+
+    def __len__(self):
+        return len(self._devices)
+
+    def _drain(self, key, state):
+        device_id = key[1]
+        pending = state['pending']
+        batch = None
+        try:
+            while pending:
+                batch = pending.popleft()
+                if batch.writes > 1:
+                    logger.debug('Merged %d writes to %s'
+                                 % (batch.writes, device_id))
+                try:
+                    result = self._send(batch.connector, device_id, batch)
+                except Exception, e:
+                    batch.result.set_exception(e)
+                else:
+                    batch.result.set(result)
+        except BaseException, e:
+            # Killed, or broken outside a send. Nothing else will send these,
+            # so their waiters get the exception rather than waiting forever.
+            unsent = list(pending)
+            if batch is not None:
+                unsent.insert(0, batch)
+            pending.clear()
+            for unsent_batch in unsent:
+                if not unsent_batch.result.ready():
+                    unsent_batch.result.set_exception(e)
+            raise
+        finally:
+            state['worker'] = None
+            if self._devices.get(key) is state:
+                del self._devices[key]
+
+    def _send(self, connector, device_id, batch):
+        """
+        Send a batch, returning the device's reply to each operation
+        """
+        kwargs = {}
+        if batch.enable_mask:
+            kwargs['enable_mask'] = hex(batch.enable_mask)
+            kwargs['io_mask'] = hex(batch.output_mask)
+        if batch.settings:
+            kwargs['settings'] = {'InputOutput': dict(batch.settings)}
+        if batch.serial_data:
+            kwargs['data_b64'] = base64.b64encode(batch.serial_data)
+        with self.limiter.semaphore(connector.cloud_fqdn):
+            self.sent += 1
+            return connector.send_device_commands(device_id, **kwargs)
+
+
+default_limiter = InFlightLimiter(
+    settings.LIB_DIGI_DEVICECLOUD.get('MAX_IN_FLIGHT_REQUESTS', 20))
+
+device_commands = DeviceCommandQueue()
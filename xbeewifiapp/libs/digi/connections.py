@@ -0,0 +1,152 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Process-wide registry of DeviceCloudConnectors
+
+Each connector owns a requests Session, and with it a pool of keep-alive
+connections to Device Cloud. Sharing connectors between requests for the same
+account avoids paying for a new TLS handshake on every API call. They also
+share a cache of device listings.
+
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from devicecloud import DeviceCloudConnector
+from responsecache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectorRegistry(object):
+    """
+    Bounded, least-recently-used cache of DeviceCloudConnectors keyed by
+    (username, cloud_fqdn). A connector dropped from the registry is closed
+    once the requests other greenlets are making with it have finished.
+    """
+
+    def __init__(self, max_size=100, idle_timeout=300, pool_size=None,
+                 response_cache=None):
+        """
+        Kwargs:
+            max_size (int): Maximum number of connectors to keep open. The
+                            least recently used connector is closed when full.
+            idle_timeout (int): Seconds a connector may go unused before its
+                            connections are closed and it is dropped.
+            pool_size (int): Keep-alive connections held by each connector
+            response_cache (ResponseCache): Listing cache given to each
+                            connector
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.pool_size = pool_size
+        self.response_cache = response_cache
+        # (username, cloud_fqdn) -> [connector, last used timestamp]
+        self._connectors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._connectors)
+
+    def get(self, username, password, cloud_fqdn):
+        """
+        Return a connector for the given account, creating one if none exists
+        or if the credentials have changed since it was created.
+        """
+        key = (username, cloud_fqdn)
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+
+            entry = self._connectors.pop(key, None)
+            if entry is not None and entry[0].r.auth != (username, password):
+                logger.info('Credentials changed for %s@%s, replacing connector'
+                            % key)
+                entry[0].close()
+                entry = None
+            if entry is None:
+                entry = [DeviceCloudConnector(
+                    username, password, cloud_fqdn, pool_size=self.pool_size,
+                    response_cache=self.response_cache), now]
+
+            # Re-inserting keeps the dict ordered from least to most recent
+            entry[1] = now
+            self._connectors[key] = entry
+
+            while len(self._connectors) > self.max_size:
+                old_key, old_entry = self._connectors.popitem(last=False)
+                logger.debug('Registry full, closing connector for %s@%s'
+                             % old_key)
+                old_entry[0].close()
+
+            return entry[0]
+
+    def find(self, username, cloud_fqdn):
+        """
+        Return the connector currently held for the given account, or None.
+        Used by background work, which has no password to create one with.
+        """
+        with self._lock:
+            entry = self._connectors.get((username, cloud_fqdn))
+        return entry[0] if entry is not None else None
+
+    def invalidate(self, username, cloud_fqdn):
+        """
+        Close and forget the connector for the given account, if any
+        """
+        with self._lock:
+            entry = self._connectors.pop((username, cloud_fqdn), None)
+        if entry is not None:
+            entry[0].close()
+
+    def clear(self):
+        """
+        Close and forget all connectors, and any cached responses
+        """
+        with self._lock:
+            entries = self._connectors.values()
+            self._connectors.clear()
+        for connector, last_used in entries:
+            connector.close()
+        if self.response_cache is not None:
+            self.response_cache.clear()
+
+    def _evict_idle(self, now):
+        # Oldest entries are first, stop at the first one still in use
+        while self._connectors:
+            key, entry = next(self._connectors.iteritems())
+            if now - entry[1] < self.idle_timeout:
+                break
+            logger.debug('Closing idle connector for %s@%s' % key)
+            del self._connectors[key]
+            entry[0].close()
+
+
+_dc_settings = settings.LIB_DIGI_DEVICECLOUD
+
+response_cache = ResponseCache(
+    max_size=_dc_settings.get('RESPONSE_CACHE_SIZE', 1000),
+    ttls={
+        'get_device_list': _dc_settings.get('DEVICE_LIST_TTL', 60),
+    })
+
+connector_registry = ConnectorRegistry(
+    max_size=_dc_settings.get('CONNECTOR_REGISTRY_SIZE', 100),
+    idle_timeout=_dc_settings.get('CONNECTOR_IDLE_TIMEOUT', 300),
+    pool_size=_dc_settings.get('CONNECTION_POOL_SIZE', None),
+    response_cache=response_cache)
+
+
+def get_connector(username, password, cloud_fqdn):
+    """
+    Return a shared DeviceCloudConnector for the given account
+    """
+    return connector_registry.get(username, password, cloud_fqdn)
@@ -0,0 +1,135 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Compact representation of Device Cloud DataPoints
+
+DataPoints arrive as dicts, from monitor pushes and DataPoint queries, each
+carrying a dozen fields of which the dashboard mostly uses the stream,
+timestamp and value. Points held on to in bulk, in caches or while a history
+is reduced, are kept as DataPoint objects instead: the common fields in
+slots, and the rest flattened into a tuple of names and values that is only
+turned back into a dict when the point leaves through the API.
+"""
+
+# Field names as Device Cloud spells them, in slot order
+FIELDS = ('id', 'streamId', 'timestamp', 'serverTimestamp', 'data', 'quality')
+
+
+def _flatten(items):
+    # One tuple of name, value, name, value... takes a single allocation
+    flat = []
+    for item in items:
+        flat.extend(item)
+    return tuple(flat)
+
+
+def _unflatten(flat):
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+class DataPoint(object):
+    """
+    A single DataPoint. Values are kept as they were given, so a point turns
+    back into the dict it came from, numbers from pushes and strings from
+    queries alike.
+    """
+
+    __slots__ = ('id', 'stream_id', 'timestamp', 'server_timestamp', 'data',
+                 'quality', '_extra', '_envelope')
+
+    def __init__(self, id=None, stream_id=None, timestamp=None,
+                 server_timestamp=None, data=None, quality=None, extra=(),
+                 envelope=None):
+        """
+        Kwargs:
+            extra (iterable): (name, value) pairs of any other DataPoint
+                              fields
+            envelope (iterable): (name, value) pairs of the push message the
+                              point came in, without the DataPoint itself
+        """
+        self.id = id
+        self.stream_id = stream_id
+        self.timestamp = timestamp
+        self.server_timestamp = server_timestamp
+        self.data = data
+        self.quality = quality
+        self._extra = _flatten(extra)
+        self._envelope = _flatten(envelope) if envelope is not None else None
+
+    @classmethod
+    def from_dict(cls, point):
+        """
+        Build a DataPoint from Device Cloud's dict representation
+        """
+        extra = [(name, value) for name, value in point.iteritems()
+                 if name not in FIELDS]
+        get = point.get
+        return cls(get('id'), get('streamId'), get('timestamp'),
+                   get('serverTimestamp'), get('data'), get('quality'), extra)
+
+    @classmethod
+    def from_message(cls, msg):
+        """
+        Build a DataPoint from a DataPoint push message, keeping the rest of
+        the message so it can be sent on as it was received
+        """
+        self = cls.from_dict(msg['DataPoint'])
+        self._envelope = _flatten((name, value) for name, value
+                                  in msg.iteritems() if name != 'DataPoint')
+        return self
+
+    @property
+    def millis(self):
+        """
+        The timestamp as an int, or None if it isn't a number
+        """
+        try:
+            return int(self.timestamp)
+        except (TypeError, ValueError):
+            return None
+
+    @property
+    def extra(self):
+        """
+        Dict of the fields not kept in slots, e.g. description or cstId
+        """
+        return _unflatten(self._extra)
+
+    def to_dict(self):
+        """
+        Return Device Cloud's dict representation, leaving out fields that
+        are None
+        """
+        point = _unflatten(self._extra)
+        for name, value in zip(FIELDS, (
+                self.id, self.stream_id, self.timestamp,
+                self.server_timestamp, self.data, self.quality)):
+            if value is not None:
+                point[name] = value
+        return point
+
+    def to_message(self):
+        """
+        Return the push message the point came in
+        """
+        msg = _unflatten(self._envelope or ())
+        msg['DataPoint'] = self.to_dict()
+        return msg
+
+    def __eq__(self, other):
+        if not isinstance(other, DataPoint):
+            return NotImplemented
+        return self.to_message() == other.to_message()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'DataPoint(%r, %r, %r)' % (self.stream_id, self.timestamp,
+                                         self.data)
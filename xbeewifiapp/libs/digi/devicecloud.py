@@ -12,8 +12,14 @@ Simple library to handle common Device Cloud operations
 """
 import logging
 import requests
-import xmltodict
+import xmlparse
+import sci
+from sci import Template, Value, Raw, element
+from singleflight import SingleFlight, freeze
 from collections import OrderedDict
+from functools import wraps
+from inspect import getcallargs
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
@@ -26,15 +32,34 @@ DATAPOINT_RESOURCE = 'DataPoint'
 SCI_RESOURCE = 'sci'
 MONITOR_RESOURCE = 'Monitor'
 
+# Largest page of DataPoints Device Cloud will return
+DATAPOINT_PAGE_SIZE = 1000
 
-def _parse_response(response):
+# DataPoint rollup intervals, finest first, with their length in seconds
+# (a month taken as 30 days), and the ways points can be rolled up
+ROLLUP_INTERVALS = OrderedDict([
+    ('half', 30 * 60),
+    ('hour', 60 * 60),
+    ('day', 24 * 60 * 60),
+    ('week', 7 * 24 * 60 * 60),
+    ('month', 30 * 24 * 60 * 60),
+])
+ROLLUP_METHODS = ('sum', 'average', 'min', 'max', 'count', 'standarddev')
+
+
+def _parse_response(response, keep=None):
     """
     Convert the Requests response content to a python dictionary by parsing out
     json/xml
+
+    Kwargs:
+        keep (dict): For XML, element name to the names of the only children
+                     to include (see xmlparse.parse)
     """
     if 'application/xml' in response.headers['Content-Type']:
-        # XML content, run through xmltodict
-        return xmltodict.parse(response.text)
+        # XML content, parsed straight from the raw bytes into the same shape
+        # xmltodict produces
+        return xmlparse.parse(response.content, keep)
     elif 'application/json' in response.headers['Content-Type']:
         # JSON content, use request's built in parser
         return response.json()
@@ -50,33 +75,280 @@ def _parse_response(response):
         return response.text
 
 
+def _datapoint_topic(device_id):
+    """
+    Monitor topic for a device's DataPoints, or all DataPoints in the account
+    if device_id is None
+    """
+    if device_id is None:
+        return DATAPOINT_RESOURCE
+    return '/'.join([DATAPOINT_RESOURCE, device_id])
+
+
+# Request bodies, compiled once (see sci.py)
+_DEVICE_TARGET = Template({'device': {'@id': Value('device_id')}},
+                          declaration=False)
+
+
+# One or more SCI operations, in the order they are to be performed
+_SCI_REQUEST = Template({
+    'sci_request': {'@version': '1.0', '#text': Raw('operations')},
+})
+
+
+def _send_message_template(cache):
+    send_message = {
+        'targets': Raw('targets'),
+        'rci_request': {'@version': '1.1', '#text': Raw('rci_body')},
+    }
+    if cache:
+        send_message['@cache'] = Value('cache')
+    return Template({'send_message': send_message}, declaration=False)
+
+# Keyed by whether the cache attribute is included
+_SEND_MESSAGE = {
+    False: _send_message_template(cache=False),
+    True: _send_message_template(cache=True),
+}
+
+_DATA_SERVICE = Template({
+    'data_service': {
+        'targets': Raw('targets'),
+        'requests': {
+            'device_request': {
+                '@target_name': Value('target_name'),
+                '@format': 'base64',
+                '#text': Value('data'),
+            }
+        },
+    },
+}, declaration=False)
+
+_SET_OUTPUT_MASK = Template(
+    {'set_state': {'Executable': {'OM': Value('enable_mask')}}},
+    declaration=False)
+_SET_OUTPUT_LEVELS = Template(
+    {'set_state': {'Executable': {'IO': Value('io_mask')}}},
+    declaration=False)
+# Note: using an ordered dict to ensure OM command comes first in rendered xml
+_SET_OUTPUT = Template(
+    {'set_state': {'Executable': OrderedDict([('OM', Value('enable_mask')),
+                                              ('IO', Value('io_mask'))])}},
+    declaration=False)
+
+_PROVISION_DEVICE = Template({'DeviceCore': {'devMac': Value('mac')}})
+
+_KICK_MONITOR = Template({
+    'Monitor': {
+        'monId': Value('monitor_id'),
+        # Update the monitor with the most up-to-date auth information
+        'monTransportToken': Value('token'),
+    },
+})
+
+_SET_MONITOR_BATCHING = Template({
+    'Monitor': OrderedDict([
+        ('monId', Value('monitor_id')),
+        ('monBatchSize', Value('batch_size')),
+        ('monBatchDuration', Value('batch_duration')),
+    ]),
+})
+
+
+def _sci_targets(device_ids):
+    """
+    Render the contents of the SCI targets element for a list of device ids
+    """
+    return ''.join(_DEVICE_TARGET.render(device_id=device_id)
+                   for device_id in device_ids)
+
+
+def _split_sci_reply(reply, operation):
+    """
+    Split a parsed sci_reply into a dict of device id to the reply element for
+    that device. Device Cloud returns a single object rather than a list when
+    only one device was targeted.
+    """
+    try:
+        devices = reply['sci_reply'][operation]['device']
+    except (KeyError, TypeError):
+        logger.warning('No device replies found in SCI %s response'
+                       % operation)
+        return {}
+    if not isinstance(devices, list):
+        devices = [devices]
+    return dict((device['@id'], device) for device in devices)
+
+
+def _split_composite_reply(reply, device_id, set_state, set_setting,
+                           data_service):
+    """
+    Split the reply to send_device_commands into the device's reply to each
+    operation. An error for the whole RCI request (e.g. device not connected)
+    is returned for both set_state and set_setting.
+    """
+    results = OrderedDict()
+    if set_state or set_setting:
+        device = _split_sci_reply(reply, 'send_message').get(device_id)
+        try:
+            rci_reply = device['rci_reply']
+        except (KeyError, TypeError):
+            rci_reply = None
+        for operation, sent in (('set_state', set_state),
+                                ('set_setting', set_setting)):
+            if sent:
+                if isinstance(rci_reply, dict):
+                    results[operation] = rci_reply.get(operation)
+                else:
+                    results[operation] = device
+    if data_service:
+        results['data_service'] = _split_sci_reply(
+            reply, 'data_service').get(device_id)
+    return results
+
+
+def _query_setting_body(settings_group=None):
+    query_setting = {}
+    # If a settings group is provided, limit query to just that group
+    if settings_group:
+        query_setting[settings_group] = {}
+    return element('query_setting', query_setting)
+
+
+# Elements of an RCI error reply, never pruned from a query_setting reply
+RCI_ERROR_TAGS = ('error', 'desc', 'hint')
+
+
+def _query_setting_keep(keep_groups):
+    if keep_groups is None:
+        return None
+    return {'query_setting': set(keep_groups).union(RCI_ERROR_TAGS)}
+
+
+def _set_output_body(enable_mask, io_mask):
+    return _SET_OUTPUT.render(enable_mask=enable_mask, io_mask=io_mask)
+
+
+def _single_flight(method):
+    """
+    Share the result of a read between identical calls on the same connector
+    (and so the same account) which are in flight at the same time
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, freeze(args), freeze(kwargs))
+        return self._reads.do(key, method, self, *args, **kwargs)
+    return wrapper
+
+
+def _listed_device_ids(response):
+    """
+    Ids of the devices in a DeviceCore listing
+    """
+    device_ids = set()
+    items = response.get('items') if isinstance(response, dict) else None
+    for item in items or []:
+        try:
+            device_ids.add(item['devConnectwareId'])
+        except (KeyError, TypeError):
+            continue
+    return device_ids
+
+
+def _cached(method):
+    """
+    Serve a listing from the connector's response cache, if it has one.
+    The method must take a device_id filter argument.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = self.response_cache
+        ttl = cache.ttl(method.__name__) if cache is not None else None
+        if not ttl:
+            return method(self, *args, **kwargs)
+
+        key = (self.r.auth[0], self.cloud_fqdn, method.__name__,
+               freeze(args), freeze(kwargs))
+        try:
+            return cache.get(key)
+        except KeyError:
+            pass
+        generation = cache.generation
+        response = method(self, *args, **kwargs)
+
+        device_id = getcallargs(method, self, *args, **kwargs)['device_id']
+        device_ids = _listed_device_ids(response)
+        if device_id:
+            device_ids.add(device_id)
+        cache.put(key, response, ttl, device_ids, wide=not device_id,
+                  generation=generation)
+        return response
+    return wrapper
+
+
 class DeviceCloudConnector(object):
 
-    def __init__(self, username, password, cloud_fqdn):
+    def __init__(self, username, password, cloud_fqdn, pool_size=None,
+                 response_cache=None):
         """
         Args:
             username (str): Device Cloud Account Username
             password (str): Device Cloud Account Password
             cloud_fqdn (str): Device Cloud Fully Qualified Domain Name (ex
                                 'devicecloud.digi.com')
+
+        Kwargs:
+            pool_size (int): Maximum number of keep-alive connections to hold
+                                open to Device Cloud. Defaults to requests'
+                                own default.
+            response_cache (ResponseCache): Cache for device and stream
+                                listings. Not cached if None.
         """
         self.cloud_fqdn = cloud_fqdn
         # Requests session, defaults
         r = requests.Session()
         r.auth = (username, password)
         r.headers.update({'Accept': 'application/json'})
+        if pool_size:
+            r.mount('https://', HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=pool_size))
         self.r = r
+        # Concurrent identical reads share one request
+        self._reads = SingleFlight()
+        self.response_cache = response_cache
+        # Requests being made, and whether the connector has been closed
+        self._in_flight = 0
+        self._closed = False
+
+    def close(self):
+        """
+        Close any pooled connections held by this connector, once requests
+        already being made with it have finished
+        """
+        self._closed = True
+        if not self._in_flight:
+            self.r.close()
+
+    def _request(self, method, *args, **kwargs):
+        self._in_flight += 1
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._in_flight -= 1
+            if self._closed and not self._in_flight:
+                # Closed while in use, or used after closing
+                self.r.close()
 
     # Helper methods to wrap common requests logic
     def _get(self, *args, **kwargs):
-        response = self.r.get(*args, **kwargs)
+        response = self._request(self.r.get, *args, **kwargs)
         logger.info("GET on %s" % response.url)
         logger.debug("Response %s: %s" % (response.status_code, response.text))
         response.raise_for_status()
         return response
 
     def _post(self, *args, **kwargs):
-        response = self.r.post(*args, **kwargs)
+        response = self._request(self.r.post, *args, **kwargs)
         logger.info("POST on %s" % response.url)
         logger.debug("POST data: %s" % kwargs['data'])
         logger.debug("Response %s: %s" % (response.status_code, response.text))
@@ -84,7 +356,7 @@ class DeviceCloudConnector(object):
         return response
 
     def _put(self, *args, **kwargs):
-        response = self.r.put(*args, **kwargs)
+        response = self._request(self.r.put, *args, **kwargs)
         logger.info("PUT on %s" % response.url)
         logger.debug("PUT data: %s" % kwargs['data'])
         logger.debug("Response %s: %s" % (response.status_code, response.text))
@@ -92,7 +364,7 @@ class DeviceCloudConnector(object):
         return response
 
     def _delete(self, *args, **kwargs):
-        response = self.r.delete(*args, **kwargs)
+        response = self._request(self.r.delete, *args, **kwargs)
         logger.info("DELETE on %s" % response.url)
         logger.debug("Response %s: %s" % (response.status_code, response.text))
         response.raise_for_status()
@@ -121,6 +393,8 @@ class DeviceCloudConnector(object):
 
         return r.status_code == requests.codes['ok'], _parse_response(r)
 
+    @_single_flight
+    @_cached
     def get_device_list(self, device_types=[], device_id=None):
         """
         Get a list of devices on the user's Device Cloud account by querying
@@ -164,19 +438,22 @@ class DeviceCloudConnector(object):
         Args:
             mac (str) - mac address of the device
         """
-        post_dict = {
-            'DeviceCore': {
-                'devMac': mac,
-            },
-        }
-        post_body = xmltodict.unparse(post_dict)
+        post_body = _PROVISION_DEVICE.render(mac=mac)
 
         uri = ws_uri.format(
             resource=DEVICECORE_RESOURCE, fqdn=self.cloud_fqdn, path_filter="")
         r = self._post(uri, data=post_body)
 
+        # The account's listings no longer hold all its devices
+        if self.response_cache is not None:
+            self.response_cache.invalidate_account(self.r.auth[0],
+                                                   self.cloud_fqdn)
+
         return _parse_response(r)
 
+    # Not cached: listings carry each stream's currentValue, which every
+    # DataPoint push changes
+    @_single_flight
     def get_datastream_list(self, stream_prefix="", device_id=None):
         """
         Get a list of DataStreams available to the user.
@@ -201,7 +478,9 @@ class DeviceCloudConnector(object):
 
         return _parse_response(r)
 
-    def get_datapoints(self, stream_id, start_time=None):
+    @_single_flight
+    def get_datapoints(self, stream_id, start_time=None, rollup_interval=None,
+                       rollup_method=None):
         """
         Get a list of DataStreams available to the user.
 
@@ -210,11 +489,19 @@ class DeviceCloudConnector(object):
             start_time - timestamp, either epoch time (millis since start of
                             1970) or ISO 8601
 
+        Kwargs:
+            rollup_interval (str) - Roll points up into one per interval, one
+                            of ROLLUP_INTERVALS. Raw points if None.
+            rollup_method (str) - How points are rolled up, one of
+                            ROLLUP_METHODS. Device Cloud's default if None.
+
         Returns:
             Python object loaded from Device Cloud JSON response
         """
         params = {
-            'startTime': start_time
+            'startTime': start_time,
+            'rollupInterval': rollup_interval,
+            'rollupMethod': rollup_method,
         }
         uri = ws_uri.format(
             resource=DATAPOINT_RESOURCE, fqdn=self.cloud_fqdn,
@@ -223,49 +510,130 @@ class DeviceCloudConnector(object):
 
         return _parse_response(r)
 
-    def get_device_settings(self, device_id, settings_group=None, cache=False):
+    def iter_datapoint_pages(self, stream_id, start_time=None,
+                             end_time=None, size=DATAPOINT_PAGE_SIZE,
+                             rollup_interval=None, rollup_method=None):
         """
-        Get the settings for a device by doing an RCI query_setting
+        Generator over every page of DataPoints in a time range, following
+        the pageCursor of each page to request the next. Pages are only
+        requested as they are iterated over.
 
         Args:
-            device_id (str) - The device to query
+            stream_id (str) - the stream ID to query data from
 
         Kwargs:
-            cache (bool) - Whether to use Device Cloud cache. Default False.
+            start_time - timestamp, either epoch time (millis since start of
+                            1970) or ISO 8601. Unbounded if None.
+            end_time - timestamp, as for start_time
+            size (int) - DataPoints per page, at most 1000
+            rollup_interval (str) - As for get_datapoints
+            rollup_method (str) - As for get_datapoints
 
         Returns:
-            Python dict representation of xml response (using xmltodict lib)
+            Generator of Python objects loaded from Device Cloud JSON
+            responses, one per page
         """
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'send_message': {
-                    '@cache': str(cache),
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'rci_request': {
-                        '@version': '1.1',
-                        'query_setting': {},
-                    },
-                },
-            },
+        params = {
+            'startTime': start_time,
+            'endTime': end_time,
+            'size': size,
+            'rollupInterval': rollup_interval,
+            'rollupMethod': rollup_method,
         }
+        uri = ws_uri.format(
+            resource=DATAPOINT_RESOURCE, fqdn=self.cloud_fqdn,
+            path_filter=stream_id)
+        while True:
+            page = _parse_response(self._get(uri, params=params))
+            yield page
 
-        # If a settings group is provided, limit query to just that group
-        if settings_group:
-            rci_req = post_dict['sci_request']['send_message']['rci_request']
-            rci_req['query_setting'][settings_group] = {}
+            # A short page is the last, so needs no request to find the end
+            cursor = page.get('pageCursor')
+            if not cursor or len(page.get('items') or []) < size:
+                return
+            params['pageCursor'] = cursor
 
-        post_body = xmltodict.unparse(post_dict)
+    def iter_datapoints(self, stream_id, start_time=None, end_time=None,
+                        size=DATAPOINT_PAGE_SIZE, rollup_interval=None,
+                        rollup_method=None):
+        """
+        Generator over every DataPoint in a time range, oldest first. Takes
+        the same arguments as iter_datapoint_pages.
+        """
+        for page in self.iter_datapoint_pages(stream_id, start_time,
+                                              end_time, size,
+                                              rollup_interval, rollup_method):
+            for point in page.get('items') or []:
+                yield point
+
+    def _send_rci(self, device_ids, rci_body, cache=None, keep=None):
+        """
+        Send an RCI request to one or more devices via SCI send_message
+
+        Args:
+            device_ids list(str) - The devices to target
+            rci_body (str) - Rendered contents of the rci_request element
+
+        Kwargs:
+            cache (bool) - Whether to use Device Cloud cache. If None, the
+                            attribute is omitted.
+            keep (dict) - Parts of an XML reply to include, as for
+                            _parse_response
+
+        Returns:
+            Python dict representation of xml response (using xmltodict lib)
+        """
+        send_message = _SEND_MESSAGE[cache is not None].render(
+            targets=_sci_targets(device_ids), rci_body=rci_body,
+            cache=str(cache))
+        post_body = _SCI_REQUEST.render(operations=send_message)
 
         uri = ws_uri.format(
             resource=SCI_RESOURCE, fqdn=self.cloud_fqdn, path_filter="")
         r = self._post(uri, data=post_body)
 
-        return _parse_response(r)
+        return _parse_response(r, keep)
+
+    @_single_flight
+    def get_device_settings(self, device_id, settings_group=None, cache=False,
+                            keep_groups=None):
+        """
+        Get the settings for a device by doing an RCI query_setting
+
+        Args:
+            device_id (str) - The device to query
+
+        Kwargs:
+            cache (bool) - Whether to use Device Cloud cache. Default False.
+            keep_groups list(str) - Only include these settings groups in the
+                            result. The device still reports every group, but
+                            the others aren't converted.
+
+        Returns:
+            Python dict representation of xml response (using xmltodict lib)
+        """
+        return self._send_rci([device_id],
+                              _query_setting_body(settings_group), cache,
+                              keep=_query_setting_keep(keep_groups))
+
+    def get_device_settings_batch(self, device_ids, settings_group=None,
+                                  cache=False, keep_groups=None):
+        """
+        Batched get_device_settings, querying many devices in one request
+
+        Args:
+            device_ids list(str) - The devices to query
+
+        Kwargs:
+            keep_groups list(str) - As for get_device_settings
+
+        Returns:
+            dict of device id to that device's reply element
+        """
+        reply = self._send_rci(device_ids,
+                               _query_setting_body(settings_group), cache,
+                               keep=_query_setting_keep(keep_groups))
+        return _split_sci_reply(reply, 'send_message')
 
     def set_device_settings(self, device_id, settings={}):
         """
@@ -276,37 +644,27 @@ class DeviceCloudConnector(object):
             settings (dict) - Nested dictionary, of the form
                     `{'setting_group': {'key': value, 'key2': 'value2'}, }`
 
-        Kwargs:
-            cache (bool) - Whether to use Device Cloud cache. Default False.
-
         Returns:
             Python dict representation of xml response (using xmltodict lib)
         """
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'send_message': {
-                    '@cache': "False",
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'rci_request': {
-                        '@version': '1.1',
-                        'set_setting': settings,
-                    },
-                },
-            },
-        }
+        return self._send_rci([device_id], element('set_setting', settings),
+                              cache=False)
 
-        post_body = xmltodict.unparse(post_dict)
+    def set_device_settings_batch(self, device_ids, settings={}):
+        """
+        Batched set_device_settings, sending the same settings to many devices
+        in one request
 
-        uri = ws_uri.format(resource=SCI_RESOURCE,
-                            fqdn=self.cloud_fqdn, path_filter="")
-        r = self._post(uri, data=post_body)
+        Args:
+            device_ids list(str) - The devices to configure
+            settings (dict) - Nested dictionary, as in set_device_settings
 
-        return _parse_response(r)
+        Returns:
+            dict of device id to that device's reply element
+        """
+        reply = self._send_rci(device_ids, element('set_setting', settings),
+                               cache=False)
+        return _split_sci_reply(reply, 'send_message')
 
     def set_output_mask(self, device_id, enable_mask):
         """
@@ -319,34 +677,8 @@ class DeviceCloudConnector(object):
                                 pins
 
         """
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'send_message': {
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'rci_request': {
-                        '@version': '1.1',
-                        'set_state': {
-                            'Executable': {
-                                'OM': enable_mask,
-                            },
-                        },
-                    },
-                },
-            },
-        }
-
-        post_body = xmltodict.unparse(post_dict)
-
-        uri = ws_uri.format(resource=SCI_RESOURCE,
-                            fqdn=self.cloud_fqdn, path_filter="")
-        r = self._post(uri, data=post_body)
-
-        return _parse_response(r)
+        return self._send_rci(
+            [device_id], _SET_OUTPUT_MASK.render(enable_mask=enable_mask))
 
     def set_output_levels(self, device_id, io_mask):
         """
@@ -358,34 +690,8 @@ class DeviceCloudConnector(object):
             io_mask (str) - hex string of bit map that specifies pin levels
 
         """
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'send_message': {
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'rci_request': {
-                        '@version': '1.1',
-                        'set_state': {
-                            'Executable': {
-                                'IO': io_mask,
-                            },
-                        },
-                    },
-                },
-            },
-        }
-
-        post_body = xmltodict.unparse(post_dict)
-
-        uri = ws_uri.format(resource=SCI_RESOURCE,
-                            fqdn=self.cloud_fqdn, path_filter="")
-        r = self._post(uri, data=post_body)
-
-        return _parse_response(r)
+        return self._send_rci(
+            [device_id], _SET_OUTPUT_LEVELS.render(io_mask=io_mask))
 
     def set_output(self, device_id, enable_mask, io_mask):
         """
@@ -398,58 +704,42 @@ class DeviceCloudConnector(object):
             io_mask (str) - hex string of bit map that specifies pin levels
 
         """
-        # Note: using an ordered dict to ensure OM command comes first in
-        # rendered xml
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'send_message': {
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'rci_request': {
-                        '@version': '1.1',
-                        'set_state': {
-                            'Executable': OrderedDict(
-                                [('OM', enable_mask), ('IO', io_mask)])
-                        },
-                    },
-                },
-            },
-        }
-
-        post_body = xmltodict.unparse(post_dict)
+        return self._send_rci([device_id],
+                              _set_output_body(enable_mask, io_mask))
 
-        uri = ws_uri.format(resource=SCI_RESOURCE,
-                            fqdn=self.cloud_fqdn, path_filter="")
-        r = self._post(uri, data=post_body)
+    def set_output_batch(self, device_ids, enable_mask, io_mask):
+        """
+        Batched set_output, applying the same IO state to many devices in one
+        request
 
-        return _parse_response(r)
+        Returns:
+            dict of device id to that device's reply element
+        """
+        reply = self._send_rci(device_ids,
+                               _set_output_body(enable_mask, io_mask))
+        return _split_sci_reply(reply, 'send_message')
 
     def create_monitor(self, topic, url, auth_user, auth_pass,
                        description=None, batch_size=None, batch_duration=None):
         """
         Create a new Device Cloud http monitor for the specified topic
         """
-        post_dict = {
-            'Monitor': {
-                'monTopic': topic,
-                'monTransportType': 'http',
-                'monTransportUrl': url,
-                'monTransportToken': ':'.join([auth_user, auth_pass]),
-                'monFormatType': 'json',
-            },
+        monitor = {
+            'monTopic': topic,
+            'monTransportType': 'http',
+            'monTransportUrl': url,
+            'monTransportToken': ':'.join([auth_user, auth_pass]),
+            'monFormatType': 'json',
         }
         if description:
-            post_dict['Monitor']['monDescription'] = description
+            monitor['monDescription'] = description
         if batch_size:
-            post_dict['Monitor']['monBatchSize'] = batch_size
+            monitor['monBatchSize'] = batch_size
         if batch_duration:
-            post_dict['Monitor']['monBatchDuration'] = batch_duration
+            monitor['monBatchDuration'] = batch_duration
 
-        post_body = xmltodict.unparse(post_dict)
+        # Optional fields vary the shape, so this isn't a template
+        post_body = sci.XML_DECLARATION + element('Monitor', monitor)
 
         uri = ws_uri.format(resource=MONITOR_RESOURCE,
                             fqdn=self.cloud_fqdn, path_filter="")
@@ -458,19 +748,24 @@ class DeviceCloudConnector(object):
         return _parse_response(r)
 
     def create_datapoint_monitor(self, device_id, url, auth_user,
-                                 auth_pass, description=None):
+                                 auth_pass, description=None, batch_size=1000,
+                                 batch_duration=1):
         """
         Create a new Device Cloud monitor for the DataPoint resource, filtering
         to channels for given device id, and enabling batching
+
+        A device_id of None monitors DataPoints from every device in the
+        account.
         """
-        topic = '/'.join([DATAPOINT_RESOURCE, device_id])
+        topic = _datapoint_topic(device_id)
 
         return self.create_monitor(
-            topic, url, auth_user, auth_pass, description, batch_size=1000,
-            batch_duration=1)
+            topic, url, auth_user, auth_pass, description,
+            batch_size=batch_size, batch_duration=batch_duration)
 
     def create_devicecore_monitor(self, url, auth_user, auth_pass,
-                                  description=None):
+                                  description=None, batch_size=1000,
+                                  batch_duration=1):
         """
         Create a new Device Cloud monitor for the DeviceCore resource
         """
@@ -478,7 +773,7 @@ class DeviceCloudConnector(object):
 
         return self.create_monitor(
             topic, url, auth_user, auth_pass, description,
-            batch_size=1000, batch_duration=1)
+            batch_size=batch_size, batch_duration=batch_duration)
 
     def get_monitors(self, topics=[], urls=[]):
         """
@@ -505,9 +800,9 @@ class DeviceCloudConnector(object):
     def get_datapoint_monitor_for_device(self, device_id, url):
         """
         Wrapper around get_monitors, with the default topic generated from
-        device_id
+        device_id. A device_id of None finds the account-wide monitor.
         """
-        topics = ['/'.join([DATAPOINT_RESOURCE, device_id])]
+        topics = [_datapoint_topic(device_id)]
 
         return self.get_monitors(topics, [url])
 
@@ -524,14 +819,23 @@ class DeviceCloudConnector(object):
         Monitors may go inactive after a number of failed pushes, or be in a
         backoff state. An empty PUT will make it active again or reset backoff.
         """
-        put_dict = {
-            'Monitor': {
-                'monId': monitor_id,
-                # Update the monitor with the most up-to-date auth information
-                'monTransportToken': ':'.join([auth_user, auth_pass]),
-            },
-        }
-        put_body = xmltodict.unparse(put_dict)
+        put_body = _KICK_MONITOR.render(
+            monitor_id=monitor_id, token=':'.join([auth_user, auth_pass]))
+
+        uri = ws_uri.format(resource=MONITOR_RESOURCE,
+                            fqdn=self.cloud_fqdn, path_filter=monitor_id)
+        r = self._put(uri, data=put_body)
+
+        return _parse_response(r)
+
+    def set_monitor_batching(self, monitor_id, batch_size, batch_duration):
+        """
+        Change how many events a monitor collects (batch_size), and for how
+        many seconds (batch_duration), before pushing them
+        """
+        put_body = _SET_MONITOR_BATCHING.render(
+            monitor_id=monitor_id, batch_size=batch_size,
+            batch_duration=batch_duration)
 
         uri = ws_uri.format(resource=MONITOR_RESOURCE,
                             fqdn=self.cloud_fqdn, path_filter=monitor_id)
@@ -552,27 +856,73 @@ class DeviceCloudConnector(object):
                                 mode. Defaults to empty.
 
         """
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'data_service': {
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'requests': {
-                        'device_request': {
-                            '@target_name': target_name,
-                            '@format': 'base64',
-                            '#text': data_b64,
-                        }
-                    },
-                },
-            },
-        }
+        return self._send_data_service([device_id], data_b64, target_name)
+
+    def send_serial_data_batch(self, device_ids, data_b64, target_name=''):
+        """
+        Batched send_serial_data, sending the same payload to many devices in
+        one request
+
+        Returns:
+            dict of device id to that device's reply element
+        """
+        reply = self._send_data_service(device_ids, data_b64, target_name)
+        return _split_sci_reply(reply, 'data_service')
+
+    def send_device_commands(self, device_id, enable_mask=None,
+                             io_mask=None, settings=None, data_b64=None,
+                             target_name=''):
+        """
+        Set output levels, change settings and send serial data in a single
+        SCI request. The set_state and set_setting go in one RCI request,
+        followed by a data_service operation.
+
+        Args:
+            device_id (str) - The device to send the commands to
+
+        Kwargs:
+            enable_mask (str) - hex string of bit map of pins to set, as for
+                                set_output. Levels are left alone if None.
+            io_mask (str) - hex string of bit map of pin levels
+            settings (dict) - Nested settings dictionary, as for
+                                set_device_settings
+            data_b64 (str) - Base64 encoded serial payload
+            target_name (str) - Data service target for the serial payload
+
+        Returns:
+            OrderedDict of each operation performed ('set_state',
+            'set_setting', 'data_service') to the device's reply to it
+        """
+        rci_body = []
+        if enable_mask is not None:
+            rci_body.append(_SET_OUTPUT.render(enable_mask=enable_mask,
+                                               io_mask=io_mask))
+        if settings:
+            rci_body.append(element('set_setting', settings))
+
+        targets = _sci_targets([device_id])
+        operations = []
+        if rci_body:
+            operations.append(_SEND_MESSAGE[True].render(
+                targets=targets, rci_body=''.join(rci_body), cache='False'))
+        if data_b64 is not None:
+            operations.append(_DATA_SERVICE.render(
+                targets=targets, target_name=target_name, data=data_b64))
+        post_body = _SCI_REQUEST.render(operations=''.join(operations))
+
+        uri = ws_uri.format(resource=SCI_RESOURCE,
+                            fqdn=self.cloud_fqdn, path_filter="")
+        r = self._post(uri, data=post_body)
+
+        return _split_composite_reply(_parse_response(r), device_id,
+                                      enable_mask is not None,
+                                      bool(settings), data_b64 is not None)
 
-        post_body = xmltodict.unparse(post_dict)
+    def _send_data_service(self, device_ids, data_b64, target_name):
+        data_service = _DATA_SERVICE.render(
+            targets=_sci_targets(device_ids), target_name=target_name,
+            data=data_b64)
+        post_body = _SCI_REQUEST.render(operations=data_service)
 
         uri = ws_uri.format(resource=SCI_RESOURCE,
                             fqdn=self.cloud_fqdn, path_filter="")
@@ -0,0 +1,153 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Cache of Device Cloud listing responses
+
+Device listings change rarely but are asked for on every page navigation.
+Responses are kept per account for a time to live, in a bounded least-
+recently-used cache, and dropped early when something says they have
+changed: provisioning a device, or a DeviceCore push for one of the devices
+they list.
+"""
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry(object):
+
+    __slots__ = ('value', 'expires', 'account', 'device_ids', 'wide')
+
+    def __init__(self, value, expires, account, device_ids, wide):
+        self.value = value
+        self.expires = expires
+        self.account = account
+        self.device_ids = device_ids
+        self.wide = wide
+
+
+class ResponseCache(object):
+    """
+    Bounded, least-recently-used cache of parsed responses with a time to
+    live per method. Keys start with the account, (username, cloud_fqdn).
+    """
+
+    def __init__(self, max_size=1000, ttls=None):
+        """
+        Kwargs:
+            max_size (int): Maximum number of responses to keep. The least
+                            recently used is dropped when full.
+            ttls (dict): Connector method name to the seconds its responses
+                            are kept. Methods not listed aren't cached.
+        """
+        self.max_size = max_size
+        self.ttls = ttls or {}
+        # key -> _Entry, ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a response fetched across one
+        # isn't stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ttl(self, method):
+        """
+        Seconds to keep responses of a connector method, or None if they
+        aren't cached
+        """
+        return self.ttls.get(method)
+
+    def get(self, key):
+        """
+        Return a copy of the cached response for key
+
+        Raises KeyError if there is none, or it has expired
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry.expires <= time.time():
+                self.misses += 1
+                raise KeyError(key)
+            # Re-inserting keeps the dict ordered from least to most recent
+            self._entries[key] = entry
+            self.hits += 1
+            value = entry.value
+        # Callers may modify what they get back
+        return copy.deepcopy(value)
+
+    def put(self, key, value, ttl, device_ids=(), wide=False,
+            generation=None):
+        """
+        Cache a response
+
+        Args:
+            key (tuple): (username, cloud_fqdn) followed by anything naming
+                         the request
+            value: Parsed response. A copy is kept.
+            ttl (int): Seconds to keep it
+        Kwargs:
+            device_ids (iterable): Devices the response describes
+            wide (bool): The response lists the whole account, so would
+                         change if a device were added to it
+            generation (int): self.generation when the request was made. If
+                         anything was invalidated since, the response may
+                         already be stale and isn't kept.
+        """
+        value = copy.deepcopy(value)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = _Entry(value, time.time() + ttl, key[:2],
+                                        frozenset(device_ids), wide)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_account(self, username, cloud_fqdn):
+        """
+        Drop every response cached for an account
+        """
+        account = (username, cloud_fqdn)
+        self._drop(lambda entry: entry.account == account)
+
+    def invalidate_device(self, device_id):
+        """
+        Drop every response describing a device. A device no cached response
+        knows of may be new to its account, which can't be told from the
+        device id, so then every account wide listing is dropped.
+        """
+        if not self._drop(lambda entry: device_id in entry.device_ids):
+            logger.debug('Device %s not cached, dropping account listings'
+                         % device_id)
+            self._drop(lambda entry: entry.wide)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def _drop(self, match):
+        """
+        Drop matching entries, returning how many there were
+        """
+        with self._lock:
+            self.generation += 1
+            keys = [key for key, entry in self._entries.iteritems()
+                    if match(entry)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
@@ -0,0 +1,170 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+XML request bodies for Device Cloud web services
+
+Most requests have a fixed shape in which only a few values (device ids,
+masks, payloads) change. Each shape is compiled once into a Template: it is
+rendered by xmltodict with markers in place of the values, and split into
+literal byte strings around them. Rendering a request then only escapes the
+values and joins the pieces, producing the same bytes xmltodict would.
+
+Shapes which vary from call to call, like the settings in a set_setting,
+are written by element(), a direct equivalent of xmltodict.unparse.
+'''
+import re
+from collections import OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+import xmltodict
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+# Stands in for a value while a template is compiled
+_MARKER = '\x01%d\x01'
+_MARKER_PATTERN = re.compile('\x01(\\d+)\x01')
+
+TEXT = 'text'
+ATTRIBUTE = 'attribute'
+RAW = 'raw'
+
+
+class Value(object):
+    """
+    Placeholder for a value in a template shape, used as element text or an
+    attribute value. Escaped when rendered.
+    """
+    raw = False
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Raw(Value):
+    """
+    Placeholder for already rendered XML in a template shape, e.g. the
+    elements inside a targets element
+    """
+    raw = True
+
+
+def _bytes(value):
+    """
+    Value as utf-8 bytes, converting non-strings as xmltodict does
+    """
+    if isinstance(value, str):
+        return value
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return value.encode('utf-8')
+
+
+class Template(object):
+    """
+    An XML document or fragment compiled from an xmltodict style shape, with
+    Value and Raw placeholders filled in by render()
+    """
+
+    def __init__(self, shape, declaration=True):
+        """
+        Args:
+            shape (dict): xmltodict.unparse input with a single root element.
+                          Values may be Value or Raw placeholders.
+        Kwargs:
+            declaration (bool): Start with an XML declaration. Fragments for
+                          use in other templates should leave it out.
+        """
+        placeholders = []
+        xml = _bytes(xmltodict.unparse(self._mark(shape, placeholders)))
+        if not declaration:
+            xml = xml[len(XML_DECLARATION):]
+
+        pieces = _MARKER_PATTERN.split(xml)
+        literals = pieces[0::2]
+        fields = []
+        for n, index in enumerate(pieces[1::2]):
+            placeholder = placeholders[int(index)]
+            kind = TEXT
+            if placeholder.raw:
+                kind = RAW
+            elif literals[n].endswith('="') and \
+                    literals[n + 1].startswith('"'):
+                # quoteattr picks the quotes when rendering
+                literals[n] = literals[n][:-1]
+                literals[n + 1] = literals[n + 1][1:]
+                kind = ATTRIBUTE
+            fields.append((placeholder.name, kind))
+        self._literals = literals
+        self._fields = fields
+
+    def render(self, **values):
+        """
+        Return the XML bytes with each placeholder's value filled in. A text
+        value of None renders as an empty element.
+        """
+        literals = self._literals
+        out = [literals[0]]
+        for n, (name, kind) in enumerate(self._fields):
+            value = values[name]
+            if kind == TEXT:
+                if value is not None:
+                    out.append(escape(_bytes(value)))
+            elif kind == ATTRIBUTE:
+                out.append(quoteattr(_bytes(value)))
+            else:
+                out.append(_bytes(value))
+            out.append(literals[n + 1])
+        return ''.join(out)
+
+    def _mark(self, node, placeholders):
+        if isinstance(node, Value):
+            placeholders.append(node)
+            return _MARKER % (len(placeholders) - 1)
+        if isinstance(node, dict):
+            # Keep the shape's own key order
+            return OrderedDict((key, self._mark(value, placeholders))
+                               for key, value in node.items())
+        if isinstance(node, (list, tuple)):
+            return [self._mark(value, placeholders) for value in node]
+        return node
+
+
+def element(name, value):
+    """
+    Render an element (without XML declaration) from an xmltodict style
+    value, as xmltodict.unparse would
+    """
+    out = []
+    _emit(out, name, value)
+    return ''.join(out)
+
+
+def _emit(out, name, value):
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    for v in value:
+        if v is None:
+            v = {}
+        elif not isinstance(v, dict):
+            v = {'#text': v}
+        out.append('<' + name)
+        children = []
+        text = None
+        for key, item in v.items():
+            if key == '#text':
+                text = item
+            elif key.startswith('@'):
+                out.append(' %s=%s' % (key[1:], quoteattr(_bytes(item))))
+            else:
+                children.append((key, item))
+        out.append('>')
+        for key, item in children:
+            _emit(out, key, item)
+        if text is not None:
+            out.append(escape(_bytes(text)))
+        out.append('</%s>' % name)
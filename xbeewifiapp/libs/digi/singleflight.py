@@ -0,0 +1,113 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Coalescing of identical concurrent calls
+
+When a class logs in at once, many requests for the same account ask Device
+Cloud the same question at the same moment. A SingleFlight lets the first
+caller for a key make the call while later callers with the same key wait
+for it and share its result, rather than each sending their own request.
+
+Only calls overlapping in time are shared; nothing is cached once the call
+completes.
+"""
+import copy
+import weakref
+import gevent
+from gevent.event import AsyncResult
+
+
+class _Interrupted(Exception):
+    """
+    The caller making a shared call was killed or timed out before it
+    completed
+    """
+
+
+class _Flight(object):
+    """
+    A call in progress, and how many other callers are waiting on it
+    """
+
+    def __init__(self):
+        self.result = AsyncResult()
+        self.waiters = 0
+
+
+def freeze(value):
+    """
+    Hashable equivalent of a call argument made of dicts, lists and scalars
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time, sharing its result (or
+    exception) with every caller who asked for the same key meanwhile.
+
+    Each caller gets its own deep copy of a shared result, so callers may
+    modify what they get back.
+    """
+
+    def __init__(self):
+        # As with InFlightLimiter, gevent primitives can't be shared across
+        # OS threads, so calls are only shared within a hub
+        self._flights = weakref.WeakKeyDictionary()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Return func(*args, **kwargs), or the result of an identical call
+        already in flight
+
+        Args:
+            key: Hashable identity of the call. Calls with equal keys must be
+                 interchangeable.
+            func (callable): The call to make if none is in flight for key
+        """
+        flights = self._flights.setdefault(gevent.get_hub(), {})
+        flight = flights.get(key)
+        if flight is not None:
+            self.shared += 1
+            flight.waiters += 1
+            try:
+                return copy.deepcopy(flight.result.get())
+            except _Interrupted:
+                # Nothing wrong with the call itself, so make it again
+                return self.do(key, func, *args, **kwargs)
+
+        flight = flights[key] = _Flight()
+        self.calls += 1
+        try:
+            result = func(*args, **kwargs)
+        except Exception, e:
+            flight.result.set_exception(e)
+            raise
+        except BaseException:
+            # GreenletExit or a Timeout is about this caller, not the call;
+            # waiters mustn't be left waiting, nor be killed along with it
+            flight.result.set_exception(_Interrupted())
+            raise
+        else:
+            flight.result.set(result)
+        finally:
+            del flights[key]
+        if flight.waiters:
+            # Keep the shared copy intact until the waiters have their own
+            return copy.deepcopy(result)
+        return result
+
+    def __len__(self):
+        return sum(len(flights) for flights in self._flights.values())
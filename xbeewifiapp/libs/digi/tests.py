@@ -18,9 +18,20 @@ from django.test import TestCase
 from auth import DeviceCloudBackend
 from forms import DeviceCloudAuthenticationForm
 from devicecloud import DeviceCloudConnector
+from connections import ConnectorRegistry
+from responsecache import ResponseCache
+from datapoint import DataPoint
+from concurrency import AsyncConnector, InFlightLimiter, wait_all, \
+    DeviceCommandQueue
+import xmlparse
+import xmltodict
+import sci
+from collections import OrderedDict
+import gevent
 from requests.exceptions import HTTPError, ConnectionError
 from requests import Response
 import json
+import base64
 
 User = get_user_model()
 
@@ -204,6 +215,38 @@ TEST_RESPONSES = {
 }
 
 
+class DataPointPages(object):
+    """
+    Fake Session.get serving DataPoint queries a page at a time from a list
+    of points, following pageCursor. Patched in as a side_effect, it records
+    the params of each request.
+    """
+
+    def __init__(self, points):
+        self.points = points
+        # Served instead for rollupMethod=count queries
+        self.counts = []
+        # Raise ConnectionError for pages starting at or after this index
+        self.fail_after = None
+        # Answer rollup queries with a 400
+        self.refuse_rollups = False
+        self.requests = []
+
+    def __call__(self, session, uri, params=None):
+        self.requests.append(dict(params))
+        start = int(params.get('pageCursor', 0))
+        if self.fail_after is not None and start >= self.fail_after:
+            raise ConnectionError('Lost connection')
+        if self.refuse_rollups and params.get('rollupInterval'):
+            raise HTTPError(response=MagicMock(status_code=400))
+        points = self.counts if params.get('rollupMethod') == 'count' else self.points
+        response = MagicMock(status_code=200, headers={'Content-Type': 'application/json'})
+        response.json.return_value = {
+            'items': points[start:start + params['size']],
+            'pageCursor': str(start + params['size'])}
+        return response
+
+
 class DeviceCloudConnectorTestCase(TestCase):
     """
     Base class to be extended by tests using the DeviceCloudConnector
@@ -424,6 +467,41 @@ class DeviceCloudConnectorDataPointTest(DeviceCloudConnectorTestCase):
         self.assertEqual(datapoints['items'][0]['streamId'], stream_id)
         self.assertEqual(datapoints['items'][0]['data'], "0")
 
+    def test_datapoint_rollup(self):
+        self.cloud.get_datapoints("stream", rollup_interval='hour', rollup_method='max')
+        params = self.patched_get.call_args[1]['params']
+        self.assertEqual(params['rollupInterval'], 'hour')
+        self.assertEqual(params['rollupMethod'], 'max')
+
+
+class DeviceCloudConnectorDataPointPagesTest(DeviceCloudConnectorTestCase):
+
+    def setUp(self):
+        super(DeviceCloudConnectorDataPointPagesTest, self).setUp()
+        # Five points, served two per page
+        self.pages = DataPointPages([{'id': str(n), 'data': str(n)} for n in range(5)])
+        self.patched_get.side_effect = self.pages
+
+    def test_follows_page_cursor(self):
+        points = list(self.cloud.iter_datapoints('stream', '2015-01-01T00:00:00z', size=2))
+        self.assertEqual(points, self.pages.points)
+        # The short third page is the last
+        self.assertEqual(len(self.pages.requests), 3)
+        self.assertNotIn('pageCursor', self.pages.requests[0])
+        self.assertEqual(self.pages.requests[2]['pageCursor'], '4')
+        self.assertEqual(self.pages.requests[2]['startTime'], '2015-01-01T00:00:00z')
+
+    def test_lazy(self):
+        pages = self.cloud.iter_datapoint_pages('stream', size=2)
+        self.assertEqual(self.patched_get.call_count, 0)
+        self.assertEqual(len(next(pages)['items']), 2)
+        self.assertEqual(self.patched_get.call_count, 1)
+
+    def test_full_last_page(self):
+        # A full last page needs an empty one to show it was the last
+        del self.pages.points[4]
+        self.assertEqual(len(list(self.cloud.iter_datapoint_pages('stream', size=2))), 3)
+
 
 class DeviceCloudConnectorDeviceSettingsTest(DeviceCloudConnectorTestCase):
 
@@ -460,6 +538,188 @@ class DeviceCloudConnectorDeviceSettingsTest(DeviceCloudConnectorTestCase):
         xml = """<?xml version="1.0" encoding="utf-8"?>\n<sci_request version="1.0"><send_message cache="False"><rci_request version="1.1"><set_setting><InputOutput><D0>Disabled</D0></InputOutput></set_setting></rci_request><targets><device id="00000000-00000000-00000000-00000001"></device></targets></send_message></sci_request>"""
         self.assertEqual(self.patched_post.call_args[1]['data'], xml)
 
+    def test_settings_xml_reply(self):
+        self.patched_post.return_value.headers = {'Content-Type': 'application/xml;charset=UTF-8'}
+        self.patched_post.return_value.content = SCI_QUERY_SETTING_XML
+        settings = self.cloud.get_device_settings("00000000-00000000-00000000-00000001")
+        self.assertEqual(settings, xmltodict.parse(SCI_QUERY_SETTING_XML))
+
+        settings = self.cloud.get_device_settings("00000000-00000000-00000000-00000001", keep_groups=['InputOutput'])
+        query_setting = settings['sci_reply']['send_message']['device']['rci_reply']['query_setting']
+        self.assertEqual(query_setting.keys(), ['InputOutput'])
+        self.assertEqual(query_setting['InputOutput']['D0'], 'Input')
+
+    def test_settings_error_reply_kept(self):
+        self.patched_post.return_value.headers = {'Content-Type': 'application/xml;charset=UTF-8'}
+        self.patched_post.return_value.content = SCI_QUERY_SETTING_XML.replace(
+            '<query_setting>', '<query_setting><error id="1"><desc>Field specified does not exist</desc>'
+            '<hint>Bogus</hint></error>')
+        settings = self.cloud.get_device_settings("00000000-00000000-00000000-00000001", keep_groups=['InputOutput'])
+        query_setting = settings['sci_reply']['send_message']['device']['rci_reply']['query_setting']
+        self.assertEqual(query_setting['error'], {'@id': '1', 'desc': 'Field specified does not exist', 'hint': 'Bogus'})
+
+
+SCI_QUERY_SETTING_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<sci_reply version="1.0">
+  <send_message>
+    <device id="00000000-00000000-00000000-00000001">
+      <rci_reply version="1.1">
+        <query_setting>
+          <!-- a comment -->
+          <Network><DO>0x15</DO><NI></NI></Network>
+          <InputOutput><D0>Input</D0><D1>ADC</D1><IR>5000</IR></InputOutput>
+          <Serial><AP>0</AP><BD>3</BD></Serial>
+          <Other note="mixed">before <b>1</b> caf\xc3\xa9 <b>2</b></Other>
+        </query_setting>
+      </rci_reply>
+    </device>
+  </send_message>
+</sci_reply>"""
+
+
+class XMLParseTest(TestCase):
+
+    def test_matches_xmltodict(self):
+        for xml in (SCI_QUERY_SETTING_XML, '<a/>', '<a x="1"/>', '<a> text </a>', '<a><b/><b>1</b><c/></a>',
+                    '<a x="1">t<b y="2">u</b></a>', '<?xml version="1.0" encoding="utf-8"?><a>\xc3\xa9</a>'):
+            self.assertEqual(xmlparse.parse(xml), xmltodict.parse(xml))
+
+    def test_keep(self):
+        keep = {'query_setting': set(['Serial', 'Missing'])}
+        result = xmlparse.parse(SCI_QUERY_SETTING_XML, keep)
+        query_setting = result['sci_reply']['send_message']['device']['rci_reply']['query_setting']
+        self.assertEqual(query_setting, {'Serial': {'AP': '0', 'BD': '3'}})
+
+    def test_namespaces(self):
+        xml = '<a xmlns:n="urn:x"><n:b>1</n:b><c>2</c></a>'
+        self.assertEqual(xmlparse.parse(xml), xmltodict.parse(xml))
+        self.assertEqual(xmlparse.parse(xml, {'a': ['c']}), {'a': {'@xmlns:n': 'urn:x', 'c': '2'}})
+
+
+class SCITemplateTest(TestCase):
+
+    def test_template_matches_xmltodict(self):
+        template = sci.Template({'a': OrderedDict([('@x', sci.Value('x')), ('b', sci.Value('b')),
+                                                   ('c', {'#text': sci.Raw('c')})])})
+        for x, b in (('1', '2'), ('q"uote', '<&>'), ("both'\"", u'\u00e9'), ('', None), (5, 10)):
+            expected = xmltodict.unparse({'a': OrderedDict([('@x', unicode(x)), ('b', b), ('c', None)])})
+            rendered = template.render(x=x, b=b, c='')
+            self.assertEqual(rendered, expected.encode('utf-8'))
+        self.assertEqual(template.render(x='1', b='2', c='<d>raw</d>'),
+                         sci.XML_DECLARATION + '<a x="1"><b>2</b><c><d>raw</d></c></a>')
+
+    def test_fragment(self):
+        template = sci.Template({'a': {'b': sci.Value('b')}}, declaration=False)
+        self.assertEqual(template.render(b='1'), '<a><b>1</b></a>')
+
+    def test_element_matches_xmltodict(self):
+        values = [{'InputOutput': {'D0': 'Disabled', 'D1': None}, 'Serial': {'AP': 0}},
+                  {'@id': 'x"y', 'device': [{'@id': '1'}, {'@id': '2'}], '#text': '<t>'},
+                  u'caf\u00e9', None]
+        for value in values:
+            expected = xmltodict.unparse({'root': value})[len(sci.XML_DECLARATION):]
+            self.assertEqual(sci.element('root', value), expected.encode('utf-8'))
+
+
+class DeviceCloudConnectorBatchTest(DeviceCloudConnectorTestCase):
+
+    def setUp(self):
+        super(DeviceCloudConnectorBatchTest, self).setUp()
+
+        result_text = """{
+            "sci_reply": {
+                "@version": "1.0",
+                "send_message": {
+                    "device": [
+                        {
+                            "@id": "00000000-00000000-00000000-00000001",
+                            "rci_reply": {"@version": "1.1", "set_state": {}}
+                        },
+                        {
+                            "@id": "00000000-00000000-00000000-00000002",
+                            "error": {"@id": "2001"}
+                        }
+                    ]
+                }
+            }
+        }"""
+        self.patched_post.return_value.json.return_value = json.loads(result_text)
+        self.device_ids = ["00000000-00000000-00000000-00000001",
+                           "00000000-00000000-00000000-00000002"]
+
+    def test_set_output_batch(self):
+        results = self.cloud.set_output_batch(self.device_ids, '0x1', '0x1')
+        self.assertEqual(self.patched_post.call_count, 1)
+        self.assertIn('<targets><device id="00000000-00000000-00000000-00000001"></device><device id="00000000-00000000-00000000-00000002"></device></targets>', self.patched_post.call_args[1]['data'])
+        self.assertEqual(sorted(results.keys()), self.device_ids)
+        self.assertIn('rci_reply', results[self.device_ids[0]])
+        self.assertIn('error', results[self.device_ids[1]])
+
+    def test_settings_batch_single_reply(self):
+        # A single device reply is an object rather than a list
+        result_text = TEST_RESPONSES['sci']['POST']
+        self.patched_post.return_value.json.return_value = json.loads(result_text)
+        results = self.cloud.get_device_settings_batch(self.device_ids[:1])
+        self.assertEqual(results.keys(), self.device_ids[:1])
+
+    def test_serial_batch(self):
+        self.cloud.send_serial_data_batch(self.device_ids, 'dGVzdA==')
+        self.assertEqual(self.patched_post.call_count, 1)
+        self.assertIn('<targets><device id="00000000-00000000-00000000-00000001"></device><device id="00000000-00000000-00000000-00000002"></device></targets></data_service>', self.patched_post.call_args[1]['data'])
+
+
+class DeviceCloudConnectorCompositeTest(DeviceCloudConnectorTestCase):
+
+    device_id = "00000000-00000000-00000000-00000001"
+
+    def setUp(self):
+        super(DeviceCloudConnectorCompositeTest, self).setUp()
+        self.patched_post.return_value.headers = {'Content-Type': 'application/json'}
+
+    def reply(self, device_reply):
+        self.patched_post.return_value.json.return_value = {
+            "sci_reply": {
+                "@version": "1.0",
+                "send_message": {"device": dict(device_reply, **{"@id": self.device_id})},
+                "data_service": {"device": {"@id": self.device_id, "requestId": "1"}}
+            }
+        }
+
+    def test_single_request(self):
+        self.reply({"rci_reply": {"@version": "1.1", "set_state": None, "set_setting": {"InputOutput": None}}})
+        results = self.cloud.send_device_commands(
+            self.device_id, enable_mask='0x1', io_mask='0x1',
+            settings={'InputOutput': {'M0': '0x1'}}, data_b64='dGVzdA==')
+
+        self.assertEqual(self.patched_post.call_count, 1)
+        body = self.patched_post.call_args[1]['data']
+        self.assertIn('<send_message cache="False"><rci_request version="1.1">'
+                      '<set_state><Executable><OM>0x1</OM><IO>0x1</IO></Executable></set_state>'
+                      '<set_setting><InputOutput><M0>0x1</M0></InputOutput></set_setting></rci_request>', body)
+        self.assertIn('</send_message><data_service>', body)
+        self.assertIn('>dGVzdA==</device_request>', body)
+        self.assertEqual(results.keys(), ['set_state', 'set_setting', 'data_service'])
+        self.assertEqual(results['set_setting'], {"InputOutput": None})
+        self.assertEqual(results['data_service']['requestId'], "1")
+
+    def test_only_requested_operations(self):
+        self.reply({"rci_reply": {"@version": "1.1", "set_setting": {"InputOutput": None}}})
+        results = self.cloud.send_device_commands(
+            self.device_id, settings={'InputOutput': {'M0': '0x1'}})
+        body = self.patched_post.call_args[1]['data']
+        self.assertNotIn('set_state', body)
+        self.assertNotIn('data_service', body)
+        self.assertEqual(results.keys(), ['set_setting'])
+
+    def test_device_error(self):
+        # An error for the RCI request as a whole applies to each operation
+        self.reply({"error": {"@id": "2001", "desc": "Device not connected"}})
+        results = self.cloud.send_device_commands(
+            self.device_id, enable_mask='0x1', io_mask='0x0',
+            settings={'InputOutput': {'M0': '0x1'}})
+        self.assertIn('error', results['set_state'])
+        self.assertIn('error', results['set_setting'])
+
 
 class DeviceCloudConnectorMonitorTest(DeviceCloudConnectorTestCase):
 
@@ -500,8 +760,368 @@ class DeviceCloudConnectorMonitorTest(DeviceCloudConnectorTestCase):
         self.assertTrue(self.patched_post.called)
         self.assertIn('<monTopic>DataPoint/00000000-00000000-00000000-00000001</monTopic>' ,self.patched_post.call_args[1]['data'])
 
+    def test_monitor_account_wide_datapoint(self):
+        self.cloud.get_datapoint_monitor_for_device(None, 'url')
+        self.assertEqual("monTopic='DataPoint' and monTransportUrl='url'" ,self.patched_get.call_args[1]['params']['condition'])
+        self.cloud.create_datapoint_monitor(None, 'url', 'user', 'pass', batch_size=50, batch_duration=5)
+        self.assertIn('<monTopic>DataPoint</monTopic>' ,self.patched_post.call_args[1]['data'])
+        self.assertIn('<monBatchSize>50</monBatchSize>' ,self.patched_post.call_args[1]['data'])
+        self.assertIn('<monBatchDuration>5</monBatchDuration>' ,self.patched_post.call_args[1]['data'])
+
     def test_monitor_put(self):
         self.cloud.kick_monitor('monitor_id', 'user', 'pass')
         self.assertTrue(self.patched_put.called)
         self.assertIn('<monId>monitor_id</monId>', self.patched_put.call_args[1]['data'])
         self.assertIn('<monTransportToken>user:pass</monTransportToken>', self.patched_put.call_args[1]['data'])
+
+    def test_monitor_set_batching(self):
+        self.cloud.set_monitor_batching('monitor_id', 200, 3)
+        self.assertTrue(self.patched_put.call_args[0][1].endswith('/ws/Monitor/monitor_id'))
+        self.assertIn('<monBatchSize>200</monBatchSize>', self.patched_put.call_args[1]['data'])
+        self.assertIn('<monBatchDuration>3</monBatchDuration>', self.patched_put.call_args[1]['data'])
+
+
+class SingleFlightTest(DeviceCloudConnectorTestCase):
+
+    def setUp(self):
+        super(SingleFlightTest, self).setUp()
+        result_text = TEST_RESPONSES['DeviceCore']['GET']
+
+        def slow_get(*args, **kwargs):
+            gevent.sleep(0.01)
+            response = MagicMock(status_code=200, headers={'Content-Type': 'application/json'})
+            response.json.return_value = json.loads(result_text)
+            return response
+        self.patched_get.side_effect = slow_get
+
+    def test_identical_reads_shared(self):
+        readers = [gevent.spawn(self.cloud.get_device_list) for n in range(5)]
+        results = wait_all(readers)
+        self.assertEqual(self.patched_get.call_count, 1)
+        self.assertEqual(self.cloud._reads.calls, 1)
+        self.assertEqual(self.cloud._reads.shared, 4)
+        # Every caller may modify its own copy
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(len(set(id(result) for result in results)), 5)
+        self.assertEqual(len(self.cloud._reads), 0)
+
+    def test_different_reads_not_shared(self):
+        wait_all([gevent.spawn(self.cloud.get_device_list, device_id=str(n)) for n in range(3)])
+        self.assertEqual(self.patched_get.call_count, 3)
+
+    def test_sequential_reads_not_shared(self):
+        self.cloud.get_device_list()
+        self.cloud.get_device_list()
+        self.assertEqual(self.patched_get.call_count, 2)
+
+    def test_error_shared(self):
+        def failing_get(*args, **kwargs):
+            gevent.sleep(0.01)
+            raise ConnectionError()
+        self.patched_get.side_effect = failing_get
+        readers = [gevent.spawn(self.cloud.get_datastream_list) for n in range(3)]
+        gevent.joinall(readers)
+        self.assertTrue(all(isinstance(r.exception, ConnectionError) for r in readers))
+        self.assertEqual(self.patched_get.call_count, 1)
+        self.assertEqual(len(self.cloud._reads), 0)
+
+    def test_leader_killed(self):
+        leader = gevent.spawn(self.cloud.get_device_list)
+        gevent.sleep(0)
+        waiters = [gevent.spawn(self.cloud.get_device_list) for n in range(2)]
+        gevent.sleep(0)
+        leader.kill()
+        self.assertEqual(len(self.cloud._reads), 0)
+        # The waiters make the call again between them
+        results = wait_all(waiters, timeout=1)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(self.patched_get.call_count, 2)
+        self.assertEqual(len(self.cloud._reads), 0)
+
+
+class ResponseCacheTest(DeviceCloudConnectorTestCase):
+
+    def setUp(self):
+        super(ResponseCacheTest, self).setUp()
+        self.cache = ResponseCache(max_size=2, ttls={'get_device_list': 60})
+        self.cloud.response_cache = self.cache
+        self.patched_get.return_value.json.return_value = json.loads(TEST_RESPONSES['DeviceCore']['GET'])
+
+    def test_listing_cached(self):
+        devices = self.cloud.get_device_list()
+        devices['items'] = []
+        again = self.cloud.get_device_list()
+        self.assertEqual(self.patched_get.call_count, 1)
+        # The caller's changes didn't reach the cache
+        self.assertEqual(len(again['items']), 1)
+        self.assertEqual(self.cache.hits, 1)
+        # Different accounts and arguments are cached separately
+        DeviceCloudConnector("user2", "pass", "cloud", response_cache=self.cache).get_device_list()
+        self.cloud.get_device_list(device_id="00000000-00000000-00000000-00000002")
+        self.assertEqual(self.patched_get.call_count, 3)
+
+    def test_stream_listing_not_cached(self):
+        # Stream listings carry current values, which pushes change
+        self.cloud.get_datastream_list()
+        self.cloud.get_datastream_list()
+        self.assertEqual(self.patched_get.call_count, 2)
+
+    @patch('xbeewifiapp.libs.digi.responsecache.time.time')
+    def test_expiry(self, mock_time):
+        mock_time.return_value = 1000
+        self.cloud.get_device_list()
+        mock_time.return_value = 1061
+        self.cloud.get_device_list()
+        self.assertEqual(self.patched_get.call_count, 2)
+
+    def test_lru_eviction(self):
+        self.cloud.get_device_list(device_id='1')
+        self.cloud.get_device_list(device_id='2')
+        self.cloud.get_device_list(device_id='1')
+        self.cloud.get_device_list(device_id='3')
+        self.assertEqual(len(self.cache), 2)
+        self.cloud.get_device_list(device_id='1')
+        self.assertEqual(self.patched_get.call_count, 3)
+
+    def test_uncached_method(self):
+        self.cloud.get_datapoints('stream')
+        self.cloud.get_datapoints('stream')
+        self.assertEqual(self.patched_get.call_count, 2)
+
+    def test_provision_invalidates(self):
+        self.cloud.get_device_list()
+        self.cloud.provision_device('00:40:9d:5e:31:48')
+        self.cloud.get_device_list()
+        self.assertEqual(self.patched_get.call_count, 2)
+
+    def test_device_invalidates(self):
+        self.cloud.get_device_list()
+        self.patched_get.return_value.json.return_value = {'items': []}
+        self.cloud.get_device_list(device_id='00000000-00000000-00000000-00000002')
+        # Only the listings holding the device are dropped
+        self.cache.invalidate_device('00000000-00000000-00000000-00000001')
+        self.assertEqual(len(self.cache), 1)
+        self.cloud.get_device_list()
+        self.assertEqual(self.patched_get.call_count, 3)
+
+    def test_new_device_invalidates_account_listings(self):
+        self.cloud.get_device_list()
+        self.cloud.get_device_list(device_id='00000000-00000000-00000000-00000002')
+        self.cache.invalidate_device('00000000-00000000-00000000-00000003')
+        self.assertEqual(len(self.cache), 1)
+        self.cloud.get_device_list(device_id='00000000-00000000-00000000-00000002')
+        self.assertEqual(self.patched_get.call_count, 2)
+
+    def test_invalidated_while_in_flight(self):
+        def get_then_invalidate(*args, **kwargs):
+            self.cache.invalidate_device('00000000-00000000-00000000-00000001')
+            return self.patched_get.return_value
+        self.patched_get.side_effect = get_then_invalidate
+        self.cloud.get_device_list()
+        self.assertEqual(len(self.cache), 0)
+
+
+class ConnectorRegistryTest(TestCase):
+
+    def setUp(self):
+        self.registry = ConnectorRegistry(max_size=2, idle_timeout=60)
+
+    def test_connector_reused(self):
+        conn1 = self.registry.get('user', 'pass', 'cloud')
+        conn2 = self.registry.get('user', 'pass', 'cloud')
+        self.assertIs(conn1, conn2)
+        self.assertEqual(len(self.registry), 1)
+
+    def test_credential_change(self):
+        conn1 = self.registry.get('user', 'pass', 'cloud')
+        conn2 = self.registry.get('user', 'newpass', 'cloud')
+        self.assertIsNot(conn1, conn2)
+        self.assertEqual(conn2.r.auth, ('user', 'newpass'))
+        self.assertEqual(len(self.registry), 1)
+
+    def test_lru_eviction(self):
+        conn1 = self.registry.get('user1', 'pass', 'cloud')
+        self.registry.get('user2', 'pass', 'cloud')
+        # Touch user1 so that user2 is the least recently used
+        self.registry.get('user1', 'pass', 'cloud')
+        self.registry.get('user3', 'pass', 'cloud')
+        self.assertEqual(len(self.registry), 2)
+        self.assertIs(conn1, self.registry.get('user1', 'pass', 'cloud'))
+        self.assertNotIn(('user2', 'cloud'), self.registry._connectors)
+
+    @patch('xbeewifiapp.libs.digi.devicecloud.requests.sessions.Session.close', autospec=True)
+    @patch('xbeewifiapp.libs.digi.devicecloud.requests.sessions.Session.get', autospec=True)
+    def test_closed_after_use(self, patched_get, patched_close):
+        conn1 = self.registry.get('user', 'pass', 'cloud')
+
+        def request(session, uri, params=None):
+            # Replaced while the request is being made
+            self.assertIsNot(self.registry.get('user', 'newpass', 'cloud'), conn1)
+            self.assertFalse(patched_close.called)
+            return MagicMock(status_code=200)
+        patched_get.side_effect = request
+        conn1._get('https://cloud/ws/DeviceCore')
+        patched_close.assert_called_once_with(conn1.r)
+
+    @patch('xbeewifiapp.libs.digi.connections.time.time')
+    def test_idle_eviction(self, mock_time):
+        mock_time.return_value = 1000
+        conn1 = self.registry.get('user1', 'pass', 'cloud')
+        mock_time.return_value = 1100
+        self.registry.get('user2', 'pass', 'cloud')
+        self.assertEqual(len(self.registry), 1)
+        self.assertIsNot(conn1, self.registry.get('user1', 'pass', 'cloud'))
+
+
+class AsyncConnectorTest(DeviceCloudConnectorTestCase):
+
+    def setUp(self):
+        super(AsyncConnectorTest, self).setUp()
+        result_text = TEST_RESPONSES['DeviceCore']['GET']
+        self.patched_get.return_value.json.return_value = json.loads(result_text)
+
+    def test_future_result(self):
+        async_cloud = AsyncConnector(self.cloud)
+        future = async_cloud.get_device_list()
+        devices = future.get()
+        self.assertEqual(devices['resultSize'], "1")
+        # Non-method attributes pass straight through
+        self.assertEqual(async_cloud.cloud_fqdn, "cloud")
+
+    def test_future_exception(self):
+        self.patched_get.return_value.raise_for_status.side_effect = \
+            HTTPError()
+        futures = [AsyncConnector(self.cloud).get_device_list()]
+        self.assertRaises(HTTPError, wait_all, futures)
+
+    def test_in_flight_limit(self):
+        in_flight = []
+        peak = []
+
+        def slow_get(*args, **kwargs):
+            in_flight.append(1)
+            peak.append(len(in_flight))
+            gevent.sleep(0.01)
+            in_flight.pop()
+            return self.patched_get.return_value
+        self.patched_get.side_effect = slow_get
+
+        async_cloud = AsyncConnector(self.cloud, InFlightLimiter(2))
+        # Distinct reads, as identical ones would share one request
+        results = wait_all([async_cloud.get_device_list(device_id=str(i)) for i in range(5)])
+        self.assertEqual(len(results), 5)
+        self.assertEqual(max(peak), 2)
+
+
+class DeviceCommandQueueTest(TestCase):
+
+    def setUp(self):
+        self.queue = DeviceCommandQueue(InFlightLimiter(20))
+        self.conn = self.connector('user')
+        self.in_flight = []
+        self.peak = []
+
+        def slow_request(*args, **kwargs):
+            self.in_flight.append(1)
+            self.peak.append(len(self.in_flight))
+            gevent.sleep(0.01)
+            self.in_flight.pop()
+            return {'request': (args, kwargs)}
+        self.conn.send_device_commands.side_effect = slow_request
+        self.slow_request = slow_request
+
+    def connector(self, username):
+        conn = MagicMock(cloud_fqdn='cloud')
+        conn.r.auth = (username, 'pass')
+        return conn
+
+    def test_writes_merged_while_in_flight(self):
+        first = self.queue.submit(self.conn, 'dev', 0b011, 0b001)
+        gevent.sleep(0)
+        # Queued behind the first request, latest level per pin wins
+        second = self.queue.submit(self.conn, 'dev', 0b110, 0b100)
+        third = self.queue.submit(self.conn, 'dev', 0b010, 0b010, {'M0': '0x2'}, 'cd')
+        self.assertIs(second, third)
+
+        results = wait_all([first, second, third])
+        self.assertEqual(results[0], {'request': (('dev',), {'enable_mask': '0x3', 'io_mask': '0x1'})})
+        # Everything in a batch goes out in one request
+        self.assertEqual(self.conn.send_device_commands.call_count, 2)
+        self.conn.send_device_commands.assert_called_with(
+            'dev', enable_mask='0x6', io_mask='0x6',
+            settings={'InputOutput': {'M0': '0x2'}},
+            data_b64=base64.b64encode('cd'))
+        self.assertEqual(results[1], results[2])
+        self.assertEqual(max(self.peak), 1)
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.sent, 2)
+
+    def test_writes_kept_in_order(self):
+        first = self.queue.submit(self.conn, 'dev', 0b1, 0b1)
+        gevent.sleep(0)
+        second = self.queue.submit(self.conn, 'dev', serial_data='ab')
+        third = self.queue.submit(self.conn, 'dev', serial_data='cd')
+        # Merging would set the level before the serial data went out
+        fourth = self.queue.submit(self.conn, 'dev', 0b1, 0b0, {'M0': '0x2'})
+        self.assertIs(second, third)
+        self.assertIsNot(third, fourth)
+        wait_all([first, second, fourth])
+        self.assertEqual([c[1] for c in self.conn.send_device_commands.call_args_list], [
+            {'enable_mask': '0x1', 'io_mask': '0x1'},
+            {'data_b64': base64.b64encode('abcd')},
+            {'enable_mask': '0x1', 'io_mask': '0x0', 'settings': {'InputOutput': {'M0': '0x2'}}}])
+        self.assertEqual(max(self.peak), 1)
+
+    def test_devices_independent(self):
+        wait_all([self.queue.submit(self.conn, 'dev%d' % n, 1, 1) for n in range(3)])
+        self.assertEqual(max(self.peak), 3)
+
+    def test_accounts_not_merged(self):
+        other = self.connector('other')
+        other.send_device_commands.side_effect = self.slow_request
+        first = self.queue.submit(self.conn, 'dev', 0b01, 0b01)
+        second = self.queue.submit(other, 'dev', 0b10, 0b10)
+        self.assertIsNot(first, second)
+        wait_all([first, second])
+        # Each account's write went out with its own credentials
+        self.conn.send_device_commands.assert_called_once_with('dev', enable_mask='0x1', io_mask='0x1')
+        other.send_device_commands.assert_called_once_with('dev', enable_mask='0x2', io_mask='0x2')
+        # but one after the other
+        self.assertEqual(max(self.peak), 1)
+
+    def test_killed_worker_fails_waiters(self):
+        first = self.queue.submit(self.conn, 'dev', 1, 1)
+        gevent.sleep(0)
+        second = self.queue.submit(self.conn, 'dev', serial_data='ab')
+        third = self.queue.submit(self.conn, 'dev', 1, 0)
+        self.queue._devices[('cloud', 'dev')]['worker'].kill()
+        for future in (first, second, third):
+            self.assertRaises(gevent.GreenletExit, future.get, timeout=1)
+        self.assertEqual(len(self.queue), 0)
+
+    def test_error_reaches_waiters(self):
+        self.conn.send_device_commands.side_effect = ConnectionError()
+        futures = [self.queue.submit(self.conn, 'dev', 1, 1) for n in range(2)]
+        self.assertRaises(ConnectionError, wait_all, futures)
+        self.assertRaises(ConnectionError, futures[1].get)
+        self.assertEqual(len(self.queue), 0)
+
+
+class DataPointTest(TestCase):
+
+    msg = {'topic': '1/DataPoint/dev/DIO/0', 'operation': 'INSERTION',
+           'DataPoint': {'id': '1', 'streamId': 'dev/DIO/0', 'timestamp': 1377620227161,
+                         'serverTimestamp': 1377620227253, 'data': 0, 'quality': 0,
+                         'description': '', 'cstId': 1}}
+
+    def test_round_trip(self):
+        point = DataPoint.from_message(self.msg)
+        self.assertEqual(point.stream_id, 'dev/DIO/0')
+        self.assertEqual(point.extra, {'description': '', 'cstId': 1})
+        self.assertEqual(point.to_message(), self.msg)
+        self.assertEqual(DataPoint.from_dict(self.msg['DataPoint']).to_dict(), self.msg['DataPoint'])
+
+    def test_millis(self):
+        self.assertEqual(DataPoint(timestamp='1000').millis, 1000)
+        self.assertIsNone(DataPoint(timestamp='soon').millis)
+        self.assertEqual(DataPoint(timestamp='1000', data='1').to_dict(), {'timestamp': '1000', 'data': '1'})
@@ -0,0 +1,121 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Fast conversion of Device Cloud XML responses to xmltodict's output
+
+xmltodict drives expat through Python callbacks for every element and text
+run, after requests has decoded the whole body to unicode. Here the raw
+bytes are parsed into a tree in C (lxml if installed, otherwise
+cElementTree) and walked once to build the same nested OrderedDicts, with
+'@' prefixed attributes, '#text' for text beside attributes or children,
+and lists for repeated elements.
+
+Subtrees which aren't wanted, e.g. settings groups nobody will look at in a
+query_setting reply, can be skipped rather than converted.
+'''
+from collections import OrderedDict
+import xmltodict
+
+try:
+    from lxml import etree
+except ImportError:
+    try:
+        import xml.etree.cElementTree as etree
+    except ImportError:
+        import xml.etree.ElementTree as etree
+
+
+def parse(content, keep=None):
+    """
+    Parse an XML document into nested dicts, as xmltodict.parse would
+
+    Args:
+        content (str): Raw XML bytes
+    Kwargs:
+        keep (dict): Element name to the names of the children to convert.
+                     Other children of elements with that name are left out.
+                     For example {'query_setting': ['InputOutput']}.
+
+    Returns:
+        OrderedDict of the root element name to its contents
+
+    Raises:
+        SyntaxError (xml.etree.ElementTree.ParseError) or
+        lxml.etree.XMLSyntaxError if the document is malformed
+
+    Namespaced documents are handed to xmltodict, which keeps prefixes as
+    written rather than expanding them. Without lxml, the order of an
+    element's attributes is not preserved.
+    """
+    if 'xmlns' in content:
+        return _prune(xmltodict.parse(content), keep)
+    root = etree.fromstring(content)
+    return OrderedDict([(root.tag, _convert(root, keep or {}))])
+
+
+def _convert(elem, keep):
+    if elem.attrib:
+        item = OrderedDict(('@' + name, value)
+                           for name, value in elem.attrib.items())
+    else:
+        item = None
+
+    text = elem.text
+    wanted = keep.get(elem.tag)
+    for child in elem:
+        tail = child.tail
+        if tail:
+            text = text + tail if text else tail
+        tag = child.tag
+        if not isinstance(tag, basestring):
+            # Comments and processing instructions
+            continue
+        if wanted is not None and tag not in wanted:
+            continue
+
+        value = _convert(child, keep)
+        if item is None:
+            item = OrderedDict()
+        try:
+            existing = item[tag]
+        except KeyError:
+            item[tag] = value
+        else:
+            if isinstance(existing, list):
+                existing.append(value)
+            else:
+                item[tag] = [existing, value]
+
+    if text is not None:
+        text = text.strip() or None
+    if item is None:
+        return text
+    if text:
+        item['#text'] = text
+    return item
+
+
+def _prune(value, keep):
+    """
+    Apply keep to an already parsed document
+    """
+    if not keep:
+        return value
+    if isinstance(value, list):
+        return [_prune(v, keep) for v in value]
+    if not isinstance(value, dict):
+        return value
+    for name in value.keys():
+        wanted = keep.get(name)
+        if wanted is not None and isinstance(value[name], dict):
+            for child in value[name].keys():
+                if not child.startswith(('@', '#')) and child not in wanted:
+                    del value[name][child]
+        value[name] = _prune(value[name], keep)
+    return value
@@ -7,8 +7,10 @@
 #
 
 import os
+import tempfile
 import dj_database_url
 import binascii
+from distutils.util import strtobool
 import random
 import sys
 
@@ -301,6 +303,26 @@ LIB_DIGI_DEVICECLOUD = {
     'USERNAME_CLOUD_DELIMETER': '#',
     # Set a default cloud fdqn if not provided
     'DEFAULT_CLOUD_SERVER': 'devicecloud.digi.com',
+    # Connectors (and their keep-alive connection pools) are shared between
+    # requests for the same account. Limit how many accounts are kept open,
+    # for how long (seconds) an unused one is kept, and connections per pool.
+    'CONNECTOR_REGISTRY_SIZE': int(
+        os.environ.get('DEVICE_CLOUD_CONNECTOR_REGISTRY_SIZE', 100)),
+    'CONNECTOR_IDLE_TIMEOUT': int(
+        os.environ.get('DEVICE_CLOUD_CONNECTOR_IDLE_TIMEOUT', 300)),
+    'CONNECTION_POOL_SIZE': int(
+        os.environ.get('DEVICE_CLOUD_CONNECTION_POOL_SIZE', 10)),
+    # Maximum concurrent requests to each Device Cloud server, per worker,
+    # when requests are made asynchronously
+    'MAX_IN_FLIGHT_REQUESTS': int(
+        os.environ.get('DEVICE_CLOUD_MAX_IN_FLIGHT_REQUESTS', 20)),
+    # Device listings are cached per worker for this many seconds (0 to not
+    # cache), in a cache of at most RESPONSE_CACHE_SIZE responses.
+    # Provisioning and DeviceCore pushes drop them early.
+    'RESPONSE_CACHE_SIZE': int(
+        os.environ.get('DEVICE_CLOUD_RESPONSE_CACHE_SIZE', 1000)),
+    'DEVICE_LIST_TTL': int(
+        os.environ.get('DEVICE_CLOUD_DEVICE_LIST_TTL', 60)),
 }
 
 # Custom authentication backend for Device Cloud
@@ -324,6 +346,147 @@ SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER = \
 SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS = \
     os.environ.get('DEVICE_CLOUD_MONITOR_AUTH_PASS', "me")
 
+# Pub/sub backbone used to fan Device Cloud monitor pushes out to every worker
+# process. 'local' delivers only within the worker that received the push,
+# 'unix' forwards to all workers on this host via datagram sockets in
+# SOCKET_DIR, and 'postgres' forwards to all workers sharing the default
+# database via LISTEN/NOTIFY on CHANNEL.
+MONITOR_PUBSUB = {
+    'BACKEND': os.environ.get('MONITOR_PUBSUB_BACKEND', 'local'),
+    'SOCKET_DIR': os.environ.get(
+        'MONITOR_PUBSUB_SOCKET_DIR',
+        os.path.join(tempfile.gettempdir(), 'xbeewifiapp-monitor')),
+    'CHANNEL': os.environ.get('MONITOR_PUBSUB_CHANNEL', 'xbeewifiapp_monitor'),
+    # Seconds between each worker telling the others which devices it has
+    # sockets monitoring, so pushes nobody is watching can be refused
+    'ADVERTISE_INTERVAL': float(
+        os.environ.get('MONITOR_PUBSUB_ADVERTISE_INTERVAL', 5)),
+}
+
+# Queue between receipt of monitor pushes and their fan-out to sockets.
+# OVERFLOW is what happens to a push when the queue is full: 'drop-oldest'
+# discards the oldest queued events, 'block' waits up to BLOCK_TIMEOUT seconds
+# for room, and 'reject' answers with a 503 so Device Cloud retries later.
+# Only 'drop-oldest' starts queueing a push before all of it has been read;
+# with the others a push is queued whole or refused.
+# More than one worker may reorder events for the same device.
+MONITOR_DISPATCH = {
+    'QUEUE_SIZE': int(os.environ.get('MONITOR_DISPATCH_QUEUE_SIZE', 10000)),
+    'WORKERS': int(os.environ.get('MONITOR_DISPATCH_WORKERS', 1)),
+    'OVERFLOW': os.environ.get('MONITOR_DISPATCH_OVERFLOW', 'drop-oldest'),
+    'BLOCK_TIMEOUT': float(
+        os.environ.get('MONITOR_DISPATCH_BLOCK_TIMEOUT', 5)),
+}
+
+# Per-socket batching of device data. Events are collected for WINDOW seconds
+# and sent as one device_data_batch frame, at most MAX_RATE frames a second.
+# When a socket has more than MAX_PENDING events waiting, OVERFLOW decides
+# what is kept: 'merge' keeps the latest value of each stream, 'drop' drops
+# the oldest events. Batches are held back while a client still has frames
+# waiting to be sent. A WINDOW of 0 sends each event as its own device_data
+# frame.
+SOCKET_OUTBOUND = {
+    'WINDOW': float(os.environ.get('SOCKET_OUTBOUND_WINDOW', 0.05)),
+    'MAX_RATE': float(os.environ.get('SOCKET_OUTBOUND_MAX_RATE', 20)),
+    'MAX_PENDING': int(os.environ.get('SOCKET_OUTBOUND_MAX_PENDING', 1000)),
+    'OVERFLOW': os.environ.get('SOCKET_OUTBOUND_OVERFLOW', 'merge'),
+}
+
+# DataPoint monitors. With MODE 'device', a Device Cloud monitor is created
+# for each monitored device. With 'account', a single monitor pushes data for
+# every device in the account and pushes are filtered here to the devices
+# being watched, meaning fewer, larger pushes. BATCH_SIZE and BATCH_DURATION
+# (seconds) are used for newly created monitors.
+MONITOR_DATAPOINT = {
+    'MODE': os.environ.get('MONITOR_DATAPOINT_MODE', 'device'),
+    'BATCH_SIZE': int(os.environ.get('MONITOR_DATAPOINT_BATCH_SIZE', 1000)),
+    'BATCH_DURATION': int(
+        os.environ.get('MONITOR_DATAPOINT_BATCH_DURATION', 1)),
+}
+
+# Reuse of monitor setups. A monitor is not queried and kicked again within
+# MIN_KICK_INTERVAL seconds of its last setup, nor while its pushes keep
+# arriving (at least once every PUSH_TIMEOUT seconds).
+MONITOR_STATE_CACHE = {
+    'MIN_KICK_INTERVAL': int(
+        os.environ.get('MONITOR_MIN_KICK_INTERVAL', 60)),
+    'PUSH_TIMEOUT': int(os.environ.get('MONITOR_PUSH_TIMEOUT', 300)),
+    'SIZE': int(os.environ.get('MONITOR_STATE_CACHE_SIZE', 1000)),
+}
+
+# Monitor pushes are parsed as they are read, CHUNK_SIZE bytes at a time.
+# Events are handed to the dispatch queue every DISPATCH_BATCH messages, so
+# the front of a large push is delivered while the rest is still arriving.
+MONITOR_PUSH_STREAMING = {
+    'CHUNK_SIZE': int(os.environ.get('MONITOR_PUSH_CHUNK_SIZE', 8192)),
+    'DISPATCH_BATCH': int(os.environ.get('MONITOR_PUSH_DISPATCH_BATCH', 100)),
+}
+
+# Adaptive DataPoint monitor batching. Every INTERVAL seconds, each monitor's
+# batch duration is set between MIN_DURATION and MAX_DURATION seconds,
+# growing with its message rate (reaching MAX_DURATION at BUSY_RATE messages
+# per second), and shortened whenever delivery latency exceeds MAX_LATENCY
+# seconds. MAX_DURATION may not be more than MAX_LATENCY. Batch sizes are kept
+# within MIN_SIZE and MAX_SIZE. Tuning changes the monitors on Device Cloud,
+# so is off unless enabled.
+MONITOR_BATCH_TUNING = {
+    'ENABLED': bool(strtobool(
+        os.environ.get('MONITOR_BATCH_TUNING_ENABLED', 'false'))),
+    'INTERVAL': int(os.environ.get('MONITOR_BATCH_TUNING_INTERVAL', 60)),
+    'MIN_DURATION': int(os.environ.get('MONITOR_BATCH_MIN_DURATION', 1)),
+    'MAX_DURATION': int(os.environ.get('MONITOR_BATCH_MAX_DURATION', 5)),
+    'MAX_LATENCY': float(os.environ.get('MONITOR_BATCH_MAX_LATENCY', 5)),
+    'BUSY_RATE': float(os.environ.get('MONITOR_BATCH_BUSY_RATE', 50)),
+    'MIN_SIZE': int(os.environ.get('MONITOR_BATCH_MIN_SIZE', 10)),
+    'MAX_SIZE': int(os.environ.get('MONITOR_BATCH_MAX_SIZE', 1000)),
+}
+
+# Charts ask for DataPoint histories reduced to a number of points. Let
+# Device Cloud roll streams up where it can, rather than always fetching
+# every raw point and reducing them here, as long as its rollup intervals
+# give at least MIN_FRACTION of the points asked for. Shorter windows are
+# reduced here.
+DATAPOINT_ROLLUPS = {
+    'DEVICE_CLOUD': bool(strtobool(
+        os.environ.get('DATAPOINT_DEVICE_CLOUD_ROLLUPS', 'true'))),
+    'MIN_FRACTION': float(
+        os.environ.get('DATAPOINT_ROLLUP_MIN_FRACTION', 0.125)),
+}
+
+# Keep DataPoints received in monitor pushes in the database, and answer
+# history queries from them where they cover the window asked for. Chunks
+# older than RETENTION_DAYS are removed by the prune_datapoint_store command.
+# Pushes are written in the background; when more than MAX_PENDING DataPoints
+# are waiting, further pushes aren't stored.
+DATAPOINT_STORE = {
+    'ENABLED': bool(strtobool(
+        os.environ.get('DATAPOINT_STORE_ENABLED', 'false'))),
+    'RETENTION_DAYS': int(os.environ.get('DATAPOINT_STORE_RETENTION_DAYS', 7)),
+    'MAX_PENDING': int(os.environ.get('DATAPOINT_STORE_MAX_PENDING', 10000)),
+}
+
+# Number of devices whose latest DataPoint values are kept, to send to sockets
+# as soon as they start monitoring a device
+LATEST_VALUE_CACHE_SIZE = int(os.environ.get('LATEST_VALUE_CACHE_SIZE', 1000))
+
+# Recent DataPoints of watched streams are kept in memory, CAPACITY points
+# per stream (16 bytes each) for at most MAX_STREAMS streams, to answer the
+# last few minutes of history without asking Device Cloud. Streams not pushed
+# to for IDLE_TIMEOUT seconds are forgotten. Only used with a MONITOR_PUBSUB
+# backend other than 'local', so every worker sees every push.
+RECENT_DATAPOINTS = {
+    'ENABLED': bool(strtobool(
+        os.environ.get('RECENT_DATAPOINTS_ENABLED', 'true'))),
+    'CAPACITY': int(os.environ.get('RECENT_DATAPOINTS_CAPACITY', 300)),
+    'MAX_STREAMS': int(os.environ.get('RECENT_DATAPOINTS_MAX_STREAMS', 2000)),
+    'IDLE_TIMEOUT': int(os.environ.get('RECENT_DATAPOINTS_IDLE_TIMEOUT', 600)),
+}
+
+# Number of monitor push topic strings (one per device stream) whose routing
+# is cached. Should cover every stream being monitored by a worker.
+MONITOR_TOPIC_CACHE_SIZE = int(
+    os.environ.get('MONITOR_TOPIC_CACHE_SIZE', 4096))
+
 # Supported Device Types (dpDeviceType) visible to frontend.
 # Will be used to filter Device Cloud queries
 SUPPORTED_DEVICE_TYPES = [
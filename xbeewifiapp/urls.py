@@ -74,11 +74,14 @@ dashboard_api_patterns = patterns(
     url(r'^login$', 'login_user', name='api_login'),
     url(r'^logout$', 'logout_user', name='api_logout'),
     url(r'^monitor$', 'monitor_receiver', name='monitor_receiver'),
+    url(r'^monitor/stats$', 'monitor_stats', name='monitor_stats'),
     url(r'^monitor/setup/devicecore', 'monitor_devicecore_setup',
         name='monitor_setup_devicecore'),
     url(r'^monitor/setup/(?P<device_id>[0-9A-F\-]+)$', 'monitor_setup',
         name='monitor_setup'),
     url(r'^devices$', views.DevicesList.as_view(), name='devices-list'),
+    url(r'^devices/config-stock$', views.DevicesConfigStock.as_view(),
+        name='devices-config-stock'),
     url(r'^devices/(?P<device_id>[0-9A-F\-]+)$', views.DevicesDetail.as_view(),
         name='devices-detail'),
     url(r'^devices/(?P<device_id>[0-9A-F\-]+)/io$', views.DeviceIO.as_view(),